@@ -1,5 +1,5 @@
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
@@ -13,6 +13,13 @@ from src.payments.ApplePay.apple_pay_routes import router as apple_pay_router
 from src.payments.GooglePay.google_pay_routes import router as google_pay_router
 from src.payments.AmazonPay.amazon_pay_routes import router as amazon_pay_router
 from src.db.common.database_connection import init_database
+from src.ai.services.http_client import close_http_client
+from src.ai.services.llm import close_openai_client
+from src.ai.services.render_pool import shutdown_render_pool
+from src.ai.services.tracing import tracing_middleware, shutdown_tracing
+from src.ai.services.metrics import metrics_middleware, metrics_payload, start_metrics, shutdown_metrics
+from src.ai.services.remove_background import warm_up_background_remover, shutdown_background_remover
+from src.ai.services.book_jobs import shutdown_book_jobs
 from test.route.test_routes import router as test_router
 
 # Load environment variables
@@ -50,6 +57,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Mỗi request là một trace: span theo từng stage, thống kê theo endpoint (/api/v1/tracing/stats)
+app.middleware("http")(tracing_middleware)
+
+# Histogram thời gian xử lý theo route /api/v1, gộp giữa các worker tại /metrics
+app.middleware("http")(metrics_middleware)
+
 # Database sẽ được init khi có request đầu tiên đến
 # @app.on_event("startup")
 # async def startup_event():
@@ -67,12 +80,36 @@ app.add_middleware(
 #         # Có thể raise exception để dừng ứng dụng nếu database không khởi tạo được
 #         # raise e
 
+@app.on_event("startup")
+async def startup_event():
+    """Bắt đầu lấy mẫu định kỳ các gauge (queue depth, connection pool) của worker và warm-up session tách nền"""
+    start_metrics()
+    warm_up_background_remover()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Dừng các job render sách còn chạy (ghi lý do cho client), đóng connection pool của HTTP client và OpenAI client dùng chung, process pool render PDF, thread pool tách nền, đẩy nốt span đang chờ export và bỏ metric của worker"""
+    await shutdown_book_jobs()
+    await close_http_client()
+    await close_openai_client()
+    shutdown_render_pool()
+    shutdown_background_remover()
+    shutdown_tracing()
+    shutdown_metrics()
+
 # Health check route
 @app.get("/health")
 async def health():
     """Health check endpoint"""
     return "healthy"
 
+# Prometheus metrics (gộp mọi worker khi đặt PROMETHEUS_MULTIPROC_DIR)
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint"""
+    body, content_type = await metrics_payload()
+    return Response(content=body, media_type=content_type)
+
 # Root route
 @app.get("/")
 async def root():
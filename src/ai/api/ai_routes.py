@@ -1,63 +1,44 @@
-# Utility to ensure transparent background on swapped images
-async def convert_image_to_transparent_base64(image_url: str) -> str:
-    try:
-        image = _load_image_from_source(image_url)
-
-        cleaned_data = []
-        for pixel in image.getdata():
-            r, g, b, a = pixel
-            if r < 10 and g < 10 and b < 10:
-                cleaned_data.append((r, g, b, 0))
-            else:
-                cleaned_data.append((r, g, b, a))
+import time
+import asyncio
+import json
+import requests
+from typing import Union
+from src.ai.services.image_utils import ImageHandle, load_transparent_handle
 
-        image.putdata(cleaned_data)
 
-        buffer = io.BytesIO()
-        image.save(buffer, format="PNG")
-        base64_image = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        return f"data:image/png;base64,{base64_image}"
+# Utility to ensure transparent background on swapped images
+async def load_transparent_image(image_url: str) -> Union[ImageHandle, str]:
+    """Load ảnh đã swap (HTTP client async dùng chung) và tách nền đen; trả về ImageHandle để renderer dùng trực tiếp."""
+    try:
+        return await load_transparent_handle(image_url)
 
     except Exception as e:
-        print(f"Warning: Failed to convert image to transparent base64: {e}")
+        print(f"Warning: Failed to make image background transparent: {e}")
         return image_url
-import time
-import asyncio
-import json
-import base64
-import io
-import requests
-import yaml
-from PIL import Image
-
-
-def _load_image_from_source(image_source: str) -> Image.Image:
-    """Load image from a URL or data URL into a PIL Image."""
-    if image_source.startswith("data:image/"):
-        header, base64_data = image_source.split(",", 1)
-        image_bytes = base64.b64decode(base64_data)
-    else:
-        response = requests.get(image_source, timeout=60)
-        response.raise_for_status()
-        image_bytes = response.content
-
-    image = Image.open(io.BytesIO(image_bytes))
-    if image.mode not in ("RGBA", "LA"):
-        image = image.convert("RGBA")
-    return image
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header, Request, Query
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
-from src.ai.services.llm import gen_script  # Import hàm từ services
+from src.ai.services.llm import gen_script, stream_script  # Import hàm từ services
 from src.ai.services.gen_illustration_image import gen_illustration_image  # Import hàm xử lý image
 from src.ai.services.gen_avatar import gen_avatar  # Import hàm tạo cartoon image
 from src.ai.services.create_content import create_main_content
 from src.ai.services.get_page_id import get_page_id  # Import hàm get_page_id từ services
-from src.ai.services.swap_face import swap_face  # Import hàm swap_face từ services
+from src.ai.services.catalog import catalog
+from src.ai.services.swap_face import swap_face, swap_face_cached  # Import hàm swap_face từ services
 from src.ai.services.create_cover import create_cover  # Import hàm create_cover từ services
 from src.ai.services.create_interleafs import create_interleafs  # Import hàm create_interleafs từ services
-from src.ai.services.create_book import create_book  # Import hàm create_book từ services
+from src.ai.services.book_jobs import (
+    book_job_store, start_or_join_book_job, wait_for_book_job, IdempotencyConflict, JOB_STATUS_COMPLETED
+)
+from src.ai.services.render_pool import render_pool
+from src.ai.services.remove_background import remove_background, background_remover
+from src.ai.services.tracing import tracing_stats
+from src.ai.services.inference_backend import verify_prediction_webhook, InferenceBackendError
+from src.ai.services.prediction_webhooks import prediction_inbox
+from src.ai.services.prediction_scheduler import (
+    prediction_scheduler, prediction_priority, PRIORITY_PREVIEW
+)
 
 # Pydantic models cho gen_script endpoint
 class StoryRequest(BaseModel):
@@ -77,8 +58,13 @@ class GenScriptResponse(BaseModel):
     script_type: str
     processing_time: float
     model_used: str
+    cache_hit: bool = False
     success: bool
 
+class ThemeScriptRequest(BaseModel):
+    type: str  # Theme của sách (vd: "space", "ocean")
+    name: str  # Character name
+
 # Pydantic models cho gen_illustration_image endpoint
 class GenImagesRequest(BaseModel):
     prompt: str  # Prompt tạo ảnh
@@ -158,6 +144,13 @@ class CreateBookResponse(BaseModel):
     processing_time: float
     success: bool
 
+# Pydantic models cho book job endpoints
+class CreateBookJobResponse(BaseModel):
+    job_id: str
+    status: str
+    status_url: str
+    joined: bool = False  # True nếu request trùng với job đã có (cùng nội dung hoặc cùng Idempotency-Key)
+
 # Pydantic models cho create_cover endpoint
 class CreateCoverRequest(BaseModel):
     category_id: str
@@ -189,6 +182,41 @@ async def get_page_id_endpoint(request: PageIdRequest) -> PageIdResponse:
     return PageIdResponse(id=page_id)
 
 
+@router.post("/gen-script/", response_model=GenScriptResponse)
+async def gen_script_endpoint(request: ThemeScriptRequest, stream: bool = Query(False)):
+    """
+    Tạo script sách thiếu nhi theo theme bằng OpenAI (script giống nhau được cache).
+
+    Request body:
+    - type: Theme của sách
+    - name: Tên nhân vật chính
+
+    Query:
+    - stream: true để nhận JSON của script theo từng đoạn ngay khi model sinh ra (application/json, chunked)
+    """
+    if stream:
+        chunks = stream_script(request.type, request.name)
+        # Lấy đoạn đầu trước khi trả response để lỗi cấu hình/API trả về 500 thay vì cắt ngang stream
+        try:
+            first_chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            first_chunk = ""
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to generate script: {str(e)}")
+
+        async def generate_script():
+            yield first_chunk
+            async for chunk in chunks:
+                yield chunk
+
+        return StreamingResponse(generate_script(), media_type="application/json")
+
+    result = await gen_script(request.type, request.name)
+    if not result.get("success"):
+        raise HTTPException(status_code=500, detail=f"Failed to generate script: {result.get('error')}")
+    return result
+
+
 @router.post("/swap-face/", response_model=SwapFaceResponse)
 async def swap_face_endpoint(request: SwapFaceRequest) -> SwapFaceResponse:
     """
@@ -201,10 +229,11 @@ async def swap_face_endpoint(request: SwapFaceRequest) -> SwapFaceResponse:
 
     Response: SwapFaceResponse với URL ảnh đã swap và metadata
     """
-    result = await swap_face(
-        face_image_url=request.face_image_url,
-        body_image_url=request.body_image_url
-    )
+    with prediction_priority(PRIORITY_PREVIEW):
+        result = await swap_face(
+            face_image_url=request.face_image_url,
+            body_image_url=request.body_image_url
+        )
 
     return SwapFaceResponse(
         swapped_image_url=result.get("swapped_image_url", ""),
@@ -234,16 +263,6 @@ async def create_content_endpoint(request: CreateBookRequest):
     start_time = time.time()
 
     try:
-        # Load catalog metadata
-        from pathlib import Path
-        import yaml
-
-        BASE_DIR = Path(__file__).resolve().parents[3]
-        catalog_path = BASE_DIR / "assets" / "interiors" / "pages_metadata.yaml"
-
-        with catalog_path.open("r", encoding="utf-8") as f:
-            catalog_data = yaml.safe_load(f)
-
         # Collect all pages to process
         all_pages = []
         for story_req in request.stories:
@@ -263,14 +282,12 @@ async def create_content_endpoint(request: CreateBookRequest):
         # Process all pages in parallel
         async def process_page(page_key):
             try:
-                page_metadata = catalog_data["pages"].get(page_key)
+                page_metadata = catalog.get_page(page_key)
                 if not page_metadata:
                     return None, None
 
                 # Load story content
-                story_file_path = BASE_DIR / page_metadata["story_file"]
-                with story_file_path.open("r", encoding="utf-8") as f:
-                    story_data = json.load(f)
+                story_data = catalog.load_json(page_metadata["story_file"])
 
                 page_content = story_data.get("page_content")
                 if not page_content:
@@ -284,7 +301,7 @@ async def create_content_endpoint(request: CreateBookRequest):
                 # Send file path directly instead of URL for Replicate upload
 
                 # Face swap
-                face_swap_result = await swap_face(
+                face_swap_result = await swap_face_cached(
                     face_image_url=request.image_url,
                     body_image_url=character_path  # Send file path for direct upload
                 )
@@ -295,8 +312,8 @@ async def create_content_endpoint(request: CreateBookRequest):
                     # Use file path directly for local files
                     swapped_image_url = character_path
 
-                # Ensure the swapped image has transparent background (convert to base64 data URL)
-                processed_image_data = await convert_image_to_transparent_base64(swapped_image_url)
+                # Ensure the swapped image has transparent background (giữ ảnh đã decode cho renderer)
+                processed_image_data = await load_transparent_image(swapped_image_url)
 
                 return page_content, processed_image_data
 
@@ -323,11 +340,11 @@ async def create_content_endpoint(request: CreateBookRequest):
         # Collect background local paths from catalog metadata
         background_urls = []
         for page_key in all_pages:
-            page_metadata = catalog_data["pages"].get(page_key)
+            page_metadata = catalog.get_page(page_key)
             if page_metadata:
                 background_path = page_metadata["background"]
                 # Use local file path for PDF generation (like the old create_page did)
-                background_full_path = BASE_DIR / background_path
+                background_full_path = catalog.resolve(background_path)
                 if background_full_path.exists():
                     background_urls.append(str(background_full_path))
                 else:
@@ -388,12 +405,13 @@ async def create_cover_endpoint(request: CreateCoverRequest):
 
     try:
         # Tạo cover PDF
-        pdf_bytes = await create_cover(
-            category_id=request.category_id,
-            book_id=request.book_id,
-            name=request.name,
-            image_url=request.image_url
-        )
+        with prediction_priority(PRIORITY_PREVIEW):
+            pdf_bytes = await create_cover(
+                category_id=request.category_id,
+                book_id=request.book_id,
+                name=request.name,
+                image_url=request.image_url
+            )
 
         processing_time = time.time() - start_time
 
@@ -439,13 +457,14 @@ async def create_interleaf_endpoint(request: CreateInterleafRequest):
 
     try:
         # Tạo interleaf PDF
-        pdf_bytes = await create_interleafs(
-            category_id=request.category_id,
-            book_id=request.book_id,
-            interleaf_count=request.interleaf_count,
-            name=request.name,
-            image_url=request.image_url
-        )
+        with prediction_priority(PRIORITY_PREVIEW):
+            pdf_bytes = await create_interleafs(
+                category_id=request.category_id,
+                book_id=request.book_id,
+                interleaf_count=request.interleaf_count,
+                name=request.name,
+                image_url=request.image_url
+            )
 
         processing_time = time.time() - start_time
 
@@ -474,8 +493,21 @@ async def create_interleaf_endpoint(request: CreateInterleafRequest):
         )
 
 
+def _book_request_data(request: CreateBookRequest) -> dict:
+    return {
+        "category_id": request.category_id,
+        "book_id": request.book_id,
+        "stories": [story.dict() for story in request.stories],
+        "name": request.name,
+        "image_url": request.image_url
+    }
+
+
 @router.post("/create-book/", response_model=CreateBookResponse)
-async def create_book_endpoint(request: CreateBookRequest):
+async def create_book_endpoint(
+    request: CreateBookRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """
     Tạo toàn bộ cuốn sách PDF bao gồm cover, content và interleafs.
 
@@ -493,63 +525,138 @@ async def create_book_endpoint(request: CreateBookRequest):
     - name: Tên nhân vật chính
     - image_url: URL ảnh face để swap vào characters
 
+    Header (tùy chọn):
+    - Idempotency-Key: retry với cùng key trả về cùng cuốn sách thay vì render lại
+
+    Request trùng nội dung (double-click, client retry) chờ job render đang chạy thay vì render lần nữa;
+    sách đã render xong được trả lại từ artifact store.
+
     Response: CreateBookResponse với URL download file PDF
     """
-    start_time = time.time()
-
     try:
-        # Tạo book PDF hoàn chỉnh
-        pdf_bytes = await create_book(
-            category_id=request.category_id,
-            book_id=request.book_id,
-            stories=[story.dict() for story in request.stories],  # Convert to dict
-            name=request.name,
-            image_url=request.image_url
+        # Render chạy trong job nền (ưu tiên PRIORITY_PAID), request này chờ job kết thúc
+        job, joined = await start_or_join_book_job(_book_request_data(request), idempotency_key)
+        job = await wait_for_book_job(job["job_id"])
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Book creation failed: {str(e)}"
         )
 
-        processing_time = time.time() - start_time
+    if job["status"] != JOB_STATUS_COMPLETED:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Book creation failed: {job.get('error')}"
+        )
+
+    return CreateBookResponse(
+        download_url=job["download_url"],
+        file_size=job["file_size"],
+        page_count=job["page_count"],
+        stories_count=len(request.stories),
+        interleaf_count=len(request.stories) // 2,
+        processing_time=job["processing_time"],
+        success=True
+    )
 
-        # Tính số interleaf và tổng số trang
-        interleaf_count = len(request.stories) // 2
-        total_pages = 1 + (len(request.stories) * 2) + (interleaf_count * 2)  # cover + content pages + interleaf pages
 
-        # Lưu file PDF vào thư mục runs
-        import os
-        from pathlib import Path
 
-        # Tạo tên file duy nhất
-        timestamp = int(time.time())
-        filename = f"book_{request.category_id}_{request.book_id}_{timestamp}.pdf"
-        filepath = Path("runs") / filename
+@router.post("/book-jobs/", response_model=CreateBookJobResponse, status_code=202)
+async def create_book_job_endpoint(
+    request: CreateBookRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+) -> CreateBookJobResponse:
+    """
+    Tạo job render sách bất đồng bộ. Trả về job_id ngay lập tức; việc render tiếp tục trong nền
+    kể cả khi client ngắt kết nối (nginx timeout, mạng di động).
 
-        # Đảm bảo thư mục tồn tại
-        os.makedirs("runs", exist_ok=True)
+    Request body: giống /create-book/
+    Header (tùy chọn): Idempotency-Key
 
-        # Lưu file PDF
-        with open(filepath, "wb") as f:
-            f.write(pdf_bytes)
+    Response: job_id và URL để poll trạng thái; request trùng với job đang chạy hoặc đã xong
+    nhận lại job đó (joined = true)
+    """
+    try:
+        job, joined = await start_or_join_book_job(_book_request_data(request), idempotency_key)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    return CreateBookJobResponse(
+        job_id=job["job_id"],
+        status=job["status"],
+        status_url=f"/api/v1/book-jobs/{job['job_id']}",
+        joined=joined
+    )
 
-        # Tạo URL download
-        download_url = f"http://localhost:8000/runs/{filename}"
 
-        return CreateBookResponse(
-            download_url=download_url,
-            file_size=len(pdf_bytes),
-            page_count=total_pages,
-            stories_count=len(request.stories),
-            interleaf_count=interleaf_count,
-            processing_time=processing_time,
-            success=True
-        )
+@router.get("/book-jobs/{job_id}")
+async def get_book_job_endpoint(job_id: str):
+    """
+    Trạng thái của job render sách: status, tiến độ theo từng stage
+    (cover, story_XX, interleafs, render) và download_url khi hoàn tất.
+    """
+    job = book_job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Book job not found")
 
-    except Exception as e:
-        processing_time = time.time() - start_time
-        raise HTTPException(
-            status_code=500,
-            detail=f"Book creation failed: {str(e)}"
-        )
+    job.pop("request", None)
+    return job
 
 
+# Route xem trạng thái scheduler của các prediction (queue depth, số prediction đang chạy)
+@router.get("/scheduler/stats")
+async def scheduler_stats_endpoint():
+    """
+    Trạng thái hiện tại của scheduler dùng chung cho swap_face, gen_avatar và gen_illustration_image
+    trong worker xử lý request này.
+    """
+    return {**prediction_scheduler.stats(), "webhooks": prediction_inbox.stats()}
+
+
+@router.post("/replicate/webhook", include_in_schema=False)
+async def replicate_webhook_endpoint(request: Request):
+    """
+    Nhận kết quả prediction từ Replicate (REPLICATE_WEBHOOK_URL trỏ tới endpoint này).
+    Chữ ký được kiểm tra trước khi kết quả được chuyển cho coroutine đang chờ prediction.
+    """
+    body = (await request.body()).decode("utf-8")
+    try:
+        await verify_prediction_webhook(dict(request.headers), body)
+        prediction_inbox.deliver(json.loads(body))
+    except InferenceBackendError as e:
+        print(f"Warning: Rejected Replicate webhook: {e}")
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid webhook payload: {e}")
+    return {"received": True}
+
+
+@router.get("/render-pool/stats")
+async def render_pool_stats_endpoint():
+    """
+    Trạng thái process pool render PDF của worker xử lý request này (số job đang chờ, thời gian chờ trong hàng đợi).
+    """
+    return render_pool.stats()
+
+
+@router.get("/remove-background/stats")
+async def remove_background_stats_endpoint():
+    """
+    Trạng thái session pool tách nền của worker xử lý request này (số session, số batch, kích thước batch trung bình).
+    """
+    return background_remover.stats()
+
+
+@router.get("/tracing/stats")
+async def tracing_stats_endpoint():
+    """
+    Thời gian từng stage (prediction.queue, swap_face, image.download, *.pool_wait, render.pdf...)
+    gộp theo endpoint trong worker xử lý request này.
+    """
+    return tracing_stats()
+
 
 # Route tạo hình ảnh từ nội dung sách
 @router.post("/gen-illustration-image/", response_model=GenImagesResponse)
@@ -562,10 +669,11 @@ async def create_images(request: GenImagesRequest):
 
     try:
         # Gọi hàm gen_illustration_image từ models với prompt và image_url
-        generated_url = await gen_illustration_image(
-            prompt=request.prompt,
-            image_url=request.image_url
-        )
+        with prediction_priority(PRIORITY_PREVIEW):
+            generated_url = await gen_illustration_image(
+                prompt=request.prompt,
+                image_url=request.image_url
+            )
 
         processing_time = time.time() - start_time
 
@@ -604,9 +712,10 @@ async def create_cartoon_image(request: GenCartoonImageRequest):
 
     try:
         # Gọi hàm gen_avatar từ models với image_url
-        generated_url = await gen_avatar(
-            image_url=request.image_url
-        )
+        with prediction_priority(PRIORITY_PREVIEW):
+            generated_url = await gen_avatar(
+                image_url=request.image_url
+            )
 
         processing_time = time.time() - start_time
 
@@ -0,0 +1,288 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from .swap_cache import PROJECT_ROOT
+
+
+# "local" (thư mục runs, phục vụ qua /runs) hoặc "s3" (S3 / MinIO / R2...)
+ARTIFACT_STORE_BACKEND = os.getenv("ARTIFACT_STORE_BACKEND", "local").lower()
+# URL gốc public của API (dùng cho link download của backend local)
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost:8000").rstrip("/")
+
+# Backend local: file nằm dưới RUNS_DIR (được mount tại /runs)
+RUNS_DIR = Path(os.getenv("RUNS_DIR", str(PROJECT_ROOT / "runs")))
+ARTIFACT_LOCAL_PREFIX = os.getenv("ARTIFACT_LOCAL_PREFIX", "books")
+
+# Backend S3 (boto3 là dependency tùy chọn, chỉ cần khi dùng backend này)
+ARTIFACT_S3_BUCKET = os.getenv("ARTIFACT_S3_BUCKET", "")
+ARTIFACT_S3_PREFIX = os.getenv("ARTIFACT_S3_PREFIX", "books")
+ARTIFACT_S3_ENDPOINT_URL = os.getenv("ARTIFACT_S3_ENDPOINT_URL") or None  # vd: http://localhost:9000 cho MinIO
+ARTIFACT_S3_REGION = os.getenv("ARTIFACT_S3_REGION") or None
+# URL public của bucket/CDN; nếu để trống sẽ trả presigned URL
+ARTIFACT_PUBLIC_BASE_URL = (os.getenv("ARTIFACT_PUBLIC_BASE_URL") or "").rstrip("/")
+ARTIFACT_PRESIGN_SECONDS = int(os.getenv("ARTIFACT_PRESIGN_SECONDS", str(24 * 3600)))
+
+# Retention: xóa artifact không được dùng quá TTL, và xóa cũ nhất khi tổng dung lượng vượt quota
+ARTIFACT_TTL_SECONDS = int(os.getenv("ARTIFACT_TTL_SECONDS", str(30 * 24 * 3600)))
+ARTIFACT_MAX_MB = int(os.getenv("ARTIFACT_MAX_MB", "10240"))
+# Khoảng thời gian tối thiểu giữa hai lần quét để eviction
+ARTIFACT_PURGE_INTERVAL_SECONDS = int(os.getenv("ARTIFACT_PURGE_INTERVAL_SECONDS", "300"))
+
+_CONTENT_TYPES = {".pdf": "application/pdf", ".png": "image/png", ".jpg": "image/jpeg"}
+
+
+def _content_type_for(key: str) -> str:
+    return _CONTENT_TYPES.get(Path(key).suffix.lower(), "application/octet-stream")
+
+
+class ArtifactStoreError(Exception):
+    """Backend lưu trữ artifact không dùng được (cấu hình sai, thiếu boto3...)."""
+
+
+class LocalArtifactBackend:
+    """Lưu artifact trên filesystem dưới RUNS_DIR/<prefix>, phục vụ bởi StaticFiles tại /runs."""
+
+    def __init__(self, runs_dir: Path, prefix: str, public_base_url: str):
+        self.runs_dir = Path(runs_dir)
+        self.prefix = prefix.strip("/")
+        self.root = self.runs_dir / self.prefix
+        self.public_base_url = public_base_url
+
+    def _path_for(self, key: str) -> Path:
+        return self.root / key
+
+    def exists(self, key: str) -> bool:
+        return self._path_for(key).is_file()
+
+    def touch(self, key: str) -> None:
+        # Làm mới mtime: artifact vừa được dùng lại không bị xóa theo TTL/LRU
+        try:
+            os.utime(self._path_for(key))
+        except OSError:
+            pass
+
+    def write(self, key: str, data: bytes, content_type: str) -> None:
+        path = self._path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def url_for(self, key: str) -> str:
+        return f"{self.public_base_url}/runs/{self.prefix}/{key}"
+
+    def list_objects(self) -> List[Tuple[str, float, int]]:
+        """Danh sách (key, thời điểm dùng gần nhất, size)."""
+        objects = []
+        if not self.root.exists():
+            return objects
+        for path in self.root.rglob("*"):
+            if not path.is_file() or path.name.startswith("."):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            objects.append((str(path.relative_to(self.root)), stat.st_mtime, stat.st_size))
+        return objects
+
+    def delete(self, key: str) -> None:
+        try:
+            self._path_for(key).unlink()
+        except FileNotFoundError:
+            pass
+
+
+class S3ArtifactBackend:
+    """
+    Lưu artifact trên S3 hoặc dịch vụ tương thích S3 (MinIO chạy local để test, Cloudflare R2...).
+    TTL dựa trên LastModified; nên cấu hình thêm lifecycle rule của bucket để xóa phía server.
+    """
+
+    def __init__(self, bucket: str, prefix: str, endpoint_url: Optional[str], region: Optional[str], public_base_url: str, presign_seconds: int):
+        try:
+            import boto3
+        except ImportError:
+            raise ArtifactStoreError("ARTIFACT_STORE_BACKEND=s3 requires boto3 (pip install boto3)")
+        if not bucket:
+            raise ArtifactStoreError("ARTIFACT_S3_BUCKET is not set")
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.public_base_url = public_base_url
+        self.presign_seconds = presign_seconds
+        self._client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def touch(self, key: str) -> None:
+        # Copy lên chính nó để cập nhật LastModified (giữ artifact vừa dùng lại khỏi bị xóa theo TTL)
+        object_key = self._object_key(key)
+        self._client.copy_object(
+            Bucket=self.bucket, Key=object_key,
+            CopySource={"Bucket": self.bucket, "Key": object_key},
+            MetadataDirective="REPLACE",
+            ContentType=_content_type_for(key)
+        )
+
+    def write(self, key: str, data: bytes, content_type: str) -> None:
+        self._client.put_object(Bucket=self.bucket, Key=self._object_key(key), Body=data, ContentType=content_type)
+
+    def url_for(self, key: str) -> str:
+        if self.public_base_url:
+            return f"{self.public_base_url}/{self._object_key(key)}"
+        return self._client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._object_key(key)},
+            ExpiresIn=self.presign_seconds
+        )
+
+    def list_objects(self) -> List[Tuple[str, float, int]]:
+        objects = []
+        paginator = self._client.get_paginator("list_objects_v2")
+        prefix = f"{self.prefix}/" if self.prefix else ""
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                objects.append((item["Key"][len(prefix):], item["LastModified"].timestamp(), item["Size"]))
+        return objects
+
+    def delete(self, key: str) -> None:
+        self._client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+
+class ArtifactStore:
+    """
+    Kho lưu sách PDF (và artifact khác) đã tạo, địa chỉ hóa theo nội dung.
+
+    Key = SHA-256 của nội dung nên cùng một cuốn sách render lại chỉ được lưu một lần.
+    Ghi/đọc chạy trên thread pool (không chặn event loop). Sau khi ghi, định kỳ xóa artifact
+    quá ARTIFACT_TTL_SECONDS và artifact ít dùng nhất khi tổng dung lượng vượt ARTIFACT_MAX_MB.
+    """
+
+    def __init__(self, backend, ttl_seconds: int, max_bytes: int, purge_interval: int):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.purge_interval = purge_interval
+        self._last_purge = 0.0
+        self._purge_lock = threading.Lock()
+
+    @staticmethod
+    def key_for(digest: str, suffix: str) -> str:
+        return f"{digest[:2]}/{digest}{suffix}"
+
+    def _put_sync(self, data: bytes, suffix: str) -> Dict[str, Any]:
+        digest = hashlib.sha256(data).hexdigest()
+        key = self.key_for(digest, suffix)
+
+        deduplicated = self.backend.exists(key)
+        if deduplicated:
+            # Chỉ làm mới thời điểm dùng khi ghi trùng nội dung; exists()/get_url() chỉ đọc metadata
+            self.backend.touch(key)
+        else:
+            self.backend.write(key, data, _content_type_for(key))
+            self._maybe_purge()
+
+        return {
+            "key": key,
+            "sha256": digest,
+            "size": len(data),
+            "url": self.backend.url_for(key),
+            "deduplicated": deduplicated,
+        }
+
+    async def put(self, data: bytes, suffix: str = ".pdf") -> Dict[str, Any]:
+        """
+        Lưu artifact (bỏ qua nếu đã có cùng nội dung) và trả về thông tin + URL public.
+
+        Args:
+            data: Nội dung artifact
+            suffix: Phần mở rộng file (quyết định content type)
+
+        Returns:
+            Dict gồm key, sha256, size, url, deduplicated
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._put_sync, data, suffix)
+
+    def _get_sync(self, key: str) -> Optional[str]:
+        return self.backend.url_for(key) if self.backend.exists(key) else None
+
+    async def get_url(self, key: str) -> Optional[str]:
+        """URL của artifact nếu còn tồn tại (chưa bị eviction), None nếu không."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._get_sync, key)
+
+    def _maybe_purge(self) -> None:
+        now = time.time()
+        if now - self._last_purge < self.purge_interval or not self._purge_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_purge = now
+            removed = self.purge()
+            if removed:
+                print(f"DEBUG artifact_store: Evicted {removed} artifact(s)")
+        except Exception as e:
+            print(f"Warning: Artifact eviction failed: {e}")
+        finally:
+            self._purge_lock.release()
+
+    def purge(self) -> int:
+        """Xóa artifact hết hạn, sau đó xóa artifact dùng lâu nhất cho tới khi dưới quota. Trả về số artifact đã xóa."""
+        cutoff = time.time() - self.ttl_seconds
+        objects = sorted(self.backend.list_objects(), key=lambda item: item[1])
+        total = sum(size for _, _, size in objects)
+
+        removed = 0
+        for key, used_at, size in objects:
+            if used_at >= cutoff and total <= self.max_bytes:
+                break
+            self.backend.delete(key)
+            total -= size
+            removed += 1
+        return removed
+
+
+def _create_backend():
+    if ARTIFACT_STORE_BACKEND == "s3":
+        return S3ArtifactBackend(
+            ARTIFACT_S3_BUCKET, ARTIFACT_S3_PREFIX, ARTIFACT_S3_ENDPOINT_URL, ARTIFACT_S3_REGION,
+            ARTIFACT_PUBLIC_BASE_URL, ARTIFACT_PRESIGN_SECONDS
+        )
+    if ARTIFACT_STORE_BACKEND != "local":
+        raise ArtifactStoreError(f"Unknown ARTIFACT_STORE_BACKEND: {ARTIFACT_STORE_BACKEND}")
+    return LocalArtifactBackend(RUNS_DIR, ARTIFACT_LOCAL_PREFIX, ARTIFACT_PUBLIC_BASE_URL or PUBLIC_BASE_URL)
+
+
+_artifact_store: Optional[ArtifactStore] = None
+_artifact_store_lock = threading.Lock()
+
+
+def get_artifact_store() -> ArtifactStore:
+    """Artifact store dùng chung trong process (tạo lần đầu khi cần, để lỗi cấu hình S3 không chặn app khởi động)."""
+    global _artifact_store
+    if _artifact_store is None:
+        with _artifact_store_lock:
+            if _artifact_store is None:
+                _artifact_store = ArtifactStore(
+                    _create_backend(), ARTIFACT_TTL_SECONDS, ARTIFACT_MAX_MB * 1024 * 1024, ARTIFACT_PURGE_INTERVAL_SECONDS
+                )
+    return _artifact_store
@@ -0,0 +1,215 @@
+import os
+import sys
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, Tuple
+
+from PIL import Image
+from reportlab.lib.pagesizes import A4, landscape
+
+from .swap_cache import PROJECT_ROOT, resolve_project_path
+
+
+# Thư mục chứa background đã scale sẵn (có thể xóa bất cứ lúc nào, sẽ được tạo lại khi cần)
+ASSET_CACHE_DIR = Path(os.getenv("ASSET_CACHE_DIR", str(PROJECT_ROOT / "cache" / "assets")))
+# Độ phân giải của background khi in trên trang A4 landscape (150 DPI ~ 1754x1240 px)
+ASSET_CACHE_DPI = int(os.getenv("ASSET_CACHE_DPI", "150"))
+# JPEG được reportlab nhúng thẳng vào PDF (DCTDecode) không phải decode/encode lại; PNG giữ lossless
+ASSET_CACHE_FORMAT = os.getenv("ASSET_CACHE_FORMAT", "JPEG").upper()
+ASSET_CACHE_QUALITY = int(os.getenv("ASSET_CACHE_QUALITY", "85"))
+
+# Cách đặt background lên trang
+FIT_STRETCH = "stretch"   # Kéo giãn phủ toàn trang (trang nội dung)
+FIT_CONTAIN = "contain"   # Giữ tỉ lệ, căn giữa, không phóng to (cover, interleaf)
+
+PAGE_WIDTH, PAGE_HEIGHT = landscape(A4)
+
+_EXTENSIONS = {"JPEG": "jpg", "PNG": "png"}
+
+
+class PreparedBackground:
+    """Background đã chuẩn bị sẵn: file trong cache + vị trí/kích thước vẽ trên trang (point)."""
+
+    __slots__ = ("path", "x", "y", "width", "height")
+
+    def __init__(self, path: Path, x: float, y: float, width: float, height: float):
+        self.path = path
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    def __repr__(self) -> str:
+        return f"PreparedBackground(path={str(self.path)!r}, size=({self.width:.1f}, {self.height:.1f}))"
+
+
+class BackgroundCache:
+    """
+    Cache trên đĩa cho background đã scale đúng kích thước trang A4 landscape.
+
+    Mỗi background chỉ được decode + resize + encode một lần cho mỗi (nội dung file, DPI, định dạng, cách đặt);
+    các lần render sau nhúng thẳng bytes đã chuẩn bị thay vì mở PNG 1600px và nén lại trong mỗi PDF.
+    Key là SHA-256 của nội dung file nguồn nên sửa file background sẽ tự tạo derivative mới.
+    """
+
+    def __init__(self, cache_dir: Path, dpi: int, image_format: str, quality: int):
+        if image_format not in _EXTENSIONS:
+            raise ValueError(f"Unsupported ASSET_CACHE_FORMAT: {image_format} (expected JPEG or PNG)")
+        self.cache_dir = Path(cache_dir)
+        self.dpi = dpi
+        self.image_format = image_format
+        self.quality = quality
+        self._lock = threading.Lock()
+        # (path, mtime, size, fit, page size) -> PreparedBackground
+        self._prepared: Dict[Tuple[str, int, int, str, float, float], PreparedBackground] = {}
+        # (path, mtime, size) -> (SHA-256 nội dung, kích thước ảnh): chỉ đọc + hash lại khi file nguồn thay đổi
+        self._sources: Dict[Tuple[str, int, int], Tuple[str, Tuple[int, int]]] = {}
+
+    def _layout(self, source_size: Tuple[int, int], fit: str, page_width: float, page_height: float) -> Tuple[float, float, float, float]:
+        """Tính vị trí và kích thước vẽ (point), giống cách các renderer đặt background trước đây."""
+        if fit == FIT_STRETCH:
+            return 0.0, 0.0, page_width, page_height
+
+        # Giống Image.thumbnail((page_width, page_height)): pixel nguồn ~ point, chỉ thu nhỏ
+        src_w, src_h = source_size
+        scale = min(1.0, page_width / src_w, page_height / src_h)
+        draw_w = round(src_w * scale)
+        draw_h = round(src_h * scale)
+        return (page_width - draw_w) / 2, (page_height - draw_h) / 2, float(draw_w), float(draw_h)
+
+    def _target_pixels(self, source_size: Tuple[int, int], draw_w: float, draw_h: float) -> Tuple[int, int]:
+        """Kích thước pixel theo DPI cấu hình, không vượt quá độ phân giải của ảnh nguồn."""
+        src_w, src_h = source_size
+        scale = min(self.dpi / 72.0 * draw_w / src_w, self.dpi / 72.0 * draw_h / src_h, 1.0)
+        return max(1, round(src_w * scale)), max(1, round(src_h * scale))
+
+    def _build_key(self, digest: str, fit: str, pixels: Tuple[int, int]) -> str:
+        hasher = hashlib.sha256()
+        hasher.update(digest.encode("utf-8"))
+        hasher.update(f"{fit}:{pixels[0]}x{pixels[1]}:{self.image_format}:{self.quality}".encode("utf-8"))
+        return hasher.hexdigest()
+
+    def _path_for(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.{_EXTENSIONS[self.image_format]}"
+
+    def _encode(self, source_path: Path, pixels: Tuple[int, int], target: Path) -> None:
+        with Image.open(source_path) as src:
+            img = src.convert("RGBA") if src.mode in ("P", "LA", "RGBA") else src.convert("RGB")
+            if img.size != pixels:
+                img = img.resize(pixels, Image.Resampling.LANCZOS)
+
+        if img.mode == "RGBA":
+            # Trang PDF có nền trắng: trộn alpha lên nền trắng để không cần soft mask
+            flattened = Image.new("RGB", img.size, (255, 255, 255))
+            flattened.paste(img, mask=img.getchannel("A"))
+            img = flattened
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # Ghi file tạm rồi rename để process render khác không đọc phải file ghi dở
+        tmp_path = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        if self.image_format == "JPEG":
+            img.save(tmp_path, format="JPEG", quality=self.quality, optimize=True)
+        else:
+            img.save(tmp_path, format="PNG", optimize=True)
+        os.replace(tmp_path, target)
+
+    def _source_info(self, source_path: Path, signature: Tuple[str, int, int]) -> Tuple[str, Tuple[int, int]]:
+        info = self._sources.get(signature)
+        if info is None:
+            with Image.open(source_path) as src:
+                source_size = src.size
+            info = (hashlib.sha256(source_path.read_bytes()).hexdigest(), source_size)
+            with self._lock:
+                self._sources[signature] = info
+        return info
+
+    def prepare(self, source: str, fit: str = FIT_STRETCH, page_width: float = PAGE_WIDTH, page_height: float = PAGE_HEIGHT) -> PreparedBackground:
+        """
+        Trả về background đã scale sẵn cho trang, tạo file derivative nếu chưa có.
+
+        Args:
+            source: Đường dẫn file background (tuyệt đối hoặc tương đối theo thư mục project)
+            fit: FIT_STRETCH (phủ toàn trang) hoặc FIT_CONTAIN (giữ tỉ lệ, căn giữa)
+            page_width: Chiều rộng trang (point)
+            page_height: Chiều cao trang (point)
+
+        Returns:
+            PreparedBackground với path file đã chuẩn bị và vị trí/kích thước vẽ
+        """
+        source_path = resolve_project_path(source)
+        stat = source_path.stat()
+        signature = (str(source_path), stat.st_mtime_ns, stat.st_size)
+        memo_key = signature + (fit, page_width, page_height)
+        prepared = self._prepared.get(memo_key)
+        if prepared is not None and prepared.path.exists():
+            return prepared
+
+        digest, source_size = self._source_info(source_path, signature)
+        x, y, draw_w, draw_h = self._layout(source_size, fit, page_width, page_height)
+        pixels = self._target_pixels(source_size, draw_w, draw_h)
+
+        target = self._path_for(self._build_key(digest, fit, pixels))
+        if not target.exists():
+            self._encode(source_path, pixels, target)
+            print(f"DEBUG asset_cache: Prepared {source_path.name} -> {target.name} ({pixels[0]}x{pixels[1]}, {target.stat().st_size} bytes)")
+
+        prepared = PreparedBackground(target, x, y, draw_w, draw_h)
+        with self._lock:
+            self._prepared[memo_key] = prepared
+        return prepared
+
+
+# Cache dùng chung trong process (mỗi process render có bản riêng, file trên đĩa dùng chung)
+background_cache = BackgroundCache(ASSET_CACHE_DIR, ASSET_CACHE_DPI, ASSET_CACHE_FORMAT, ASSET_CACHE_QUALITY)
+
+
+def prepare_background(source: str, fit: str = FIT_STRETCH, page_width: float = PAGE_WIDTH, page_height: float = PAGE_HEIGHT) -> PreparedBackground:
+    return background_cache.prepare(source, fit, page_width, page_height)
+
+
+def warm_up() -> int:
+    """
+    Tạo trước derivative và màu chữ (background index) cho toàn bộ background trong catalog
+    (interiors, covers, interleafs).
+
+    Returns:
+        Số background đã chuẩn bị
+    """
+    from .catalog import catalog
+    from .background_index import background_index, PROFILE_CONTENT, PROFILE_COVER, PROFILE_INTERLEAF
+
+    sections = [
+        (catalog.pages(), FIT_STRETCH, PROFILE_CONTENT),
+        (catalog.covers() or {}, FIT_CONTAIN, PROFILE_COVER),
+        (catalog.interleafs() or {}, FIT_CONTAIN, PROFILE_INTERLEAF),
+    ]
+
+    prepared = 0
+    seen = set()
+    for entries, fit, profile in sections:
+        for entry in entries.values():
+            background = entry.get("background")
+            if not background or (background, fit, profile) in seen:
+                continue
+            seen.add((background, fit, profile))
+            try:
+                background_path = str(catalog.resolve(background))
+                prepare_background(background_path, fit)
+                background_index.colors(background_path, profile)
+                prepared += 1
+            except Exception as e:
+                print(f"Warning: Could not prepare background {background}: {e}")
+    return prepared
+
+
+def main():
+    print(f"Preparing backgrounds in {ASSET_CACHE_DIR} ({ASSET_CACHE_DPI} DPI, {ASSET_CACHE_FORMAT})")
+    count = warm_up()
+    print(f"✓ Prepared {count} background(s)")
+    if count == 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
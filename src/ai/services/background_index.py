@@ -0,0 +1,214 @@
+import os
+import json
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from PIL import Image
+
+from .swap_cache import PROJECT_ROOT, resolve_project_path
+from .asset_cache import ASSET_CACHE_DIR
+
+
+# File sidecar lưu độ sáng + màu chữ đã tính cho từng background (dùng chung giữa các worker/process render)
+BACKGROUND_INDEX_PATH = Path(os.getenv("BACKGROUND_INDEX_PATH", str(ASSET_CACHE_DIR / "background_index.json")))
+
+# Profile = vùng đặt chữ của từng loại trang
+PROFILE_CONTENT = "content"      # Text bên phải trang nội dung
+PROFILE_COVER = "cover"          # Title ở giữa cover
+PROFILE_INTERLEAF = "interleaf"  # Text bên phải trang interleaf
+
+RGB = Tuple[float, float, float]
+
+DEFAULT_TEXT_COLOR: RGB = (0, 0, 0)
+DEFAULT_SHADOW_COLOR: RGB = (0.3, 0.3, 0.3)
+
+
+def _analyze_grid_brightness(bg_img: Image.Image) -> float:
+    """
+    Độ sáng trung bình (0-1) vùng text của trang nội dung: lấy mẫu mỗi 10 pixel
+    trong vùng 40% x 80% bên phải, theo công thức luminance 0.299R + 0.587G + 0.114B.
+    Ảnh được chuyển sang RGB trước (background PNG là RGBA).
+    """
+    bg_img = bg_img.convert("RGB")
+    width, height = bg_img.size
+
+    # Define text region (right half of the page where text will be placed)
+    text_region_x = int(width * 0.5)  # Start from middle
+    text_region_y = int(height * 0.1)  # Skip top margin
+    text_region_width = int(width * 0.4)  # Text takes about 40% of width
+    text_region_height = int(height * 0.8)  # Text takes about 80% of height
+
+    text_region = bg_img.crop((
+        text_region_x,
+        text_region_y,
+        min(text_region_x + text_region_width, width),
+        min(text_region_y + text_region_height, height)
+    ))
+
+    # Sample pixels (take every 10th pixel)
+    pixels = []
+    for y in range(0, text_region.height, 10):
+        for x in range(0, text_region.width, 10):
+            pixels.append(text_region.getpixel((x, y)))
+
+    if not pixels:
+        return 0.5  # Default to medium brightness
+
+    total_luminance = sum((0.299 * r + 0.587 * g + 0.114 * b) / 255.0 for r, g, b in pixels)
+    return total_luminance / len(pixels)
+
+
+def _analyze_histogram_brightness(bg_img: Image.Image, text_region_ratio: float) -> float:
+    """Độ sáng trung bình (0-1) của dải `text_region_ratio` bên phải ảnh, tính từ histogram grayscale."""
+    width, height = bg_img.size
+
+    text_region_width = int(width * text_region_ratio)
+    text_region_x = width - text_region_width  # Right side of page
+
+    histogram = bg_img.crop((text_region_x, 0, width, height)).convert("L").histogram()
+
+    total_pixels = sum(histogram)
+    if total_pixels == 0:
+        return 0.5  # Default to middle brightness
+
+    brightness_sum = sum(i * count for i, count in enumerate(histogram))
+    return brightness_sum / (total_pixels * 255.0)  # Normalize to 0-1
+
+
+def get_optimal_text_colors(brightness: float) -> Tuple[RGB, RGB]:
+    """
+    Return optimal text and shadow colors based on background brightness.
+    Returns (text_color_rgb, shadow_color_rgb) where each is (r, g, b) tuple with values 0-1.
+    """
+    if brightness > 0.5:
+        # Bright background -> Dark text
+        return (0, 0, 0), (0.3, 0.3, 0.3)
+    # Dark background -> Light text
+    return (1, 1, 1), (0.7, 0.7, 0.7)
+
+
+_ANALYZERS: Dict[str, Callable[[Image.Image], float]] = {
+    PROFILE_CONTENT: _analyze_grid_brightness,
+    PROFILE_COVER: lambda img: _analyze_histogram_brightness(img, 0.5),
+    PROFILE_INTERLEAF: lambda img: _analyze_histogram_brightness(img, 0.3),
+}
+
+
+class TextColors:
+    """Kết quả phân tích một background cho một profile."""
+
+    __slots__ = ("brightness", "text_color", "shadow_color")
+
+    def __init__(self, brightness: float, text_color: RGB, shadow_color: RGB):
+        self.brightness = brightness
+        self.text_color = text_color
+        self.shadow_color = shadow_color
+
+    def __repr__(self) -> str:
+        return f"TextColors(brightness={self.brightness:.2f}, text={self.text_color}, shadow={self.shadow_color})"
+
+
+class BackgroundIndex:
+    """
+    Index độ sáng và màu chữ/bóng chữ của các background tĩnh.
+
+    Mỗi (background, profile) chỉ được phân tích một lần; kết quả nằm trong bộ nhớ và được lưu
+    vào file sidecar JSON để các process render và lần khởi động sau dùng lại.
+    Entry bị bỏ qua (tính lại) khi mtime/size của file background thay đổi.
+    """
+
+    def __init__(self, index_path: Path):
+        self.index_path = Path(index_path)
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _entry_key(self, path: Path) -> str:
+        try:
+            return str(path.relative_to(PROJECT_ROOT))
+        except ValueError:
+            return str(path)
+
+    def _read_sidecar(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with self.index_path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"Warning: Ignoring unreadable background index {self.index_path}: {e}")
+            return {}
+        entries = data.get("backgrounds") if isinstance(data, dict) else None
+        return entries if isinstance(entries, dict) else {}
+
+    def _entries_loaded(self) -> Dict[str, Dict[str, Any]]:
+        if self._entries is None:
+            with self._lock:
+                if self._entries is None:
+                    self._entries = self._read_sidecar()
+        return self._entries
+
+    def _persist(self, key: str, entry: Dict[str, Any]) -> None:
+        """Ghi entry mới vào sidecar (gộp với nội dung hiện tại trên đĩa do process khác ghi)."""
+        with self._lock:
+            entries = self._read_sidecar()
+            entries[key] = entry
+            try:
+                self.index_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.index_path.with_name(f".{self.index_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                with tmp_path.open("w", encoding="utf-8") as f:
+                    json.dump({"backgrounds": entries}, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.index_path)
+            except OSError as e:
+                print(f"Warning: Could not write background index {self.index_path}: {e}")
+            # Lấy luôn các entry process khác đã ghi
+            self._entries = entries
+
+    def colors(self, background_path: str, profile: str) -> TextColors:
+        """
+        Trả về độ sáng + màu chữ/bóng chữ của background cho profile, phân tích nếu chưa có trong index.
+
+        Args:
+            background_path: Đường dẫn file background
+            profile: PROFILE_CONTENT, PROFILE_COVER hoặc PROFILE_INTERLEAF
+
+        Returns:
+            TextColors
+        """
+        path = resolve_project_path(background_path)
+        stat = path.stat()
+        signature = [stat.st_mtime_ns, stat.st_size]
+        key = self._entry_key(path)
+
+        entry = self._entries_loaded().get(key)
+        if entry and entry.get("signature") == signature and profile in entry.get("profiles", {}):
+            result = entry["profiles"][profile]
+            return TextColors(result["brightness"], tuple(result["text_color"]), tuple(result["shadow_color"]))
+
+        with Image.open(path) as bg_img:
+            brightness = _ANALYZERS[profile](bg_img)
+        text_color, shadow_color = get_optimal_text_colors(brightness)
+        print(f"DEBUG background_index: Analyzed {path.name} [{profile}]: brightness={brightness:.2f}")
+
+        profiles = dict(entry.get("profiles", {})) if entry and entry.get("signature") == signature else {}
+        profiles[profile] = {
+            "brightness": round(brightness, 4),
+            "text_color": list(text_color),
+            "shadow_color": list(shadow_color),
+        }
+        self._persist(key, {"signature": signature, "profiles": profiles})
+        return TextColors(brightness, text_color, shadow_color)
+
+
+# Index dùng chung trong process
+background_index = BackgroundIndex(BACKGROUND_INDEX_PATH)
+
+
+def get_text_colors(background_path: Optional[str], profile: str) -> TextColors:
+    """Màu chữ cho background; màu mặc định (chữ đen) nếu không có background hoặc không phân tích được."""
+    if background_path:
+        try:
+            return background_index.colors(background_path, profile)
+        except Exception as e:
+            print(f"⚠ Could not analyze background for color detection: {e}")
+    return TextColors(0.5, DEFAULT_TEXT_COLOR, DEFAULT_SHADOW_COLOR)
@@ -0,0 +1,687 @@
+import os
+import json
+import time
+import uuid
+import copy
+import fcntl
+import socket
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+from contextlib import asynccontextmanager
+from typing import Any, Coroutine, Dict, List, Optional, Set, Tuple
+
+from .create_book import create_book
+from .prediction_scheduler import (
+    prediction_scheduler, prediction_priority, prediction_group, PRIORITY_PAID, PRIORITY_SPECULATIVE, PRIORITY_NAMES
+)
+from .artifact_store import get_artifact_store
+from .swap_cache import get_swap_cache, read_source_bytes_async
+from .single_flight import make_flight_key
+from .tracing import trace_span, current_trace_id
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[3]
+
+# Trạng thái job được lưu thành file JSON để mọi uvicorn worker đều đọc được khi client poll
+BOOK_JOBS_DIR = Path(os.getenv("BOOK_JOBS_DIR", str(PROJECT_ROOT / "runs" / "jobs")))
+
+# Job queued/running của worker ở host khác không gửi heartbeat quá thời gian này coi như worker đã chết
+# (worker cùng host được kiểm tra trực tiếp theo pid)
+BOOK_JOB_STALE_SECONDS = int(os.getenv("BOOK_JOB_STALE_SECONDS", "1800"))
+# Chu kỳ worker ghi heartbeat cho các job nó đang chạy (kể cả job đang chờ slot trong scheduler)
+BOOK_JOB_HEARTBEAT_SECONDS = float(os.getenv("BOOK_JOB_HEARTBEAT_SECONDS", "60"))
+# File trạng thái của job cũ hơn thời gian này sẽ bị xóa
+BOOK_JOB_TTL_SECONDS = int(os.getenv("BOOK_JOB_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Khoảng thời gian giữa hai lần đọc trạng thái job khi chờ job hoàn tất (/create-book/)
+BOOK_JOB_POLL_SECONDS = float(os.getenv("BOOK_JOB_POLL_SECONDS", "1.0"))
+# Thời gian tối đa chờ khóa fingerprint (worker khác đang tạo job cho cùng request)
+FINGERPRINT_LOCK_TIMEOUT_SECONDS = 10
+FINGERPRINT_LOCK_POLL_SECONDS = 0.05
+
+# Render trước (priority thấp nhất) sách của item vừa được thêm vào giỏ hàng
+SPECULATIVE_RENDER_ENABLED = os.getenv("SPECULATIVE_RENDER_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Index phụ trong BOOK_JOBS_DIR: fingerprint request -> job, Idempotency-Key -> job,
+# cart item -> job speculative, job speculative -> trạng thái (speculative / promoted / cancelled) + cart items
+INDEX_FINGERPRINTS = "fingerprints"
+INDEX_IDEMPOTENCY = "idempotency"
+INDEX_CARTS = "carts"
+INDEX_SPECULATIVE = "speculative"
+
+SPECULATIVE_STATE_PENDING = "speculative"
+SPECULATIVE_STATE_PROMOTED = "promoted"
+SPECULATIVE_STATE_CANCELLED = "cancelled"
+
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_COMPLETED = "completed"
+JOB_STATUS_FAILED = "failed"
+
+_HOSTNAME = socket.gethostname()
+
+
+async def save_book_pdf(pdf_bytes: bytes) -> Dict[str, Any]:
+    """
+    Lưu file PDF sách vào artifact store (dedupe theo nội dung) và trả về thông tin + URL download.
+
+    Returns:
+        Dict gồm key, sha256, size, download_url, deduplicated
+    """
+    with trace_span("artifact.save", bytes=len(pdf_bytes)):
+        stored = await get_artifact_store().put(pdf_bytes, ".pdf")
+    if stored["deduplicated"]:
+        print(f"DEBUG book_jobs: Book PDF already stored as {stored['key']}")
+    stored["download_url"] = stored.pop("url")
+    return stored
+
+
+class IdempotencyConflict(Exception):
+    """Idempotency-Key đã được dùng cho một request khác."""
+
+
+async def book_fingerprint(request_data: Dict[str, Any]) -> str:
+    """
+    Fingerprint của request tạo sách: category, book, danh sách story, tên nhân vật và hash nội dung ảnh face.
+    Hai request cho ra cùng một cuốn sách có cùng fingerprint dù URL ảnh khác nhau.
+    """
+    image_url = request_data["image_url"]
+    try:
+        cache = get_swap_cache()
+        if cache is not None:
+            # Dùng lại digest đã nhớ của swap cache (ảnh face cũng là một phần của key swap)
+            loop = asyncio.get_event_loop()
+            face_digest = await loop.run_in_executor(None, cache.source_digest, image_url)
+        else:
+            face_digest = hashlib.sha256(await read_source_bytes_async(image_url)).hexdigest()
+    except Exception as e:
+        print(f"Warning: Could not hash face image for fingerprint, using URL instead: {e}")
+        face_digest = f"url:{image_url}"
+
+    return make_flight_key(
+        "book",
+        request_data["category_id"],
+        request_data["book_id"],
+        [story["story_id"] for story in request_data["stories"]],
+        request_data["name"],
+        face_digest
+    )
+
+
+def book_stage_names(stories: List[dict]) -> List[str]:
+    """Danh sách stage theo thứ tự xử lý: cover, từng story, interleafs, render."""
+    stages = ["cover"]
+    stages.extend(f"story_{story['story_id']}" for story in stories)
+    if len(stories) // 2 > 0:
+        stages.append("interleafs")
+    stages.append("render")
+    return stages
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class BookJobStore:
+    """
+    Lưu trạng thái job tạo sách dưới dạng file JSON (ghi atomic).
+
+    Job do worker này chạy được giữ trong memory (bản mới nhất); các lần cập nhật tiến độ chỉ sửa bản
+    trong memory và được gộp lại, ghi ra file trên thread pool, không ghi đồng bộ trên event loop.
+    """
+
+    def __init__(self, jobs_dir: Path):
+        self.jobs_dir = Path(jobs_dir)
+        self._lock = threading.Lock()
+        # Job của worker này: job_id -> bản ghi mới nhất (file có thể đang chờ ghi)
+        self._owned: Dict[str, Dict[str, Any]] = {}
+        self._dirty: Set[str] = set()
+        self._flushers: Dict[str, asyncio.Task] = {}
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    def _path_for(self, job_id: str) -> Path:
+        return self.jobs_dir / f"{job_id}.json"
+
+    def _write(self, job: Dict[str, Any]) -> None:
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path_for(job["job_id"])
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _snapshot(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._owned.get(job_id)
+            return copy.deepcopy(job) if job is not None else None
+
+    async def _flush_loop(self, job_id: str) -> None:
+        # Một writer cho mỗi job: các cập nhật đến trong lúc đang ghi được gộp vào lần ghi tiếp theo
+        loop = asyncio.get_event_loop()
+        try:
+            while job_id in self._dirty:
+                self._dirty.discard(job_id)
+                job = self._snapshot(job_id)
+                if job is None:
+                    return
+                try:
+                    await loop.run_in_executor(None, self._write, job)
+                except OSError as e:
+                    print(f"Warning: Could not write book job {job_id}: {e}")
+        finally:
+            self._flushers.pop(job_id, None)
+
+    def _schedule_write(self, job_id: str) -> None:
+        self._dirty.add(job_id)
+        if job_id in self._flushers:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write_now(job_id)
+            return
+        self._flushers[job_id] = loop.create_task(self._flush_loop(job_id))
+
+    async def flush(self, job_id: str) -> None:
+        """Chờ tới khi mọi cập nhật của job đã được ghi ra file."""
+        while job_id in self._flushers or job_id in self._dirty:
+            flusher = self._flushers.get(job_id)
+            if flusher is None:
+                self._schedule_write(job_id)
+                flusher = self._flushers.get(job_id)
+            if flusher is not None:
+                await asyncio.shield(flusher)
+
+    def write_now(self, job_id: str) -> None:
+        """Ghi đồng bộ bản mới nhất của job (dùng khi không còn chờ được event loop, vd: job bị cancel)."""
+        self._dirty.discard(job_id)
+        job = self._snapshot(job_id)
+        if job is not None:
+            self._write(job)
+
+    def release(self, job_id: str) -> None:
+        """Job đã kết thúc và đã được ghi ra file: bỏ khỏi memory của worker này."""
+        with self._lock:
+            self._owned.pop(job_id, None)
+        self._dirty.discard(job_id)
+
+    async def _heartbeat_loop(self) -> None:
+        while self._owned:
+            await asyncio.sleep(BOOK_JOB_HEARTBEAT_SECONDS)
+            now = time.time()
+            with self._lock:
+                job_ids = list(self._owned)
+                for job in self._owned.values():
+                    job["heartbeat_at"] = now
+            for job_id in job_ids:
+                self._schedule_write(job_id)
+        self._heartbeat_task = None
+
+    async def create(self, request_data: Dict[str, Any], fingerprint: Optional[str] = None) -> Dict[str, Any]:
+        now = time.time()
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "status": JOB_STATUS_QUEUED,
+            "created_at": now,
+            "updated_at": now,
+            "heartbeat_at": now,
+            # Worker chạy job: job chỉ bị coi là chết khi worker này không còn (không dựa vào thời gian chờ)
+            "owner": {"host": _HOSTNAME, "pid": os.getpid()},
+            "request": request_data,
+            "fingerprint": fingerprint,
+            "artifact_key": None,
+            "trace_id": current_trace_id(),
+            "stages": {stage: "pending" for stage in book_stage_names(request_data["stories"])},
+            "progress": 0.0,
+            "download_url": None,
+            "file_size": None,
+            "page_count": None,
+            "error": None,
+        }
+        with self._lock:
+            self._owned[job["job_id"]] = job
+        self._schedule_write(job["job_id"])
+        await self.flush(job["job_id"])
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.get_event_loop().create_task(self._heartbeat_loop())
+        return copy.deepcopy(job)
+
+    def _is_stale(self, job: Dict[str, Any]) -> bool:
+        """Job queued/running mà worker chạy nó không còn (process chết, hoặc không gửi heartbeat)."""
+        owner = job.get("owner") or {}
+        if owner.get("host") == _HOSTNAME and owner.get("pid"):
+            if owner["pid"] == os.getpid():
+                return job["job_id"] not in self._owned
+            return not _pid_alive(owner["pid"])
+        # Worker ở host khác: dựa vào heartbeat (được ghi định kỳ kể cả khi job đang chờ trong scheduler)
+        return time.time() - job.get("heartbeat_at", job["updated_at"]) > BOOK_JOB_STALE_SECONDS
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        # job_id chỉ gồm hex, không cho phép path traversal
+        if not job_id or not all(ch in "0123456789abcdef" for ch in job_id):
+            return None
+        job = self._snapshot(job_id)
+        if job is not None:
+            return job
+        try:
+            with open(self._path_for(job_id), "r", encoding="utf-8") as f:
+                job = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if job["status"] in (JOB_STATUS_QUEUED, JOB_STATUS_RUNNING) and self._is_stale(job):
+            job["status"] = JOB_STATUS_FAILED
+            job["error"] = "Job stopped reporting progress (worker restarted?)"
+        return job
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        with self._lock:
+            job = self._owned.get(job_id)
+            if job is None:
+                return
+            job.update(fields)
+            job["updated_at"] = time.time()
+        self._schedule_write(job_id)
+
+    def update_stage(self, job_id: str, stage: str, state: str) -> None:
+        with self._lock:
+            job = self._owned.get(job_id)
+            if job is None:
+                return
+            job["stages"][stage] = state
+            finished = sum(1 for value in job["stages"].values() if value in ("completed", "failed"))
+            job["progress"] = round(finished / len(job["stages"]), 3)
+            job["updated_at"] = time.time()
+        self._schedule_write(job_id)
+
+    def _index_path(self, index: str, key: str) -> Path:
+        return self.jobs_dir / index / f"{key}.json"
+
+    def read_index(self, index: str, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._index_path(index, key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_index(self, index: str, key: str, record: Dict[str, Any]) -> None:
+        path = self._index_path(index, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    async def write_index(self, index: str, key: str, record: Dict[str, Any]) -> None:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write_index, index, key, copy.deepcopy(record))
+
+    @asynccontextmanager
+    async def fingerprint_lock(self, fingerprint: str):
+        """
+        Khóa theo fingerprint dùng chung giữa các worker (flock), để hai request giống nhau đến cùng lúc
+        không cùng tạo job. Nếu chờ quá FINGERPRINT_LOCK_TIMEOUT_SECONDS thì tiếp tục mà không giữ khóa.
+        """
+        lock_path = self.jobs_dir / INDEX_FINGERPRINTS / f"{fingerprint}.lock"
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+        locked = False
+        try:
+            deadline = time.monotonic() + FINGERPRINT_LOCK_TIMEOUT_SECONDS
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        print(f"DEBUG book_jobs: Timed out waiting for fingerprint lock {fingerprint[:12]}")
+                        break
+                    await asyncio.sleep(FINGERPRINT_LOCK_POLL_SECONDS)
+            yield
+        finally:
+            if locked:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def purge_expired(self) -> int:
+        """Xóa file trạng thái của các job (và các index phụ) quá BOOK_JOB_TTL_SECONDS."""
+        removed = 0
+        cutoff = time.time() - BOOK_JOB_TTL_SECONDS
+        paths = list(self.jobs_dir.glob("*.json"))
+        for index in (INDEX_FINGERPRINTS, INDEX_IDEMPOTENCY, INDEX_CARTS, INDEX_SPECULATIVE):
+            paths.extend((self.jobs_dir / index).glob("*.json"))
+        for path in paths:
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+
+book_job_store = BookJobStore(BOOK_JOBS_DIR)
+
+# Giữ reference tới các task đang chạy để không bị garbage collect
+_running_jobs: Set[asyncio.Task] = set()
+# Task render của các job đang chạy trong worker này và lý do khi job bị cancel có chủ đích
+_job_tasks: Dict[str, asyncio.Task] = {}
+_cancel_reasons: Dict[str, str] = {}
+
+CANCEL_SPECULATIVE = "Speculative render cancelled: no cart item needs this book anymore"
+CANCEL_SHUTDOWN = "Worker shut down before the book was finished; request the book again to restart it"
+
+
+def _spawn(coro: Coroutine[Any, Any, Any]) -> Optional[asyncio.Task]:
+    """Chạy coroutine trong nền trên event loop hiện tại (None nếu không có loop đang chạy)."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        print("Warning: No running event loop, skipping background book job work")
+        coro.close()
+        return None
+    task = loop.create_task(coro)
+    _running_jobs.add(task)
+    task.add_done_callback(_running_jobs.discard)
+    return task
+
+
+async def _watch_speculative_job(job_id: str, job_task: asyncio.Task) -> None:
+    """
+    Theo dõi file trạng thái của job speculative (có thể được ghi bởi worker khác):
+    promoted -> nâng các prediction của job lên PRIORITY_PAID, cancelled -> hủy job.
+    """
+    while not job_task.done():
+        await asyncio.sleep(BOOK_JOB_POLL_SECONDS)
+        control = book_job_store.read_index(INDEX_SPECULATIVE, job_id) or {}
+        state = control.get("state")
+        if state == SPECULATIVE_STATE_PROMOTED:
+            promoted = prediction_scheduler.promote(job_id, PRIORITY_PAID)
+            print(f"DEBUG book_jobs: Speculative job {job_id} promoted to paid ({promoted} queued prediction(s))")
+            return
+        if state == SPECULATIVE_STATE_CANCELLED:
+            _cancel_reasons[job_id] = CANCEL_SPECULATIVE
+            job_task.cancel()
+            cancelled = prediction_scheduler.cancel_group(job_id)
+            print(f"DEBUG book_jobs: Speculative job {job_id} cancelled ({cancelled} queued prediction(s) dropped)")
+            return
+
+
+async def _run_book_job(job_id: str, request_data: Dict[str, Any], priority: int = PRIORITY_PAID) -> None:
+    start_time = time.time()
+    book_job_store.update(job_id, status=JOB_STATUS_RUNNING)
+
+    def on_progress(stage: str, state: str) -> None:
+        book_job_store.update_stage(job_id, stage, state)
+
+    if priority == PRIORITY_SPECULATIVE:
+        _spawn(_watch_speculative_job(job_id, asyncio.current_task()))
+
+    try:
+        # Nhóm theo job_id: job speculative có thể được nâng priority hoặc hủy khi đang chạy.
+        # Span của job nằm trong trace của request tạo job (context được copy khi tạo task)
+        with trace_span("book_job", job_id=job_id, priority=PRIORITY_NAMES.get(priority, priority)):
+            with prediction_priority(priority), prediction_group(job_id):
+                pdf_bytes = await create_book(
+                    category_id=request_data["category_id"],
+                    book_id=request_data["book_id"],
+                    stories=request_data["stories"],
+                    name=request_data["name"],
+                    image_url=request_data["image_url"],
+                    progress_callback=on_progress
+                )
+
+            saved = await save_book_pdf(pdf_bytes)
+
+        stories_count = len(request_data["stories"])
+        interleaf_count = stories_count // 2
+        book_job_store.update(
+            job_id,
+            status=JOB_STATUS_COMPLETED,
+            progress=1.0,
+            download_url=saved["download_url"],
+            artifact_key=saved["key"],
+            file_size=len(pdf_bytes),
+            page_count=1 + stories_count * 2 + interleaf_count * 2,
+            processing_time=time.time() - start_time
+        )
+        await book_job_store.flush(job_id)
+        print(f"✓ Book job {job_id} completed in {time.time() - start_time:.2f} seconds")
+
+    except asyncio.CancelledError:
+        reason = _cancel_reasons.pop(job_id, None)
+        error = reason or f"Book job cancelled ({PRIORITY_NAMES.get(priority, priority)} priority)"
+        print(f"✗ Book job {job_id} cancelled: {error}")
+        # Job failed không được join lại: request sau tạo job mới (face swap đã xong lấy từ swap cache)
+        book_job_store.update(
+            job_id,
+            status=JOB_STATUS_FAILED,
+            error=error,
+            processing_time=time.time() - start_time
+        )
+        # Task đã bị cancel: ghi đồng bộ thay vì chờ thread pool
+        book_job_store.write_now(job_id)
+        if reason != CANCEL_SPECULATIVE:
+            raise
+
+    except Exception as e:
+        print(f"✗ Book job {job_id} failed: {e}")
+        book_job_store.update(
+            job_id,
+            status=JOB_STATUS_FAILED,
+            error=str(e),
+            processing_time=time.time() - start_time
+        )
+        await book_job_store.flush(job_id)
+
+    finally:
+        prediction_scheduler.release_group(job_id)
+        book_job_store.release(job_id)
+
+
+async def start_book_job(request_data: Dict[str, Any], fingerprint: Optional[str] = None, priority: int = PRIORITY_PAID) -> Dict[str, Any]:
+    """
+    Tạo job và bắt đầu render sách trong nền, độc lập với kết nối HTTP của client.
+
+    Args:
+        request_data: Dict gồm category_id, book_id, stories, name, image_url
+        fingerprint: (Tùy chọn) Fingerprint của request, lưu vào job để request trùng có thể join
+        priority: Priority của các prediction trong job (PRIORITY_SPECULATIVE cho render trước từ giỏ hàng)
+
+    Returns:
+        Bản ghi job vừa tạo (status = queued)
+    """
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, book_job_store.purge_expired)
+    job = await book_job_store.create(request_data, fingerprint)
+
+    job_id = job["job_id"]
+    task = loop.create_task(_run_book_job(job_id, request_data, priority))
+    _running_jobs.add(task)
+    _job_tasks[job_id] = task
+    task.add_done_callback(_running_jobs.discard)
+    task.add_done_callback(lambda _: _job_tasks.pop(job_id, None))
+
+    print(f"Started book job {job['job_id']} for category {request_data['category_id']}, book {request_data['book_id']}")
+    return job
+
+
+async def _reusable_job(job: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Job có thể dùng lại cho request trùng: đang chạy, hoặc đã xong và file PDF vẫn còn trong artifact store."""
+    if job is None:
+        return None
+    if job["status"] in (JOB_STATUS_QUEUED, JOB_STATUS_RUNNING):
+        control = book_job_store.read_index(INDEX_SPECULATIVE, job["job_id"])
+        if control and control["state"] == SPECULATIVE_STATE_CANCELLED:
+            return None
+        return job
+    if job["status"] == JOB_STATUS_COMPLETED and job.get("artifact_key"):
+        download_url = await get_artifact_store().get_url(job["artifact_key"])
+        if download_url:
+            # URL có thể đổi (vd: presigned URL của S3 hết hạn)
+            job["download_url"] = download_url
+            return job
+    return None
+
+
+async def start_or_join_book_job(request_data: Dict[str, Any], idempotency_key: Optional[str] = None) -> Tuple[Dict[str, Any], bool]:
+    """
+    Bắt đầu job render sách, hoặc trả về job đã có cho cùng một request (double-click, client retry).
+
+    Request được nhận diện theo fingerprint (category, book, stories, name, hash ảnh face) và theo
+    Idempotency-Key nếu client gửi. Job đang chạy được join; job đã xong được trả lại từ artifact store.
+
+    Args:
+        request_data: Dict gồm category_id, book_id, stories, name, image_url
+        idempotency_key: (Tùy chọn) Giá trị header Idempotency-Key
+
+    Returns:
+        (job, joined) - joined = True nếu không phải tạo job mới
+
+    Raises:
+        IdempotencyConflict: Idempotency-Key đã dùng cho request có nội dung khác
+    """
+    fingerprint = await book_fingerprint(request_data)
+    key_hash = hashlib.sha256(idempotency_key.encode("utf-8")).hexdigest() if idempotency_key else None
+
+    async with book_job_store.fingerprint_lock(fingerprint):
+        if key_hash:
+            record = book_job_store.read_index(INDEX_IDEMPOTENCY, key_hash)
+            if record and record["fingerprint"] != fingerprint:
+                raise IdempotencyConflict("Idempotency-Key was already used with a different request")
+
+        record = book_job_store.read_index(INDEX_FINGERPRINTS, fingerprint)
+        job = await _reusable_job(book_job_store.get(record["job_id"]) if record else None)
+        joined = job is not None
+
+        if joined:
+            print(f"DEBUG book_jobs: Request {fingerprint[:12]} joined job {job['job_id']} ({job['status']})")
+            # Job speculative (render trước từ giỏ hàng) giờ có người chờ: chạy với priority của đơn hàng
+            await _set_speculative_state(job["job_id"], SPECULATIVE_STATE_PROMOTED)
+        else:
+            job = await start_book_job(request_data, fingerprint)
+            await book_job_store.write_index(INDEX_FINGERPRINTS, fingerprint, {"job_id": job["job_id"], "created_at": time.time()})
+
+        if key_hash:
+            await book_job_store.write_index(INDEX_IDEMPOTENCY, key_hash, {
+                "fingerprint": fingerprint, "job_id": job["job_id"], "created_at": time.time()
+            })
+
+    return job, joined
+
+
+async def wait_for_book_job(job_id: str) -> Dict[str, Any]:
+    """Chờ job (có thể đang chạy ở worker khác) kết thúc; trả về bản ghi job completed/failed."""
+    while True:
+        job = book_job_store.get(job_id)
+        if job is None:
+            raise RuntimeError(f"Book job {job_id} disappeared")
+        if job["status"] in (JOB_STATUS_COMPLETED, JOB_STATUS_FAILED):
+            return job
+        await asyncio.sleep(BOOK_JOB_POLL_SECONDS)
+
+
+async def _set_speculative_state(job_id: str, state: str) -> bool:
+    """Đổi trạng thái của job speculative (chỉ khi job còn đang là speculative). Gọi khi giữ khóa fingerprint."""
+    control = book_job_store.read_index(INDEX_SPECULATIVE, job_id)
+    if not control or control["state"] != SPECULATIVE_STATE_PENDING:
+        return False
+    control["state"] = state
+    await book_job_store.write_index(INDEX_SPECULATIVE, job_id, control)
+    return True
+
+
+async def _start_speculative_render(cart_id: int, request_data: Dict[str, Any]) -> None:
+    fingerprint = await book_fingerprint(request_data)
+
+    async with book_job_store.fingerprint_lock(fingerprint):
+        record = book_job_store.read_index(INDEX_FINGERPRINTS, fingerprint)
+        job = await _reusable_job(book_job_store.get(record["job_id"]) if record else None)
+
+        if job is None:
+            job = await start_book_job(request_data, fingerprint, priority=PRIORITY_SPECULATIVE)
+            await book_job_store.write_index(INDEX_FINGERPRINTS, fingerprint, {"job_id": job["job_id"], "created_at": time.time()})
+            await book_job_store.write_index(INDEX_SPECULATIVE, job["job_id"], {
+                "state": SPECULATIVE_STATE_PENDING, "cart_ids": [cart_id]
+            })
+            print(f"DEBUG book_jobs: Speculative render {job['job_id']} started for cart item {cart_id}")
+        else:
+            # Sách đã có hoặc đang render (vd: item khác trong giỏ hàng có cùng nội dung)
+            control = book_job_store.read_index(INDEX_SPECULATIVE, job["job_id"])
+            if control and cart_id not in control["cart_ids"]:
+                control["cart_ids"].append(cart_id)
+                await book_job_store.write_index(INDEX_SPECULATIVE, job["job_id"], control)
+
+        await book_job_store.write_index(INDEX_CARTS, str(cart_id), {"job_id": job["job_id"], "created_at": time.time()})
+
+
+async def _update_cart_render(cart_id: int, promote: bool) -> None:
+    record = book_job_store.read_index(INDEX_CARTS, str(cart_id))
+    job = book_job_store.get(record["job_id"]) if record else None
+    if job is None or not job.get("fingerprint"):
+        return
+
+    async with book_job_store.fingerprint_lock(job["fingerprint"]):
+        control = book_job_store.read_index(INDEX_SPECULATIVE, job["job_id"])
+        if not control or control["state"] != SPECULATIVE_STATE_PENDING:
+            return
+        if promote:
+            await _set_speculative_state(job["job_id"], SPECULATIVE_STATE_PROMOTED)
+            return
+
+        # Chỉ hủy khi không còn cart item nào khác chờ cuốn sách này
+        if cart_id in control["cart_ids"]:
+            control["cart_ids"].remove(cart_id)
+        if not control["cart_ids"]:
+            control["state"] = SPECULATIVE_STATE_CANCELLED
+        await book_job_store.write_index(INDEX_SPECULATIVE, job["job_id"], control)
+
+
+def schedule_speculative_render(cart_id: int, request_data: Dict[str, Any]) -> bool:
+    """
+    Render trước cuốn sách của một cart item ở PRIORITY_SPECULATIVE (sau mọi request paid/preview).
+
+    Face swap kết quả nằm trong swap cache và PDF nằm trong artifact store, nên khi đơn hàng được
+    thanh toán, /create-book/ với cùng nội dung join job đang chạy hoặc nhận ngay sách đã render.
+
+    Args:
+        cart_id: ID cart item
+        request_data: Dict gồm category_id, book_id, stories, name, image_url
+
+    Returns:
+        True nếu đã lên lịch render
+    """
+    return _spawn(_start_speculative_render(cart_id, request_data)) is not None
+
+
+def cancel_speculative_render(cart_id: int) -> None:
+    """Hủy render trước của cart item (nếu job vẫn còn là speculative và không cart item nào khác cần)."""
+    _spawn(_update_cart_render(cart_id, promote=False))
+
+
+def promote_speculative_render(cart_id: int) -> None:
+    """Nâng render trước của cart item lên PRIORITY_PAID (đơn hàng đã thanh toán)."""
+    _spawn(_update_cart_render(cart_id, promote=True))
+
+
+async def shutdown_book_jobs() -> None:
+    """
+    Gọi khi app shutdown: cancel các job render còn chạy trong worker này và ghi lại lý do thật
+    (worker tắt, không phải render speculative bị hủy) để client poll thấy ngay và gửi lại request.
+    """
+    tasks = list(_job_tasks.items())
+    for job_id, task in tasks:
+        _cancel_reasons[job_id] = CANCEL_SHUTDOWN
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*(task for _, task in tasks), return_exceptions=True)
+        print(f"DEBUG book_jobs: Cancelled {len(tasks)} running book job(s) at shutdown")
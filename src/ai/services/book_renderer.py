@@ -0,0 +1,84 @@
+import io
+from typing import Any, Callable, Dict, List, Optional
+
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.pdfgen import canvas
+
+from .create_cover import draw_cover_page
+from .create_content import draw_content_page, _register_unicode_font
+from .create_interleafs import draw_interleaf_page
+
+
+# Hàm vẽ tương ứng với từng loại trang trong page plan
+PAGE_RENDERERS: Dict[str, Callable[[canvas.Canvas, Dict[str, Any], str, float, float], None]] = {
+    "cover": draw_cover_page,
+    "content": draw_content_page,
+    "interleaf": draw_interleaf_page,
+}
+
+# Mỗi nhóm 2 story (4 trang content) được theo sau bởi 1 interleaf (2 trang)
+CONTENT_PAGES_PER_GROUP = 4
+INTERLEAF_PAGES_PER_GROUP = 2
+
+
+def build_book_plan(
+    cover_page: Dict[str, Any],
+    content_pages: List[Dict[str, Any]],
+    interleaf_pages: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Sắp xếp các page spec theo thứ tự cuối cùng của cuốn sách:
+    cover + (content 4 trang + interleaf 2 trang) * n
+
+    Args:
+        cover_page: Page spec của cover
+        content_pages: Page spec của các trang nội dung (theo thứ tự story)
+        interleaf_pages: Page spec của các trang interleaf (2 trang mỗi interleaf)
+
+    Returns:
+        Danh sách page spec theo đúng thứ tự render
+    """
+    plan = [cover_page]
+
+    interleaf_index = 0
+    for i in range(0, len(content_pages), CONTENT_PAGES_PER_GROUP):
+        plan.extend(content_pages[i:i + CONTENT_PAGES_PER_GROUP])
+
+        # Thêm interleaf sau mỗi 2 story (nếu còn)
+        if interleaf_index < len(interleaf_pages):
+            plan.extend(interleaf_pages[interleaf_index:interleaf_index + INTERLEAF_PAGES_PER_GROUP])
+            interleaf_index += INTERLEAF_PAGES_PER_GROUP
+
+    return plan
+
+
+def render_book(plan: List[Dict[str, Any]], font_path: Optional[str] = None) -> bytes:
+    """
+    Vẽ toàn bộ page plan lên một canvas reportlab duy nhất (không tách/ghép PDF bằng pypdf).
+
+    Args:
+        plan: Danh sách page spec từ build_book_plan
+        font_path: (Tùy chọn) Đường dẫn tới font TTF hiện đại
+
+    Returns:
+        Dữ liệu PDF của cuốn sách dưới dạng bytes
+    """
+    font_name = _register_unicode_font(font_path)
+
+    # Thiết lập trang nằm ngang A4
+    page_width, page_height = landscape(A4)
+
+    buffer = io.BytesIO()
+    # invariant=1: cùng input cho ra cùng bytes PDF (không nhúng thời gian tạo), để artifact store dedupe được
+    c = canvas.Canvas(buffer, pagesize=(page_width, page_height), invariant=1)
+
+    for page in plan:
+        renderer = PAGE_RENDERERS.get(page["type"])
+        if renderer is None:
+            raise ValueError(f"Unknown page type: {page['type']}")
+        renderer(c, page, font_name, page_width, page_height)
+        c.showPage()
+
+    c.save()
+    buffer.seek(0)
+    return buffer.getvalue()
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import yaml
+
+from .swap_cache import PROJECT_ROOT
+
+
+# Thư mục gốc chứa assets (mặc định là thư mục gốc project, /app trong Docker)
+CATALOG_BASE_DIR = Path(os.getenv("CATALOG_BASE_DIR", str(PROJECT_ROOT)))
+
+# Khoảng thời gian tối thiểu giữa hai lần kiểm tra mtime của các file metadata
+CATALOG_RELOAD_CHECK_SECONDS = float(os.getenv("CATALOG_RELOAD_CHECK_SECONDS", "2"))
+
+PAGES_METADATA = "assets/interiors/pages_metadata.yaml"
+COVERS_METADATA = "assets/covers/covers_metadata.yaml"
+INTERLEAFS_METADATA = "assets/interleafs/interleaf_metadata.yaml"
+
+
+class CatalogError(Exception):
+    """Metadata catalog không tồn tại hoặc sai định dạng."""
+
+
+def _normalize_id(value: Any) -> str:
+    return str(value).strip().zfill(2)
+
+
+def _file_signature(path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _load_yaml_section(path: Path, section: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Đọc mapping `section` của một file metadata; None nếu file không tồn tại."""
+    if not path.exists():
+        return None
+
+    try:
+        with path.open("r", encoding="utf-8") as f:
+            data = yaml.safe_load(f) or {}
+    except yaml.YAMLError as e:
+        raise CatalogError(f"Invalid catalog metadata format in {path}: {e}")
+
+    entries = data.get(section)
+    if not isinstance(entries, dict):
+        raise CatalogError(f"Catalog metadata {path} missing '{section}' mapping")
+
+    return {str(key): value for key, value in entries.items() if isinstance(value, dict)}
+
+
+class CatalogSnapshot:
+    """
+    Một phiên bản đã load của toàn bộ metadata (pages, covers, interleafs) kèm index.
+    Snapshot không bị sửa sau khi tạo; reload sẽ tạo snapshot mới và thay thế cả object.
+    """
+
+    def __init__(
+        self,
+        pages: Optional[Dict[str, Dict[str, Any]]],
+        covers: Optional[Dict[str, Dict[str, Any]]],
+        interleafs: Optional[Dict[str, Dict[str, Any]]],
+        signatures: Dict[str, Optional[Tuple[int, int]]]
+    ):
+        self.pages = pages
+        self.covers = covers
+        self.interleafs = interleafs
+        self.signatures = signatures
+        self.loaded_at = time.time()
+
+        # Index (category, book, story, page) -> page key cho các entry có key không theo chuẩn
+        self.page_keys_by_ids: Dict[Tuple[str, str, str, str], str] = {}
+        for page_key, page_data in (pages or {}).items():
+            try:
+                ids = (
+                    _normalize_id(page_data["category_id"]),
+                    _normalize_id(page_data["book_id"]),
+                    _normalize_id(page_data["story_id"]),
+                    _normalize_id(page_data["page_id"]),
+                )
+            except KeyError:
+                continue
+            self.page_keys_by_ids.setdefault(ids, page_key)
+
+
+class AssetCatalog:
+    """
+    Catalog dùng chung cho metadata của sách: load các file YAML một lần, index theo key,
+    và tự reload (thay snapshot atomic) khi file trên đĩa thay đổi.
+    Nội dung các file JSON (story, title, quote) cũng được cache theo (mtime, size).
+    """
+
+    def __init__(self, base_dir: Path):
+        self.base_dir = Path(base_dir)
+        self._sources = {
+            "pages": self.base_dir / PAGES_METADATA,
+            "covers": self.base_dir / COVERS_METADATA,
+            "interleafs": self.base_dir / INTERLEAFS_METADATA,
+        }
+        self._lock = threading.Lock()
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._last_check = 0.0
+        self._json_cache: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+
+    def resolve(self, relative_path: str) -> Path:
+        """Đường dẫn tuyệt đối của một asset (đường dẫn trong metadata là tương đối theo base_dir)."""
+        path = Path(relative_path)
+        if path.is_absolute():
+            return path
+        return self.base_dir / path
+
+    def _current_signatures(self) -> Dict[str, Optional[Tuple[int, int]]]:
+        return {name: _file_signature(path) for name, path in self._sources.items()}
+
+    def _build_snapshot(self, signatures: Dict[str, Optional[Tuple[int, int]]]) -> CatalogSnapshot:
+        return CatalogSnapshot(
+            pages=_load_yaml_section(self._sources["pages"], "pages"),
+            covers=_load_yaml_section(self._sources["covers"], "covers"),
+            interleafs=_load_yaml_section(self._sources["interleafs"], "pages"),
+            signatures=signatures,
+        )
+
+    def snapshot(self) -> CatalogSnapshot:
+        """
+        Trả về snapshot hiện tại, reload nếu file metadata đã thay đổi.
+        Nếu reload thất bại (file đang được ghi dở, YAML lỗi) thì giữ snapshot cũ.
+        """
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._last_check < CATALOG_RELOAD_CHECK_SECONDS:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            self._last_check = now
+            signatures = self._current_signatures()
+            if snapshot is not None and snapshot.signatures == signatures:
+                return snapshot
+
+            try:
+                new_snapshot = self._build_snapshot(signatures)
+            except CatalogError as e:
+                if snapshot is None:
+                    raise
+                print(f"Warning: Catalog reload failed, keeping previous version: {e}")
+                return snapshot
+
+            if snapshot is not None:
+                print("DEBUG catalog: Metadata changed on disk, reloaded catalog")
+            self._snapshot = new_snapshot
+            return new_snapshot
+
+    def pages(self) -> Dict[str, Dict[str, Any]]:
+        pages = self.snapshot().pages
+        if pages is None:
+            raise CatalogError(f"Catalog metadata file not found: {self._sources['pages']}")
+        return pages
+
+    def get_page(self, page_key: str) -> Optional[Dict[str, Any]]:
+        return self.pages().get(page_key)
+
+    def find_page_key(self, category_id: str, book_id: str, story_id: str, page_id: str) -> Optional[str]:
+        """Tìm page key theo (category, book, story, page) - tra cứu O(1)."""
+        snapshot = self.snapshot()
+        if snapshot.pages is None:
+            raise CatalogError(f"Catalog metadata file not found: {self._sources['pages']}")
+
+        ids = tuple(_normalize_id(value) for value in (category_id, book_id, story_id, page_id))
+        direct_key = f"{ids[0]}{ids[1]}{ids[2]}({ids[3]})"
+        if direct_key in snapshot.pages:
+            return direct_key
+        return snapshot.page_keys_by_ids.get(ids)
+
+    def covers(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Mapping cover_id -> metadata, hoặc None nếu không có file covers_metadata.yaml."""
+        return self.snapshot().covers
+
+    def interleafs(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Mapping interleaf_id -> metadata, hoặc None nếu không có file interleaf_metadata.yaml."""
+        return self.snapshot().interleafs
+
+    def load_json(self, relative_path: str) -> Any:
+        """
+        Đọc file JSON của asset (story, title, quote) với cache theo (mtime, size).
+        Giá trị trả về được dùng chung giữa các request - không được sửa trực tiếp.
+        """
+        path = self.resolve(relative_path)
+        signature = _file_signature(path)
+        if signature is None:
+            raise FileNotFoundError(f"File not found: {path}")
+
+        key = str(path)
+        cached = self._json_cache.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        with path.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+        self._json_cache[key] = (signature, data)
+        return data
+
+
+# Catalog dùng chung trong process
+catalog = AssetCatalog(CATALOG_BASE_DIR)
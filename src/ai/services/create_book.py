@@ -1,14 +1,15 @@
 import time
-import io
 import asyncio
-from pathlib import Path
-from typing import List, Tuple
-import yaml
-from pypdf import PdfWriter, PdfReader
-from .create_cover import create_cover, create_cover_test
-from .create_interleafs import create_interleafs, create_interleafs_test
-from .create_content import create_main_content, create_main_content_test
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from .create_cover import prepare_cover_page
+from .create_interleafs import prepare_interleaf_pages
+from .create_content import prepare_content_pages
+from .book_renderer import build_book_plan
+from .render_pool import render_plan
 from .get_page_id import get_page_id
+from .catalog import catalog
+from .image_utils import load_image_handle, load_transparent_handle
+from .tracing import trace_span
 
 
 async def _process_story_pages(
@@ -17,8 +18,7 @@ async def _process_story_pages(
     book_id: str,
     name: str,
     image_url: str,
-    catalog_data: dict,
-    base_dir: Path
+    progress_callback: Optional[Callable[[str, str], None]] = None
 ) -> Tuple[List[str], List[str], List[str]]:
     """
     Xử lý song song các trang trong một story.
@@ -26,22 +26,20 @@ async def _process_story_pages(
     """
     story_id = story_req["story_id"]
     tasks = []
+    _report_progress(progress_callback, f"story_{story_id}", "running")
 
     # Import required services
-    from .swap_face import swap_face
+    from .swap_face import swap_face_cached
 
     async def process_single_page(page_id: str):
         try:
             page_key = get_page_id(category_id, book_id, story_id, page_id)
-            page_metadata = catalog_data["pages"].get(page_key)
+            page_metadata = catalog.get_page(page_key)
             if not page_metadata:
                 return None, None, None
 
-            # Load story content
-            story_file_path = base_dir / page_metadata["story_file"]
-            with story_file_path.open("r", encoding="utf-8") as f:
-                import json
-                story_data = json.load(f)
+            # Load story content (cache trong catalog)
+            story_data = catalog.load_json(page_metadata["story_file"])
 
             page_content = story_data.get("page_content")
             if not page_content:
@@ -54,7 +52,7 @@ async def _process_story_pages(
             character_path = page_metadata["character"]
 
             # Face swap
-            face_swap_result = await swap_face(
+            face_swap_result = await swap_face_cached(
                 face_image_url=image_url,
                 body_image_url=character_path
             )
@@ -65,11 +63,12 @@ async def _process_story_pages(
                 swapped_image_url = character_path
 
             # Skip remove_background to preserve original props (balloon, basket, etc.)
-            processed_image_data = swapped_image_url
+            # Tải ảnh qua HTTP client async dùng chung để renderer không phải tải (blocking) lại
+            processed_image_data = await load_image_handle(swapped_image_url)
 
             # Collect background local path
             background_path = page_metadata["background"]
-            background_full_path = base_dir / background_path
+            background_full_path = catalog.resolve(background_path)
             background_url = str(background_full_path) if background_full_path.exists() else None
 
             return page_content, processed_image_data, background_url
@@ -83,7 +82,8 @@ async def _process_story_pages(
         tasks.append(process_single_page(page_id))
 
     # Chạy song song 2 pages
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    with trace_span("book.story", story_id=story_id):
+        results = await asyncio.gather(*tasks, return_exceptions=True)
 
     scripts = []
     image_urls = []
@@ -98,16 +98,28 @@ async def _process_story_pages(
             image_urls.append(result[1])
             background_urls.append(result[2])
 
+    _report_progress(progress_callback, f"story_{story_id}", "completed" if scripts else "failed")
     return scripts, image_urls, background_urls
 
 
+def _report_progress(progress_callback: Optional[Callable[[str, str], None]], stage: str, state: str) -> None:
+    """Báo tiến độ của một stage (cover, story_XX, interleafs, render) cho caller, nếu có."""
+    if progress_callback is None:
+        return
+    try:
+        progress_callback(stage, state)
+    except Exception as e:
+        print(f"Warning: progress callback failed for stage {stage}: {e}")
+
+
 async def create_book(
     category_id: str,
     book_id: str,
     stories: List[dict],
     name: str,
     image_url: str,
-    font_path: str = None
+    font_path: str = None,
+    progress_callback: Optional[Callable[[str, str], None]] = None
 ) -> bytes:
     """
     Tạo toàn bộ cuốn sách PDF bao gồm cover, content và interleafs.
@@ -128,12 +140,12 @@ async def create_book(
         name: Tên nhân vật để thay thế vào content
         image_url: URL ảnh face để swap vào characters
         font_path: (Tùy chọn) Đường dẫn tới font TTF hiện đại
+        progress_callback: (Tùy chọn) Hàm nhận (stage, state) mỗi khi một stage bắt đầu/kết thúc
 
     Returns:
         Dữ liệu PDF của toàn bộ cuốn sách dưới dạng bytes
     """
     start_time = time.time()
-    base_dir = Path("/app")
 
     print(f"Creating complete book for category {category_id}, book {book_id}")
     print(f"Stories count: {len(stories)}")
@@ -142,35 +154,38 @@ async def create_book(
     interleaf_count = len(stories) // 2
     print(f"Step 1: Will create {interleaf_count} interleaf(s) for {len(stories)} stories")
 
-    # CHẠY SONG SONG: Tạo cover và chuẩn bị content data
-    print("Step 2: Creating cover and preparing content (parallel)...")
+    # CHẠY SONG SONG: Chuẩn bị cover, content và interleafs
+    print("Step 2: Preparing cover, content and interleafs (parallel)...")
 
-    async def create_cover_task():
+    async def prepare_cover_task():
+        _report_progress(progress_callback, "cover", "running")
         try:
-            return await create_cover(
-                category_id=category_id,
-                book_id=book_id,
-                name=name,
-                image_url=image_url
-            )
+            with trace_span("book.prepare.cover"):
+                cover_page = await prepare_cover_page(
+                    category_id=category_id,
+                    book_id=book_id,
+                    name=name,
+                    image_url=image_url
+                )
+            _report_progress(progress_callback, "cover", "completed")
+            return cover_page
         except Exception as e:
+            _report_progress(progress_callback, "cover", "failed")
             raise Exception(f"Failed to create cover: {str(e)}")
 
     async def prepare_content_task():
         try:
-            # Load catalog metadata
-            catalog_path = Path("/app/assets/interiors/pages_metadata.yaml")
-            with catalog_path.open("r", encoding="utf-8") as f:
-                catalog_data = yaml.safe_load(f)
-
             # Xử lý song song tất cả stories
             print(f"  - Processing {len(stories)} stories in parallel...")
             story_tasks = [
-                _process_story_pages(story_req, category_id, book_id, name, image_url, catalog_data, base_dir)
+                _process_story_pages(
+                    story_req, category_id, book_id, name, image_url, progress_callback
+                )
                 for story_req in stories
             ]
 
-            story_results = await asyncio.gather(*story_tasks, return_exceptions=True)
+            with trace_span("book.prepare.content", stories=len(stories)):
+                story_results = await asyncio.gather(*story_tasks, return_exceptions=True)
 
             # Collect tất cả data từ các stories
             all_scripts = []
@@ -192,114 +207,73 @@ async def create_book(
 
             print(f"  - Collected {len(all_scripts)} pages from {len(stories)} stories")
 
-            # Create main content PDF
-            content_pdf = await create_main_content(
+            return prepare_content_pages(
                 image_urls=all_image_urls,
                 scripts=all_scripts,
-                background_urls=all_background_urls,
-                font_path=font_path
+                background_urls=all_background_urls
             )
 
-            return content_pdf, all_scripts
-
         except Exception as e:
             raise Exception(f"Failed to prepare content: {str(e)}")
 
-    # Chạy song song cover và content preparation
-    cover_task = create_cover_task()
-    content_task = prepare_content_task()
-
-    cover_pdf, (content_pdf, all_scripts) = await asyncio.gather(cover_task, content_task)
-
-    print("✓ Cover and content preparation completed successfully")
-
-    # Tạo interleafs nếu cần (chạy song song với merge nếu có thể)
-    interleaf_pdfs = []
-    if interleaf_count > 0:
-        print(f"Step 3: Creating {interleaf_count} interleaf(s)...")
+    async def prepare_interleafs_task():
+        if interleaf_count == 0:
+            return []
+        print(f"  - Preparing {interleaf_count} interleaf(s) in parallel...")
+        _report_progress(progress_callback, "interleafs", "running")
         try:
-            # Create all interleafs
-            all_interleafs_pdf = await create_interleafs(
-                category_id=category_id,
-                book_id=book_id,
-                interleaf_count=interleaf_count,
-                name=name,
-                image_url=image_url
-            )
-
-            if all_interleafs_pdf:
-                # Split interleaf PDF into individual interleaf PDFs (each 2 pages)
-                interleaf_stream = io.BytesIO(all_interleafs_pdf)
-                interleaf_reader = PdfReader(interleaf_stream)
-
-                # Each interleaf has 2 pages
-                for i in range(0, len(interleaf_reader.pages), 2):
-                    writer = PdfWriter()
-                    writer.add_page(interleaf_reader.pages[i])
-                    if i + 1 < len(interleaf_reader.pages):
-                        writer.add_page(interleaf_reader.pages[i + 1])
-
-                    buffer = io.BytesIO()
-                    writer.write(buffer)
-                    buffer.seek(0)
-                    interleaf_pdfs.append(buffer.getvalue())
-
-            print("✓ Interleaf pages created successfully")
+            with trace_span("book.prepare.interleafs", interleafs=interleaf_count):
+                interleaf_pages = await prepare_interleaf_pages(
+                    category_id=category_id,
+                    book_id=book_id,
+                    interleaf_count=interleaf_count,
+                    name=name,
+                    image_url=image_url
+                )
+            print("✓ Interleaf pages prepared successfully")
+            _report_progress(progress_callback, "interleafs", "completed")
+            return interleaf_pages
         except Exception as e:
             print(f"Warning: Failed to create interleafs: {str(e)}, continuing without interleafs")
-            interleaf_pdfs = []
+            _report_progress(progress_callback, "interleafs", "failed")
+            return []
+
+    # Chạy song song cover, content và interleafs: mọi face swap của cuốn sách nằm trong cùng một gather
+    with trace_span("book.prepare", stories=len(stories)):
+        cover_page, content_pages, interleaf_pages = await asyncio.gather(
+            prepare_cover_task(), prepare_content_task(), prepare_interleafs_task()
+        )
+
+    print("✓ Cover, content and interleaf preparation completed successfully")
 
-    # Merge tất cả PDFs theo thứ tự xen kẽ: cover + (content 4 pages + interleaf 2 pages) * n
-    print("Step 4: Merging all PDFs in interleaved order...")
+    # Render toàn bộ sách trong một lần: cover + (content 4 pages + interleaf 2 pages) * n
+    print("Step 3: Rendering all pages in interleaved order...")
+    _report_progress(progress_callback, "render", "running")
     try:
-        writer = PdfWriter()
-
-        # Add cover
-        cover_stream = io.BytesIO(cover_pdf)
-        cover_reader = PdfReader(cover_stream)
-        for page in cover_reader.pages:
-            writer.add_page(page)
-
-        # Split content into chunks of 4 pages (2 stories = 4 pages each)
-        content_stream = io.BytesIO(content_pdf)
-        content_reader = PdfReader(content_stream)
-        content_pages = content_reader.pages
-
-        # Process content in chunks of 4 pages, interleaving with interleafs
-        interleaf_index = 0
-        for i in range(0, len(content_pages), 4):  # 4 pages per story group (2 stories × 2 pages)
-            # Add 4 content pages (2 stories)
-            for j in range(4):
-                if i + j < len(content_pages):
-                    writer.add_page(content_pages[i + j])
-
-            # Add interleaf after every 2 stories (if available)
-            if interleaf_index < len(interleaf_pdfs):
-                interleaf_stream = io.BytesIO(interleaf_pdfs[interleaf_index])
-                interleaf_reader = PdfReader(interleaf_stream)
-                for page in interleaf_reader.pages:
-                    writer.add_page(page)
-                interleaf_index += 1
-
-        # Create final merged PDF
-        merged_buffer = io.BytesIO()
-        writer.write(merged_buffer)
-
-        merged_buffer.seek(0)
-        final_pdf = merged_buffer.getvalue()
+        plan = build_book_plan(cover_page, content_pages, interleaf_pages)
+        with trace_span("book.render", pages=len(plan)):
+            final_pdf = await render_plan(plan, font_path)
 
         processing_time = time.time() - start_time
         print(f"✓ Complete book created successfully in {processing_time:.2f} seconds")
-        print(f"  - Cover: 1 page")
-        print(f"  - Content: {len(content_pages)} pages")
-        print(f"  - Interleafs: {len(interleaf_pdfs) * 2} pages")
-        print(f"  - Total: {1 + len(content_pages) + (len(interleaf_pdfs) * 2)} pages")
-        print(f"  - Parallel processing: Stories processed concurrently, pages within each story processed concurrently")
+        _print_plan_summary(plan)
 
+        _report_progress(progress_callback, "render", "completed")
         return final_pdf
 
     except Exception as e:
-        raise Exception(f"Failed to merge PDFs: {str(e)}")
+        _report_progress(progress_callback, "render", "failed")
+        raise Exception(f"Failed to render book: {str(e)}")
+
+
+def _print_plan_summary(plan: List[Dict[str, Any]]) -> None:
+    content_count = sum(1 for page in plan if page["type"] == "content")
+    interleaf_count = sum(1 for page in plan if page["type"] == "interleaf")
+    print("  - Cover: 1 page")
+    print(f"  - Content: {content_count} pages")
+    print(f"  - Interleafs: {interleaf_count} pages")
+    print(f"  - Total: {len(plan)} pages")
+    print("  - Parallel processing: Cover, story pages and interleaf pages prepared concurrently")
 
 
 async def _process_story_pages_test(
@@ -307,9 +281,7 @@ async def _process_story_pages_test(
     category_id: str,
     book_id: str,
     name: str,
-    image_url: str,
-    catalog_data: dict,
-    base_dir: Path
+    image_url: str
 ) -> Tuple[List[str], List[str], List[str]]:
     """
     Xử lý song song các trang trong một story (phiên bản test - không swapface).
@@ -321,15 +293,12 @@ async def _process_story_pages_test(
     async def process_single_page(page_id: str):
         try:
             page_key = get_page_id(category_id, book_id, story_id, page_id)
-            page_metadata = catalog_data["pages"].get(page_key)
+            page_metadata = catalog.get_page(page_key)
             if not page_metadata:
                 return None, None, None
 
-            # Load story content
-            story_file_path = base_dir / page_metadata["story_file"]
-            with story_file_path.open("r", encoding="utf-8") as f:
-                import json
-                story_data = json.load(f)
+            # Load story content (cache trong catalog)
+            story_data = catalog.load_json(page_metadata["story_file"])
 
             page_content = story_data.get("page_content")
             if not page_content:
@@ -340,15 +309,14 @@ async def _process_story_pages_test(
 
             # Get character path directly (no face swap in test mode)
             character_path = page_metadata["character"]
-            character_full_path = base_dir / character_path
+            character_full_path = catalog.resolve(character_path)
 
-            # Convert to base64 data URL format for PDF generation
-            from .create_content import _convert_image_to_transparent_base64
-            processed_image_data = _convert_image_to_transparent_base64(str(character_full_path))
+            # Tách nền đen, giữ ảnh đã decode cho renderer
+            processed_image_data = await load_transparent_handle(str(character_full_path))
 
             # Collect background local path
             background_path = page_metadata["background"]
-            background_full_path = base_dir / background_path
+            background_full_path = catalog.resolve(background_path)
             background_url = str(background_full_path) if background_full_path.exists() else None
 
             return page_content, processed_image_data, background_url
@@ -419,31 +387,22 @@ async def create_book_test(
     # Tính số interleaf cần tạo (mỗi 2 stories = 1 interleaf)
     interleaf_count = len(stories) // 2
 
-    # Load catalog metadata một lần
-    base_dir = Path("/app")
-    catalog_path = base_dir / "assets" / "interiors" / "pages_metadata.yaml"
-
-    with catalog_path.open("r", encoding="utf-8") as f:
-        catalog_data = yaml.safe_load(f)
-
-    print("✓ Loaded catalog metadata")
-
-    async def create_cover_task():
-        """Tạo cover PDF"""
-        print("Step 1: Creating cover...")
+    async def prepare_cover_task():
+        """Chuẩn bị trang cover"""
+        print("Step 1: Preparing cover...")
         try:
-            return await create_cover_test(
+            return await prepare_cover_page(
                 category_id=category_id,
                 book_id=book_id,
                 name=name,
                 image_url=image_url,  # Ignored in test mode
-                font_path=font_path
+                swap_face_enabled=False
             )
         except Exception as e:
             raise Exception(f"Failed to create cover: {str(e)}")
 
     async def prepare_content_task():
-        """Chuẩn bị nội dung PDF từ tất cả stories"""
+        """Chuẩn bị các trang nội dung từ tất cả stories"""
         print(f"Step 2: Preparing content for {len(stories)} stories...")
 
         try:
@@ -455,9 +414,7 @@ async def create_book_test(
                     category_id=category_id,
                     book_id=book_id,
                     name=name,
-                    image_url=image_url,  # Ignored in test mode
-                    catalog_data=catalog_data,
-                    base_dir=base_dir
+                    image_url=image_url  # Ignored in test mode
                 )
                 story_tasks.append(task)
 
@@ -481,109 +438,47 @@ async def create_book_test(
 
             print(f"✓ Collected {len(all_scripts)} pages from {len(stories)} stories")
 
-            # Tạo content PDF với tất cả pages
-            content_pdf = await create_main_content_test(
+            return prepare_content_pages(
                 image_urls=all_image_urls,
                 scripts=all_scripts,
-                background_urls=all_background_urls,
-                font_path=font_path
+                background_urls=all_background_urls
             )
 
-            return content_pdf, all_scripts
-
         except Exception as e:
             raise Exception(f"Failed to prepare content: {str(e)}")
 
     # Chạy song song cover và content preparation
-    cover_task = create_cover_task()
-    content_task = prepare_content_task()
-
-    cover_pdf, (content_pdf, all_scripts) = await asyncio.gather(cover_task, content_task)
+    cover_page, content_pages = await asyncio.gather(prepare_cover_task(), prepare_content_task())
 
     print("✓ Cover and content preparation completed successfully")
 
-    # Tạo interleafs nếu cần (chạy song song với merge nếu có thể)
-    interleaf_pdfs = []
+    # Chuẩn bị interleafs nếu cần
+    interleaf_pages = []
     if interleaf_count > 0:
-        print(f"Step 3: Creating {interleaf_count} interleaf(s)...")
+        print(f"Step 3: Preparing {interleaf_count} interleaf(s)...")
         try:
-            # Create all interleafs using test function
-            all_interleafs_pdf = await create_interleafs_test(
+            interleaf_pages = await prepare_interleaf_pages(
                 category_id=category_id,
                 book_id=book_id,
                 interleaf_count=interleaf_count,
                 name=name,
-                image_url=image_url  # Ignored in test mode
+                image_url=image_url,  # Ignored in test mode
+                swap_face_enabled=False
             )
-
-            if all_interleafs_pdf:
-                # Split interleaf PDF into individual interleaf PDFs (each 2 pages)
-                interleaf_stream = io.BytesIO(all_interleafs_pdf)
-                interleaf_reader = PdfReader(interleaf_stream)
-
-                # Each interleaf has 2 pages
-                for i in range(0, len(interleaf_reader.pages), 2):
-                    writer = PdfWriter()
-                    writer.add_page(interleaf_reader.pages[i])
-                    if i + 1 < len(interleaf_reader.pages):
-                        writer.add_page(interleaf_reader.pages[i + 1])
-
-                    buffer = io.BytesIO()
-                    writer.write(buffer)
-                    buffer.seek(0)
-                    interleaf_pdfs.append(buffer.getvalue())
-
-            print("✓ Interleaf pages created successfully")
+            print("✓ Interleaf pages prepared successfully")
         except Exception as e:
             print(f"Warning: Failed to create interleafs: {str(e)}, continuing without interleafs")
-            interleaf_pdfs = []
+            interleaf_pages = []
 
-    # Merge tất cả PDFs theo thứ tự xen kẽ: cover + (content 4 pages + interleaf 2 pages) * n
-    print("Step 4: Merging all PDFs in interleaved order...")
+    # Render toàn bộ sách trong một lần: cover + (content 4 pages + interleaf 2 pages) * n
+    print("Step 4: Rendering all pages in interleaved order...")
     try:
-        writer = PdfWriter()
-
-        # Add cover
-        cover_stream = io.BytesIO(cover_pdf)
-        cover_reader = PdfReader(cover_stream)
-        for page in cover_reader.pages:
-            writer.add_page(page)
-
-        # Split content into chunks of 4 pages (2 stories = 4 pages each)
-        content_stream = io.BytesIO(content_pdf)
-        content_reader = PdfReader(content_stream)
-        content_pages = content_reader.pages
-
-        # Process content in chunks of 4 pages, interleaving with interleafs
-        interleaf_index = 0
-        for i in range(0, len(content_pages), 4):  # 4 pages per story group (2 stories × 2 pages)
-            # Add 4 content pages (2 stories)
-            for j in range(4):
-                if i + j < len(content_pages):
-                    writer.add_page(content_pages[i + j])
-
-            # Add interleaf after every 2 stories (if available)
-            if interleaf_index < len(interleaf_pdfs):
-                interleaf_stream = io.BytesIO(interleaf_pdfs[interleaf_index])
-                interleaf_reader = PdfReader(interleaf_stream)
-                for page in interleaf_reader.pages:
-                    writer.add_page(page)
-                interleaf_index += 1
-
-        # Create final merged PDF
-        merged_buffer = io.BytesIO()
-        writer.write(merged_buffer)
-
-        merged_buffer.seek(0)
-        final_pdf = merged_buffer.getvalue()
+        plan = build_book_plan(cover_page, content_pages, interleaf_pages)
+        final_pdf = await render_plan(plan, font_path)
 
         processing_time = time.time() - start_time
         print(f"✓ Complete TEST MODE book created successfully in {processing_time:.2f} seconds")
-        print(f"  - Cover: 1 page")
-        print(f"  - Content: {len(content_pages)} pages")
-        print(f"  - Interleafs: {len(interleaf_pdfs) * 2} pages")
-        print(f"  - Total: {1 + len(content_pages) + (len(interleaf_pdfs) * 2)} pages")
-        print(f"  - Parallel processing: Stories processed concurrently, pages within each story processed concurrently")
+        _print_plan_summary(plan)
 
         return final_pdf
 
@@ -3,7 +3,7 @@ import io
 import base64
 import re
 import json
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Union
 
 import requests
 from PIL import Image
@@ -15,7 +15,11 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
-
+from .image_utils import ImageHandle
+from .render_pool import render_plan
+from .asset_cache import prepare_background, FIT_STRETCH
+from .background_index import get_text_colors, PROFILE_CONTENT
+from .pdf_image_cache import pdf_image_cache, draw_encoded_image, target_pixels
 
 
 def _find_usable_font_path(preferred_path: Optional[str] = None) -> Optional[str]:
@@ -65,35 +69,11 @@ def _register_unicode_font(font_path: Optional[str]) -> str:
     return "Helvetica"
 
 
-def _image_to_base64_png(image: Image.Image) -> str:
-    buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
-    return f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
-
-
-def _convert_image_to_transparent_base64(source: str) -> str:
-    image = _download_image_as_pil(source)
-    if image.mode != "RGBA":
-        image = image.convert("RGBA")
-
-    cleaned_pixels = []
-    for pixel in image.getdata():
-        if isinstance(pixel, int):
-            pixel = (pixel, pixel, pixel, 255)
-        elif len(pixel) == 3:
-            pixel = (*pixel, 255)
-
-        r, g, b, a = pixel
-        if a > 0 and r < 10 and g < 10 and b < 10:
-            cleaned_pixels.append((r, g, b, 0))
-        else:
-            cleaned_pixels.append((r, g, b, a))
-
-    image.putdata(cleaned_pixels)
-    return _image_to_base64_png(image)
-
+def _download_image_as_pil(url: Union[str, ImageHandle]) -> Image.Image:
+    # Ảnh đã decode sẵn (ImageHandle) - dùng trực tiếp, không encode/decode lại
+    if isinstance(url, ImageHandle):
+        return url.image
 
-def _download_image_as_pil(url: str) -> Image.Image:
     # Check if it's a base64 data URL
     if url.startswith("data:image/"):
         # Extract base64 data from data URL
@@ -130,64 +110,6 @@ def _download_image_as_pil(url: str) -> Image.Image:
     return img
 
 
-def _analyze_background_brightness(bg_img: Image.Image, text_region_ratio: float = 0.3) -> float:
-    """
-    Analyze background brightness in the text region to determine appropriate text color.
-    Returns average brightness (0-1), where > 0.5 is bright, < 0.5 is dark.
-    """
-    width, height = bg_img.size
-
-    # Define text region (right half of the page where text will be placed)
-    text_region_x = int(width * 0.5)  # Start from middle
-    text_region_y = int(height * 0.1)  # Skip top margin
-    text_region_width = int(width * 0.4)  # Text takes about 40% of width
-    text_region_height = int(height * 0.8)  # Text takes about 80% of height
-
-    # Crop to text region
-    text_region = bg_img.crop((
-        text_region_x,
-        text_region_y,
-        min(text_region_x + text_region_width, width),
-        min(text_region_y + text_region_height, height)
-    ))
-
-    # Sample pixels (take every 10th pixel for performance)
-    pixels = []
-    for y in range(0, text_region.height, 10):
-        for x in range(0, text_region.width, 10):
-            pixels.append(text_region.getpixel((x, y)))
-
-    if not pixels:
-        return 0.5  # Default to medium brightness
-
-    # Calculate average luminance using standard formula
-    total_luminance = 0
-    for r, g, b in pixels:
-        # Standard luminance formula: 0.299*R + 0.587*G + 0.114*B
-        luminance = (0.299 * r + 0.587 * g + 0.114 * b) / 255.0
-        total_luminance += luminance
-
-    average_luminance = total_luminance / len(pixels)
-    return average_luminance
-
-
-def _get_optimal_text_colors(brightness: float) -> tuple:
-    """
-    Return optimal text and shadow colors based on background brightness.
-    Returns (text_color_rgb, shadow_color_rgb) where each is (r, g, b) tuple with values 0-1.
-    """
-    if brightness > 0.5:
-        # Bright background -> Dark text
-        text_color = (0, 0, 0)  # Black text
-        shadow_color = (0.3, 0.3, 0.3)  # Dark gray shadow
-    else:
-        # Dark background -> Light text
-        text_color = (1, 1, 1)  # White text
-        shadow_color = (0.7, 0.7, 0.7)  # Light gray shadow
-
-    return text_color, shadow_color
-
-
 def _resolve_content_background_directory(story: str = "story_01", allow_fallback: bool = True) -> str:
     """
     Resolve thư mục background cho nội dung dựa trên tên story.
@@ -371,13 +293,23 @@ def _draw_background(c: canvas.Canvas, background_path: str, page_width: float,
     Draw background image for the page, scaled to fit the full page.
     Background is drawn first so other elements appear on top.
     """
+    try:
+        # Background đã scale sẵn theo trang (cache trên đĩa), nhúng thẳng vào PDF
+        prepared = prepare_background(background_path, FIT_STRETCH, page_width, page_height)
+        draw_encoded_image(c, pdf_image_cache.for_file(prepared.path), prepared.x, prepared.y, prepared.width, prepared.height)
+        print(f"✓ Background loaded successfully: {background_path}")
+    except Exception as e:
+        print(f"⚠ Warning: Could not use prepared background for {background_path}, drawing original: {e}")
+        _draw_original_background(c, background_path, page_width, page_height)
+
+
+def _draw_original_background(c: canvas.Canvas, background_path: str, page_width: float, page_height: float) -> None:
     try:
         # Open image directly from file path
         bg_img = Image.open(background_path)
         img_reader = ImageReader(bg_img)
         # Scale background to cover full page
         c.drawImage(img_reader, 0, 0, width=page_width, height=page_height, preserveAspectRatio=False, mask="auto")
-        print(f"✓ Background loaded successfully: {background_path}")
     except Exception as e:
         # If background fails to load, just continue without background
         print(f"⚠ Warning: Could not load background image {background_path}: {e}")
@@ -400,14 +332,9 @@ def _draw_image_left_half(c: canvas.Canvas, pil_img: Image.Image, page_width: fl
     draw_x = left_x + (left_width - draw_w) / 2
     draw_y = left_y + (left_height - draw_h) / 2
 
-    if pil_img.mode == "RGBA":
-        img_buffer = io.BytesIO()
-        pil_img.save(img_buffer, format="PNG")
-        img_buffer.seek(0)
-        img_reader = ImageReader(img_buffer)
-    else:
-        img_reader = ImageReader(pil_img)
-    c.drawImage(img_reader, draw_x, draw_y, width=draw_w, height=draw_h, preserveAspectRatio=True, mask="auto")
+    # Stream ảnh đã nén (kèm soft mask) được cache theo nội dung ảnh + độ phân giải đích
+    encoded = pdf_image_cache.for_image(pil_img, target_pixels(draw_w, draw_h))
+    draw_encoded_image(c, encoded, draw_x, draw_y, draw_w, draw_h)
 
 
 def _draw_bold_text(c: canvas.Canvas, text: str, x: float, y: float, font_name: str, font_size: float, max_width: float, text_color: tuple = (0, 0, 0), shadow_color: tuple = (0.3, 0.3, 0.3)) -> float:
@@ -486,20 +413,9 @@ def _draw_text_right_half(c: canvas.Canvas, text: str, font_name: str, page_widt
     # Set font for bold text rendering
     c.setFont(font_name, 18)
 
-    # Auto-detect optimal text colors based on background brightness
-    text_color = (0, 0, 0)  # Default: black
-    shadow_color = (0.3, 0.3, 0.3)  # Default: dark gray
-
-    if background_url:
-        try:
-            # Load background image to analyze brightness
-            bg_img = Image.open(background_url)
-            brightness = _analyze_background_brightness(bg_img)
-            text_color, shadow_color = _get_optimal_text_colors(brightness)
-            print(f"✓ Auto-detected text colors for background: brightness={brightness:.2f}, text={text_color}, shadow={shadow_color}")
-        except Exception as e:
-            print(f"⚠ Could not analyze background for color detection: {e}")
-            # Keep default colors
+    # Màu chữ/bóng chữ theo độ sáng background (đã tính sẵn trong background index)
+    colors = get_text_colors(background_url, PROFILE_CONTENT)
+    text_color, shadow_color = colors.text_color, colors.shadow_color
 
     # Draw text with bold effect and optimal colors
     text_x = right_x + 8  # Left padding
@@ -573,7 +489,7 @@ def create_content_file(image_urls: List[str], scripts: List[str], output_filena
 
 
 async def create_main_content_test(
-    image_urls: List[str],
+    image_urls: List[Union[str, ImageHandle]],
     scripts: List[str],
     font_path: Optional[str] = None,
     story: str = "story_01",
@@ -670,38 +586,32 @@ async def create_main_content_test(
     return buffer.getvalue()
 
 
-async def create_main_content(
-    image_urls: List[str],
+def prepare_content_pages(
+    image_urls: List[Union[str, ImageHandle]],
     scripts: List[str],
-    font_path: Optional[str] = None,
     story: str = "story_01",
     background_urls: Optional[List[str]] = None,
     allow_fallback: bool = True
-) -> bytes:
+) -> List[Dict[str, Any]]:
     """
-    Tạo nội dung chính của cuốn sách dưới dạng PDF bytes.
-    Bao gồm các trang nội dung với hình ảnh và văn bản, nền được load từ assets.
-    Tự động remove background cho tất cả ảnh trước khi tạo PDF.
+    Chuẩn bị page spec cho các trang nội dung (ảnh nhân vật, script, background).
+    Kết quả dùng cho draw_content_page / book_renderer.
 
     Args:
-        image_urls: Danh sách URL ảnh nhân vật.
+        image_urls: Danh sách ảnh nhân vật (URL/path hoặc ImageHandle đã decode).
         scripts: Danh sách nội dung văn bản cho từng trang.
-        font_path: (Tùy chọn) Đường dẫn tới font TTF hiện đại.
         story: Tên story để load background phù hợp.
         background_urls: (Tùy chọn) Danh sách URL background cho mỗi trang.
         allow_fallback: Cho phép fallback sang background mặc định nếu không tìm thấy.
 
     Returns:
-        Dữ liệu PDF của nội dung chính dưới dạng bytes.
+        Danh sách dict page spec với type="content"
     """
     if len(image_urls) != len(scripts):
         raise ValueError("Số lượng ảnh và script phải bằng nhau.")
     if len(image_urls) == 0:
         raise ValueError("Phải có ít nhất một ảnh và một script.")
 
-    # Sử dụng trực tiếp image URLs (không remove background)
-    processed_image_urls = list(image_urls)
-
     # Load background images cho nội dung (required for each story)
     if background_urls is None:
         print(f"Loading content backgrounds for {len(scripts)} pages (story={story})...")
@@ -712,40 +622,70 @@ async def create_main_content(
             f"Using provided content background list with {len(background_urls)} items for story={story}"
         )
 
-    # Chuẩn bị font hiện đại
-    font_name = _register_unicode_font(font_path)
+    pages = []
+    for idx, (img_url, text) in enumerate(zip(image_urls, scripts), start=1):
+        bg_path = background_urls[min(idx-1, len(background_urls)-1)] if background_urls else None
+        pages.append({
+            "type": "content",
+            "background_path": bg_path,
+            "character_image": img_url,
+            "text": text,
+            "page_label": f"Trang {idx}"
+        })
+    return pages
 
-    # Thiết lập trang nằm ngang A4
-    page_width, page_height = landscape(A4)
+
+def draw_content_page(c: canvas.Canvas, page: Dict[str, Any], font_name: str, page_width: float, page_height: float) -> None:
+    """
+    Vẽ một trang nội dung lên canvas: background, ảnh bên trái, text bên phải, số trang.
+    Không gọi showPage - caller quyết định việc kết thúc trang.
+    """
     margin = 36  # 0.5 inch
     gutter = 16  # khoảng cách giữa 2 nửa trang
 
-    # Tạo PDF trong memory
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=(page_width, page_height))
+    # Background từ thư mục assets
+    bg_path = page.get("background_path")
+    if bg_path:
+        _draw_background(c, bg_path, page_width, page_height)
 
-    for idx, (img_url, text) in enumerate(zip(processed_image_urls, scripts), start=1):
-        # Background từ thư mục assets
-        bg_path = background_urls[min(idx-1, len(background_urls)-1)] if background_urls else None
-        if bg_path:
-            _draw_background(c, bg_path, page_width, page_height)
+    # Ảnh bên trái
+    pil_img = _download_image_as_pil(page["character_image"])
+    _draw_image_left_half(c, pil_img, page_width, page_height, margin, gutter)
 
-        # Ảnh bên trái
-        pil_img = _download_image_as_pil(img_url)
-        _draw_image_left_half(c, pil_img, page_width, page_height, margin, gutter)
+    # Text bên phải với font hiện đại, size lớn và màu tự động theo background
+    _draw_text_right_half(c, page["text"], font_name, page_width, page_height, margin, gutter, bg_path)
 
-        # Text bên phải với font hiện đại, size lớn và màu tự động theo background
-        _draw_text_right_half(c, text, font_name, page_width, page_height, margin, gutter, bg_path)
+    # Số trang (tuỳ chọn)
+    c.setFont(font_name if font_name != "Helvetica" else "Helvetica", 10)
+    c.setFillGray(0.3)
+    c.drawRightString(page_width - margin, margin / 2, page["page_label"])
+    c.setFillGray(0)
 
-        # Số trang (tuỳ chọn)
-        c.setFont(font_name if font_name != "Helvetica" else "Helvetica", 10)
-        c.setFillGray(0.3)
-        c.drawRightString(page_width - margin, margin / 2, f"Trang {idx}")
-        c.setFillGray(0)
 
-        c.showPage()
+async def create_main_content(
+    image_urls: List[str],
+    scripts: List[str],
+    font_path: Optional[str] = None,
+    story: str = "story_01",
+    background_urls: Optional[List[str]] = None,
+    allow_fallback: bool = True
+) -> bytes:
+    """
+    Tạo nội dung chính của cuốn sách dưới dạng PDF bytes.
+    Bao gồm các trang nội dung với hình ảnh và văn bản, nền được load từ assets.
 
-    c.save()
-    buffer.seek(0)
-    return buffer.getvalue()
+    Args:
+        image_urls: Danh sách URL ảnh nhân vật.
+        scripts: Danh sách nội dung văn bản cho từng trang.
+        font_path: (Tùy chọn) Đường dẫn tới font TTF hiện đại.
+        story: Tên story để load background phù hợp.
+        background_urls: (Tùy chọn) Danh sách URL background cho mỗi trang.
+        allow_fallback: Cho phép fallback sang background mặc định nếu không tìm thấy.
+
+    Returns:
+        Dữ liệu PDF của nội dung chính dưới dạng bytes.
+    """
+    pages = prepare_content_pages(image_urls, scripts, story, background_urls, allow_fallback)
 
+    # Vẽ PDF trên process pool, không chặn event loop
+    return await render_plan(pages, font_path)
@@ -1,14 +1,12 @@
 import os
 import io
 import base64
-import json
 import time
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Union
 
 import requests
 from PIL import Image
-from reportlab.lib.pagesizes import A4, landscape
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 from reportlab.platypus import Paragraph, Frame
@@ -16,6 +14,14 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
+from .image_utils import ImageHandle, load_transparent_handle
+from .catalog import catalog
+from .render_pool import render_plan
+from .asset_cache import prepare_background, FIT_CONTAIN
+from .background_index import get_text_colors, PROFILE_COVER
+from .pdf_image_cache import pdf_image_cache, draw_encoded_image, target_pixels
+from .tracing import trace_span
+
 # from .swap_face import swap_face  # Import moved inside functions that need it
 
 
@@ -66,7 +72,11 @@ def _register_unicode_font(font_path: Optional[str] = None) -> str:
     return "Helvetica"
 
 
-def _download_image_as_pil(source: str) -> Image.Image:
+def _download_image_as_pil(source: Union[str, ImageHandle]) -> Image.Image:
+    # Ảnh đã decode sẵn (ImageHandle) - dùng trực tiếp, không encode/decode lại
+    if isinstance(source, ImageHandle):
+        return source.image
+
     # Handle base64 data URL
     if source.startswith("data:image/"):
         try:
@@ -99,65 +109,16 @@ def _download_image_as_pil(source: str) -> Image.Image:
     return img
 
 
-def _image_to_base64_png(image: Image.Image) -> str:
-    buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
-    return f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
-
-
-def _convert_image_to_transparent_base64(source: str) -> str:
-    image = _download_image_as_pil(source)
-    if image.mode != "RGBA":
-        image = image.convert("RGBA")
-
-    cleaned_pixels = []
-    for pixel in image.getdata():
-        if isinstance(pixel, int):
-            pixel = (pixel, pixel, pixel, 255)
-        elif len(pixel) == 3:
-            pixel = (*pixel, 255)
-
-        r, g, b, a = pixel
-        if a > 0 and r < 10 and g < 10 and b < 10:
-            cleaned_pixels.append((r, g, b, 0))
-        else:
-            cleaned_pixels.append((r, g, b, a))
-
-    image.putdata(cleaned_pixels)
-    return _image_to_base64_png(image)
-
-
-def _analyze_background_brightness(bg_img: Image.Image, text_region_ratio: float = 0.3) -> float:
-    """
-    Analyze background brightness in the text region to determine appropriate text color.
-    Returns average brightness (0-1), where > 0.5 is bright, < 0.5 is dark.
-    """
-    width, height = bg_img.size
-
-    # Define text region (right half of the page where text will be placed)
-    text_region_width = int(width * text_region_ratio)
-    text_region_x = width - text_region_width  # Right side of page
-
-    # Crop to text region
-    text_region = bg_img.crop((text_region_x, 0, width, height))
-
-    # Convert to grayscale and calculate average brightness
-    gray_region = text_region.convert("L")
-    histogram = gray_region.histogram()
-
-    # Calculate weighted average brightness
-    total_pixels = sum(histogram)
-    if total_pixels == 0:
-        return 0.5  # Default to middle brightness
-
-    brightness_sum = sum(i * count for i, count in enumerate(histogram))
-    average_brightness = brightness_sum / (total_pixels * 255.0)  # Normalize to 0-1
-
-    return average_brightness
-
-
 def _draw_background(c: canvas.Canvas, bg_path: str, page_width: float, page_height: float):
     """Draw background image on the canvas."""
+    try:
+        # Background đã scale sẵn theo trang (cache trên đĩa), nhúng thẳng vào PDF
+        prepared = prepare_background(bg_path, FIT_CONTAIN, page_width, page_height)
+        draw_encoded_image(c, pdf_image_cache.for_file(prepared.path), prepared.x, prepared.y, prepared.width, prepared.height)
+        return
+    except Exception as e:
+        print(f"Warning: Could not use prepared background for {bg_path}, drawing original: {e}")
+
     try:
         bg_img = Image.open(bg_path)
         # Resize to fit page while maintaining aspect ratio
@@ -194,39 +155,22 @@ def _draw_image_left_half(c: canvas.Canvas, pil_img: Image.Image, page_width: fl
     x = margin + (left_half_width - new_width) / 2
     y = margin + (img_max_height - new_height) / 2
 
-    if pil_img.mode == "RGBA":
-        buffer = io.BytesIO()
-        pil_img.save(buffer, format="PNG")
-        buffer.seek(0)
-        image_reader = ImageReader(buffer)
-    else:
-        image_reader = ImageReader(pil_img)
-
-    c.drawImage(image_reader, x, y, width=new_width, height=new_height, mask='auto')
+    # Stream ảnh đã nén (kèm soft mask) được cache theo nội dung ảnh + độ phân giải đích
+    encoded = pdf_image_cache.for_image(pil_img, target_pixels(new_width, new_height))
+    draw_encoded_image(c, encoded, x, y, new_width, new_height)
 
 
 def _draw_title_center(c: canvas.Canvas, title: str, font_name: str, page_width: float, page_height: float, bg_path: Optional[str] = None):
     """Draw title text in the center of the page."""
-    # Analyze background brightness for text color
-    if bg_path:
-        try:
-            bg_img = Image.open(bg_path)
-            brightness = _analyze_background_brightness(bg_img, text_region_ratio=0.5)  # Check center region
-            text_color = "black" if brightness > 0.5 else "white"
-        except Exception:
-            text_color = "black"
-    else:
-        text_color = "black"
+    # Màu chữ theo độ sáng background (đã tính sẵn trong background index)
+    text_color = get_text_colors(bg_path, PROFILE_COVER).text_color
 
     # Set font and size for title (larger and bolder)
     title_font_size = 48
     c.setFont(font_name if font_name != "Helvetica" else "Helvetica-Bold", title_font_size)
 
     # Set text color
-    if text_color == "white":
-        c.setFillColorRGB(1, 1, 1)  # White
-    else:
-        c.setFillColorRGB(0, 0, 0)  # Black
+    c.setFillColorRGB(*text_color)
 
     # Center the title
     title_width = c.stringWidth(title, font_name if font_name != "Helvetica" else "Helvetica-Bold", title_font_size)
@@ -236,111 +180,115 @@ def _draw_title_center(c: canvas.Canvas, title: str, font_name: str, page_width:
     c.drawString(x, y, title)
 
 
-async def create_cover(
+async def prepare_cover_page(
     category_id: str,
     book_id: str,
     name: str,
     image_url: str,
-    font_path: Optional[str] = None
-) -> bytes:
+    swap_face_enabled: bool = True
+) -> Dict[str, Any]:
     """
-    Tạo cover của cuốn sách dưới dạng PDF bytes.
+    Chuẩn bị dữ liệu cho trang cover (load metadata, title, face swap character).
+    Kết quả là một page spec dùng cho draw_cover_page / book_renderer.
 
     Args:
         category_id: ID category (2 chữ số)
         book_id: ID book (2 chữ số)
         name: Tên nhân vật để thay thế vào title
         image_url: URL ảnh face để swap vào character
-        font_path: (Tùy chọn) Đường dẫn tới font TTF hiện đại
+        swap_face_enabled: False để bỏ qua face swap (phiên bản test)
 
     Returns:
-        Dữ liệu PDF của cover dưới dạng bytes
+        Dict page spec với type="cover"
     """
-    start_time = time.time()
-
     # Tạo cover ID (4 chữ số: category + book)
     cover_id = f"{category_id}{book_id}"
 
-    print(f"Creating cover for ID: {cover_id}")
+    print(f"Creating cover for ID: {cover_id}" if swap_face_enabled else f"Creating cover (TEST MODE - no swapface) for ID: {cover_id}")
 
-    # Load cover metadata
-    covers_metadata_path = Path("/app/assets/covers/covers_metadata.yaml")
+    # Load cover metadata từ catalog dùng chung
+    covers_data = catalog.covers()
 
-    # Nếu chưa có metadata, tạo mặc định
-    if not covers_metadata_path.exists():
-        print(f"Warning: Cover metadata not found at {covers_metadata_path}, using default paths")
+    # Nếu chưa có metadata, dùng đường dẫn mặc định
+    if covers_data is None:
+        print("Warning: Cover metadata not found, using default paths")
 
         # Default paths for cover assets
-        background_path = Path(f"/app/assets/covers/backgrounds/background_{cover_id}.png")
-        character_path = Path(f"/app/assets/covers/characters/character_{cover_id}.png")
-        title_file_path = Path(f"/app/assets/covers/titles/title_{cover_id}.json")
+        background_rel = f"assets/covers/backgrounds/background_{cover_id}.png"
+        character_path = f"assets/covers/characters/character_{cover_id}.png"
+        title_file = f"assets/covers/titles/title_{cover_id}.json"
     else:
-        # Load from metadata (nếu có)
-        import yaml
-        with covers_metadata_path.open("r", encoding="utf-8") as f:
-            covers_data = yaml.safe_load(f)
-
-        cover_metadata = covers_data.get("covers", {}).get(cover_id)
+        cover_metadata = covers_data.get(cover_id)
         if not cover_metadata:
             raise ValueError(f"Cover metadata not found for ID: {cover_id}")
 
-        background_path = Path(f"/app/{cover_metadata['background']}")
+        background_rel = cover_metadata['background']
         character_path = cover_metadata['character']  # Use relative path like create_content
-        title_file_path = Path(f"/app/{cover_metadata['title_file']}")
+        title_file = cover_metadata['title_file']
+
+    background_path = catalog.resolve(background_rel)
+    title_file_path = catalog.resolve(title_file)
 
     # Validate file paths
     if not background_path.exists():
         raise FileNotFoundError(f"Background file not found: {background_path}")
-    character_full_path = Path(f"/app/{character_path}")
+    character_full_path = catalog.resolve(character_path)
     if not character_full_path.exists():
         raise FileNotFoundError(f"Character file not found: {character_full_path}")
     if not title_file_path.exists():
         raise FileNotFoundError(f"Title file not found: {title_file_path}")
 
     # Load title content
-    with title_file_path.open("r", encoding="utf-8") as f:
-        title_data = json.load(f)
+    title_data = catalog.load_json(title_file)
 
     title_template = title_data.get("title", "Book Title")
     # Replace {character_name} placeholder with actual name
-    title = title_template.replace("{character_name}", name).replace("{character_name}", name)
+    title = title_template.replace("{character_name}", name).replace("{Name}", name)
 
     print(f"Loaded title: {title}")
 
-    # Face swap character (sử dụng file path trực tiếp như create_content)
-    print("Performing face swap...")
-    from .swap_face import swap_face
-    face_swap_result = await swap_face(
-        face_image_url=image_url,
-        body_image_url=str(character_path)  # Sử dụng file path trực tiếp
-    )
-
-    if face_swap_result["success"]:
-        swapped_character_url = face_swap_result["swapped_image_url"]
-        print("Face swap successful")
+    if swap_face_enabled:
+        # Face swap character (sử dụng file path trực tiếp như create_content)
+        print("Performing face swap...")
+        from .swap_face import swap_face_cached
+        face_swap_result = await swap_face_cached(
+            face_image_url=image_url,
+            body_image_url=str(character_path)  # Sử dụng file path trực tiếp
+        )
+
+        if face_swap_result["success"]:
+            swapped_character_url = face_swap_result["swapped_image_url"]
+            print("Face swap successful")
+        else:
+            print(f"Face swap failed: {face_swap_result.get('error', 'Unknown error')}")
+            swapped_character_url = str(character_path)
     else:
-        print(f"Face swap failed: {face_swap_result.get('error', 'Unknown error')}")
+        # SKIP FACE SWAP - use original character image directly
+        print("TEST MODE: Skipping face swap, using original character image")
         swapped_character_url = str(character_path)
 
-    character_image_url = _convert_image_to_transparent_base64(swapped_character_url)
+    return {
+        "type": "cover",
+        "background_path": str(background_path),
+        "character_image": await load_transparent_handle(swapped_character_url),
+        "title": title
+    }
 
-    # Chuẩn bị font hiện đại
-    font_name = _register_unicode_font(font_path)
 
-    # Thiết lập trang nằm ngang A4
-    page_width, page_height = landscape(A4)
+def draw_cover_page(c: canvas.Canvas, page: Dict[str, Any], font_name: str, page_width: float, page_height: float) -> None:
+    """
+    Vẽ trang cover lên canvas: background, character bên trái, title bên phải.
+    Không gọi showPage - caller quyết định việc kết thúc trang.
+    """
     margin = 36  # 0.5 inch
-
-    # Tạo PDF trong memory
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=(page_width, page_height))
+    title = page["title"]
 
     # Draw background
-    _draw_background(c, str(background_path), page_width, page_height)
+    _draw_background(c, page["background_path"], page_width, page_height)
 
     # Draw character (centered)
     try:
-        pil_character = _download_image_as_pil(character_image_url)
+        pil_character = _download_image_as_pil(page["character_image"])
         # For cover, place character in center-left area
         char_max_width = page_width * 0.4  # 40% of page width
         char_max_height = page_height - 2 * margin
@@ -358,17 +306,18 @@ async def create_cover(
         x = margin + (page_width * 0.4 - new_width) / 2
         y = margin + (char_max_height - new_height) / 2
 
-        c.drawImage(ImageReader(pil_character), x, y, width=new_width, height=new_height, mask='auto')
+        encoded = pdf_image_cache.for_image(pil_character, target_pixels(new_width, new_height))
+        draw_encoded_image(c, encoded, x, y, new_width, new_height)
     except Exception as e:
         print(f"Warning: Could not draw character: {e}")
 
     # Draw title (centered on right side)
     title_font_size = 48
-    c.setFont(font_name if font_name != "Helvetica" else "Helvetica-Bold", title_font_size)
+    title_font_name = font_name if font_name != "Helvetica" else "Helvetica-Bold"
+    c.setFont(title_font_name, title_font_size)
 
     # Simple title positioning - center right area
     title_x = page_width * 0.6  # Start at 60% of page width
-    title_y = page_height / 2 - title_font_size / 2
 
     # Word wrap title if too long
     max_title_width = page_width * 0.35  # 35% of page width for title
@@ -378,7 +327,7 @@ async def create_cover(
 
     for word in words:
         test_line = current_line + " " + word if current_line else word
-        if c.stringWidth(test_line, font_name if font_name != "Helvetica" else "Helvetica-Bold", title_font_size) > max_title_width:
+        if c.stringWidth(test_line, title_font_name, title_font_size) > max_title_width:
             if current_line:
                 title_lines.append(current_line)
             current_line = word
@@ -393,18 +342,43 @@ async def create_cover(
     start_y = page_height / 2 + (len(title_lines) - 1) * line_height / 2
 
     for i, line in enumerate(title_lines):
-        line_width = c.stringWidth(line, font_name if font_name != "Helvetica" else "Helvetica-Bold", title_font_size)
+        line_width = c.stringWidth(line, title_font_name, title_font_size)
         x = title_x + (max_title_width - line_width) / 2  # Center within title area
         y = start_y - i * line_height
         c.drawString(x, y, line)
 
-    c.save()
-    buffer.seek(0)
+
+async def create_cover(
+    category_id: str,
+    book_id: str,
+    name: str,
+    image_url: str,
+    font_path: Optional[str] = None
+) -> bytes:
+    """
+    Tạo cover của cuốn sách dưới dạng PDF bytes.
+
+    Args:
+        category_id: ID category (2 chữ số)
+        book_id: ID book (2 chữ số)
+        name: Tên nhân vật để thay thế vào title
+        image_url: URL ảnh face để swap vào character
+        font_path: (Tùy chọn) Đường dẫn tới font TTF hiện đại
+
+    Returns:
+        Dữ liệu PDF của cover dưới dạng bytes
+    """
+    start_time = time.time()
+
+    with trace_span("cover.prepare"):
+        page = await prepare_cover_page(category_id, book_id, name, image_url)
+    with trace_span("cover.render"):
+        pdf_bytes = await render_plan([page], font_path)
 
     processing_time = time.time() - start_time
     print(f"Cover creation completed in {processing_time:.2f} seconds")
 
-    return buffer.getvalue()
+    return pdf_bytes
 
 
 async def create_cover_test(
@@ -429,137 +403,10 @@ async def create_cover_test(
     """
     start_time = time.time()
 
-    # Tạo cover ID (4 chữ số: category + book)
-    cover_id = f"{category_id}{book_id}"
-
-    print(f"Creating cover (TEST MODE - no swapface) for ID: {cover_id}")
-
-    # Load cover metadata
-    covers_metadata_path = Path("/app/assets/covers/covers_metadata.yaml")
-
-    # Nếu chưa có metadata, tạo mặc định
-    if not covers_metadata_path.exists():
-        print(f"Warning: Cover metadata not found at {covers_metadata_path}, using default paths")
-
-        # Default paths for cover assets
-        background_path = Path(f"/app/assets/covers/backgrounds/background_{cover_id}.png")
-        character_path = Path(f"/app/assets/covers/characters/character_{cover_id}.png")
-        title_file_path = Path(f"/app/assets/covers/titles/title_{cover_id}.json")
-    else:
-        # Load from metadata (nếu có)
-        import yaml
-        with covers_metadata_path.open("r", encoding="utf-8") as f:
-            covers_data = yaml.safe_load(f)
-
-        cover_metadata = covers_data.get("covers", {}).get(cover_id)
-        if not cover_metadata:
-            raise ValueError(f"Cover metadata not found for ID: {cover_id}")
-
-        background_path = Path(f"/app/{cover_metadata['background']}")
-        character_path = cover_metadata['character']  # Use relative path like create_content
-        title_file_path = Path(f"/app/{cover_metadata['title_file']}")
-
-    # Validate file paths
-    if not background_path.exists():
-        raise FileNotFoundError(f"Background file not found: {background_path}")
-    character_full_path = Path(f"/app/{character_path}")
-    if not character_full_path.exists():
-        raise FileNotFoundError(f"Character file not found: {character_full_path}")
-    if not title_file_path.exists():
-        raise FileNotFoundError(f"Title file not found: {title_file_path}")
-
-    # Load title content
-    with title_file_path.open("r", encoding="utf-8") as f:
-        title_data = json.load(f)
-
-    title_template = title_data.get("title", "Book Title")
-    # Replace {character_name} placeholder with actual name
-    title = title_template.replace("{character_name}", name).replace("{Name}", name)
-
-    print(f"Loaded title: {title}")
-
-    # SKIP FACE SWAP - use original character image directly
-    print("TEST MODE: Skipping face swap, using original character image")
-    character_image_url = _convert_image_to_transparent_base64(str(character_path))
-
-    # Chuẩn bị font hiện đại
-    font_name = _register_unicode_font(font_path)
-
-    # Thiết lập trang nằm ngang A4
-    page_width, page_height = landscape(A4)
-    margin = 36  # 0.5 inch
-
-    # Tạo PDF trong memory
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=(page_width, page_height))
-
-    # Draw background
-    _draw_background(c, str(background_path), page_width, page_height)
-
-    # Draw character (centered)
-    try:
-        pil_character = _download_image_as_pil(character_image_url)
-        # For cover, place character in center-left area
-        char_max_width = page_width * 0.4  # 40% of page width
-        char_max_height = page_height - 2 * margin
-
-        # Resize character
-        char_ratio = pil_character.width / pil_character.height
-        if char_ratio > char_max_width / char_max_height:
-            new_width = char_max_width
-            new_height = char_max_width / char_ratio
-        else:
-            new_height = char_max_height
-            new_width = char_max_height * char_ratio
-
-        # Position character on left side
-        x = margin + (page_width * 0.4 - new_width) / 2
-        y = margin + (char_max_height - new_height) / 2
-
-        c.drawImage(ImageReader(pil_character), x, y, width=new_width, height=new_height, mask='auto')
-    except Exception as e:
-        print(f"Warning: Could not draw character: {e}")
-
-    # Draw title (centered on right side)
-    title_font_size = 48
-    c.setFont(font_name if font_name != "Helvetica" else "Helvetica-Bold", title_font_size)
-
-    # Simple title positioning - center right area
-    title_x = page_width * 0.6  # Start at 60% of page width
-    title_y = page_height / 2 - title_font_size / 2
-
-    # Word wrap title if too long
-    max_title_width = page_width * 0.35  # 35% of page width for title
-    title_lines = []
-    current_line = ""
-    words = title.split()
-
-    for word in words:
-        test_line = current_line + " " + word if current_line else word
-        if c.stringWidth(test_line, font_name if font_name != "Helvetica" else "Helvetica-Bold", title_font_size) > max_title_width:
-            if current_line:
-                title_lines.append(current_line)
-            current_line = word
-        else:
-            current_line = test_line
-
-    if current_line:
-        title_lines.append(current_line)
-
-    # Draw title lines
-    line_height = title_font_size * 1.2
-    start_y = page_height / 2 + (len(title_lines) - 1) * line_height / 2
-
-    for i, line in enumerate(title_lines):
-        line_width = c.stringWidth(line, font_name if font_name != "Helvetica" else "Helvetica-Bold", title_font_size)
-        x = title_x + (max_title_width - line_width) / 2  # Center within title area
-        y = start_y - i * line_height
-        c.drawString(x, y, line)
-
-    c.save()
-    buffer.seek(0)
+    page = await prepare_cover_page(category_id, book_id, name, image_url, swap_face_enabled=False)
+    pdf_bytes = await render_plan([page], font_path)
 
     processing_time = time.time() - start_time
     print(f"Cover creation (TEST MODE) completed in {processing_time:.2f} seconds")
 
-    return buffer.getvalue()
+    return pdf_bytes
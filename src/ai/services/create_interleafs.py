@@ -1,21 +1,29 @@
 import os
 import io
 import base64
-import json
 import time
+import asyncio
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Union
 
 import requests
 from PIL import Image
-from reportlab.lib.pagesizes import A4, landscape
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
+from reportlab.lib.colors import Color
 from reportlab.platypus import Paragraph, Frame
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
+from .image_utils import ImageHandle, load_transparent_handle
+from .catalog import catalog
+from .render_pool import render_plan
+from .asset_cache import prepare_background, FIT_CONTAIN
+from .background_index import get_text_colors, PROFILE_INTERLEAF
+from .pdf_image_cache import pdf_image_cache, draw_encoded_image, target_pixels
+from .tracing import trace_span
+
 # from .swap_face import swap_face  # Import moved inside functions that need it
 
 
@@ -66,7 +74,11 @@ def _register_unicode_font(font_path: Optional[str] = None) -> str:
     return "Helvetica"
 
 
-def _download_image_as_pil(source: str) -> Image.Image:
+def _download_image_as_pil(source: Union[str, ImageHandle]) -> Image.Image:
+    # Ảnh đã decode sẵn (ImageHandle) - dùng trực tiếp, không encode/decode lại
+    if isinstance(source, ImageHandle):
+        return source.image
+
     if source.startswith("data:image/"):
         try:
             _, base64_data = source.split(",", 1)
@@ -96,65 +108,16 @@ def _download_image_as_pil(source: str) -> Image.Image:
     return img
 
 
-def _image_to_base64_png(image: Image.Image) -> str:
-    buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
-    return f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
-
-
-def _convert_image_to_transparent_base64(source: str) -> str:
-    image = _download_image_as_pil(source)
-    if image.mode != "RGBA":
-        image = image.convert("RGBA")
-
-    cleaned_pixels = []
-    for pixel in image.getdata():
-        if isinstance(pixel, int):
-            pixel = (pixel, pixel, pixel, 255)
-        elif len(pixel) == 3:
-            pixel = (*pixel, 255)
-
-        r, g, b, a = pixel
-        if a > 0 and r < 10 and g < 10 and b < 10:
-            cleaned_pixels.append((r, g, b, 0))
-        else:
-            cleaned_pixels.append((r, g, b, a))
-
-    image.putdata(cleaned_pixels)
-    return _image_to_base64_png(image)
-
-
-def _analyze_background_brightness(bg_img: Image.Image, text_region_ratio: float = 0.3) -> float:
-    """
-    Analyze background brightness in the text region to determine appropriate text color.
-    Returns average brightness (0-1), where > 0.5 is bright, < 0.5 is dark.
-    """
-    width, height = bg_img.size
-
-    # Define text region (right half of the page where text will be placed)
-    text_region_width = int(width * text_region_ratio)
-    text_region_x = width - text_region_width  # Right side of page
-
-    # Crop to text region
-    text_region = bg_img.crop((text_region_x, 0, width, height))
-
-    # Convert to grayscale and calculate average brightness
-    gray_region = text_region.convert("L")
-    histogram = gray_region.histogram()
-
-    # Calculate weighted average brightness
-    total_pixels = sum(histogram)
-    if total_pixels == 0:
-        return 0.5  # Default to middle brightness
-
-    brightness_sum = sum(i * count for i, count in enumerate(histogram))
-    average_brightness = brightness_sum / (total_pixels * 255.0)  # Normalize to 0-1
-
-    return average_brightness
-
-
 def _draw_background(c: canvas.Canvas, bg_path: str, page_width: float, page_height: float):
     """Draw background image on the canvas."""
+    try:
+        # Background đã scale sẵn theo trang (cache trên đĩa), nhúng thẳng vào PDF
+        prepared = prepare_background(bg_path, FIT_CONTAIN, page_width, page_height)
+        draw_encoded_image(c, pdf_image_cache.for_file(prepared.path), prepared.x, prepared.y, prepared.width, prepared.height)
+        return
+    except Exception as e:
+        print(f"Warning: Could not use prepared background for {bg_path}, drawing original: {e}")
+
     try:
         bg_img = Image.open(bg_path)
         # Resize to fit page while maintaining aspect ratio
@@ -191,35 +154,18 @@ def _draw_image_left_half(c: canvas.Canvas, pil_img: Image.Image, page_width: fl
     x = margin + (left_half_width - new_width) / 2
     y = margin + (img_max_height - new_height) / 2
 
-    if pil_img.mode == "RGBA":
-        buffer = io.BytesIO()
-        pil_img.save(buffer, format="PNG")
-        buffer.seek(0)
-        image_reader = ImageReader(buffer)
-    else:
-        image_reader = ImageReader(pil_img)
-
-    c.drawImage(image_reader, x, y, width=new_width, height=new_height, mask='auto')
+    # Stream ảnh đã nén (kèm soft mask) được cache theo nội dung ảnh + độ phân giải đích
+    encoded = pdf_image_cache.for_image(pil_img, target_pixels(new_width, new_height))
+    draw_encoded_image(c, encoded, x, y, new_width, new_height)
 
 
 def _draw_text_right_half(c: canvas.Canvas, text: str, font_name: str, page_width: float, page_height: float, margin: float, gutter: float, bg_path: Optional[str] = None):
     """Draw text on the right half of the page with automatic color based on background."""
-    # Analyze background brightness for text color
-    if bg_path:
-        try:
-            bg_img = Image.open(bg_path)
-            brightness = _analyze_background_brightness(bg_img)
-            text_color = "black" if brightness > 0.5 else "white"
-        except Exception:
-            text_color = "black"
-    else:
-        text_color = "black"
+    # Màu chữ theo độ sáng background (đã tính sẵn trong background index)
+    text_color = get_text_colors(bg_path, PROFILE_INTERLEAF).text_color
 
     # Set text color
-    if text_color == "white":
-        c.setFillColorRGB(1, 1, 1)  # White
-    else:
-        c.setFillColorRGB(0, 0, 0)  # Black
+    c.setFillColorRGB(*text_color)
 
     # Calculate right half dimensions
     left_half_width = (page_width - gutter) / 2
@@ -242,7 +188,7 @@ def _draw_text_right_half(c: canvas.Canvas, text: str, font_name: str, page_widt
         leading=28,   # Line spacing
         spaceAfter=12,
         alignment=0,  # Left align
-        textColor=text_color,
+        textColor=Color(*text_color),
     )
 
     # Create frame and paragraph
@@ -251,17 +197,17 @@ def _draw_text_right_half(c: canvas.Canvas, text: str, font_name: str, page_widt
     frame.addFromList([paragraph], c)
 
 
-async def create_interleafs(
+async def prepare_interleaf_pages(
     category_id: str,
     book_id: str,
     interleaf_count: int,
     name: str,
     image_url: str,
-    font_path: Optional[str] = None
-) -> bytes:
+    swap_face_enabled: bool = True
+) -> List[Dict[str, Any]]:
     """
-    Tạo các trang interleaf dưới dạng PDF bytes.
-    Mỗi interleaf có 2 trang.
+    Chuẩn bị dữ liệu cho các trang interleaf (load metadata, quote, face swap character).
+    Mỗi interleaf có 2 trang. Kết quả là danh sách page spec dùng cho draw_interleaf_page / book_renderer.
 
     Args:
         category_id: ID category (2 chữ số)
@@ -269,27 +215,25 @@ async def create_interleafs(
         interleaf_count: Số lượng interleaf cần tạo
         name: Tên nhân vật để thay thế vào quotes
         image_url: URL ảnh face để swap vào characters
-        font_path: (Tùy chọn) Đường dẫn tới font TTF hiện đại
+        swap_face_enabled: False để bỏ qua face swap (phiên bản test)
 
     Returns:
-        Dữ liệu PDF của tất cả interleaf pages dưới dạng bytes
+        Danh sách dict page spec với type="interleaf"
     """
-    start_time = time.time()
-
-    print(f"Creating {interleaf_count} interleaf(s) for category {category_id}, book {book_id}")
+    if swap_face_enabled:
+        print(f"Creating {interleaf_count} interleaf(s) for category {category_id}, book {book_id}")
+    else:
+        print(f"Creating {interleaf_count} interleaf(s) (TEST MODE - no swapface) for category {category_id}, book {book_id}")
 
-    # Load interleaf metadata
-    interleaf_metadata_path = Path("/app/assets/interleafs/interleaf_metadata.yaml")
+    # Load interleaf metadata từ catalog dùng chung
+    interleaf_data = catalog.interleafs()
 
     # Nếu chưa có metadata, tạo mặc định
-    if not interleaf_metadata_path.exists():
-        print(f"Warning: Interleaf metadata not found at {interleaf_metadata_path}, using default paths")
+    if interleaf_data is None:
+        print("Warning: Interleaf metadata not found, using default paths")
         # Sẽ xử lý trong vòng lặp dưới đây
         has_metadata = False
     else:
-        import yaml
-        with interleaf_metadata_path.open("r", encoding="utf-8") as f:
-            interleaf_data = yaml.safe_load(f)
         has_metadata = True
 
     # Collect all interleaf pages to process
@@ -303,25 +247,26 @@ async def create_interleafs(
             interleaf_id = f"{category_id}{interleaf_order}({page_num})"
 
             if has_metadata:
-                page_metadata = interleaf_data.get("pages", {}).get(interleaf_id)
+                page_metadata = interleaf_data.get(interleaf_id)
                 if not page_metadata:
                     print(f"Warning: Interleaf metadata not found for ID: {interleaf_id}, skipping")
                     continue
 
-                background_path = Path(f"/app/{page_metadata['background']}")
+                background_path = catalog.resolve(page_metadata['background'])
                 character_path = page_metadata['character']  # Use relative path like create_content
-                quote_file_path = Path(f"/app/{page_metadata['quote_file']}")
+                quote_file = page_metadata['quote_file']
             else:
                 # Default paths - use new format
-                background_path = Path(f"/app/assets/interleafs/backgrounds/background_{interleaf_id}.png")
+                background_path = catalog.resolve(f"assets/interleafs/backgrounds/background_{interleaf_id}.png")
                 character_path = f"assets/interleafs/characters/character_{interleaf_id}.png"  # Use relative path
-                quote_file_path = Path(f"/app/assets/interleafs/quotes/quote_{interleaf_id}.json")
+                quote_file = f"assets/interleafs/quotes/quote_{interleaf_id}.json"
+            quote_file_path = catalog.resolve(quote_file)
 
             # Validate file paths
             if not background_path.exists():
                 print(f"Warning: Background file not found: {background_path}, skipping page {interleaf_id}")
                 continue
-            character_full_path = Path(f"/app/{character_path}")
+            character_full_path = catalog.resolve(character_path)
             if not character_full_path.exists():
                 print(f"Warning: Character file not found: {character_full_path}, skipping page {interleaf_id}")
                 continue
@@ -331,8 +276,7 @@ async def create_interleafs(
 
             # Load quote content
             try:
-                with quote_file_path.open("r", encoding="utf-8") as f:
-                    quote_data = json.load(f)
+                quote_data = catalog.load_json(quote_file)
 
                 quote_content = quote_data.get("quote", "")
                 if not quote_content:
@@ -358,83 +302,131 @@ async def create_interleafs(
 
     print(f"Processing {len(all_interleaf_pages)} interleaf pages")
 
-    # Process all pages
-    processed_pages = []
-
-    for page_data in all_interleaf_pages:
+    # Process all pages - face swap của các trang chạy đồng thời
+    # (scheduler dùng chung giới hạn số prediction thực sự chạy cùng lúc)
+    async def process_single_page(idx: int, page_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         interleaf_id = page_data["interleaf_id"]
         background_path = page_data["background_path"]
         character_path = page_data["character_path"]
         quote_content = page_data["quote_content"]
 
-        print(f"Processing interleaf page: {interleaf_id}")
+        if swap_face_enabled:
+            print(f"Processing interleaf page: {interleaf_id}")
 
-        # Face swap character
-        from .swap_face import swap_face
-        face_swap_result = await swap_face(
-            face_image_url=image_url,
-            body_image_url=str(character_path)
-        )
+            # Face swap character
+            from .swap_face import swap_face_cached
+            face_swap_result = await swap_face_cached(
+                face_image_url=image_url,
+                body_image_url=str(character_path)
+            )
 
-        if face_swap_result["success"]:
-            swapped_character_url = face_swap_result["swapped_image_url"]
+            if face_swap_result["success"]:
+                swapped_character_url = face_swap_result["swapped_image_url"]
+            else:
+                print(f"Face swap failed for {interleaf_id}: {face_swap_result.get('error', 'Unknown error')}")
+                swapped_character_url = str(character_path)
         else:
-            print(f"Face swap failed for {interleaf_id}: {face_swap_result.get('error', 'Unknown error')}")
+            # SKIP FACE SWAP - use original character image directly
+            print(f"TEST MODE: Skipping face swap for {interleaf_id}, using original character image")
             swapped_character_url = str(character_path)
 
-        character_image_url = _convert_image_to_transparent_base64(swapped_character_url)
-
-        processed_pages.append({
-            "background_path": background_path,
-            "character_image_url": character_image_url,
-            "quote_content": quote_content
-        })
-
-    # Chuẩn bị font hiện đại
-    font_name = _register_unicode_font(font_path)
-
-    # Thiết lập trang nằm ngang A4
-    page_width, page_height = landscape(A4)
+        # Tải ảnh (async) và tách nền (thread pool) không chặn event loop
+        try:
+            character_image = await load_transparent_handle(swapped_character_url)
+        except Exception as e:
+            if swapped_character_url == str(character_path):
+                print(f"Warning: Could not load character for {interleaf_id}, skipping page: {e}")
+                return None
+            # Giống khi face swap thất bại: dùng ảnh character gốc
+            print(f"Warning: Could not load swapped character for {interleaf_id}, using original character: {e}")
+            try:
+                character_image = await load_transparent_handle(str(character_path))
+            except Exception as e:
+                print(f"Warning: Could not load character for {interleaf_id}, skipping page: {e}")
+                return None
+
+        return {
+            "type": "interleaf",
+            "background_path": str(background_path),
+            "character_image": character_image,
+            "text": quote_content,
+            "page_label": f"Interleaf {idx}"
+        }
+
+    processed_pages = await asyncio.gather(*[
+        process_single_page(idx, page_data)
+        for idx, page_data in enumerate(all_interleaf_pages, start=1)
+    ])
+
+    # Trang lỗi bị bỏ riêng, các trang còn lại vẫn được đưa vào sách
+    pages = [page for page in processed_pages if page is not None]
+    if not pages:
+        raise ValueError("No interleaf pages could be prepared")
+    return pages
+
+
+def draw_interleaf_page(c: canvas.Canvas, page: Dict[str, Any], font_name: str, page_width: float, page_height: float) -> None:
+    """
+    Vẽ một trang interleaf lên canvas: background, character bên trái, quote bên phải, nhãn trang.
+    Không gọi showPage - caller quyết định việc kết thúc trang.
+    """
     margin = 36  # 0.5 inch
     gutter = 16  # khoảng cách giữa 2 nửa trang
 
-    # Tạo PDF trong memory
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=(page_width, page_height))
+    # Background
+    _draw_background(c, page["background_path"], page_width, page_height)
 
-    for idx, page_data in enumerate(processed_pages, start=1):
-        background_path = page_data["background_path"]
-        character_image_url = page_data["character_image_url"]
-        quote_content = page_data["quote_content"]
+    # Character bên trái
+    try:
+        pil_character = _download_image_as_pil(page["character_image"])
+        _draw_image_left_half(c, pil_character, page_width, page_height, margin, gutter)
+    except Exception as e:
+        print(f"Warning: Could not draw character for {page['page_label']}: {e}")
 
-        # Background
-        _draw_background(c, str(background_path), page_width, page_height)
+    # Quote bên phải
+    _draw_text_right_half(c, page["text"], font_name, page_width, page_height, margin, gutter, page["background_path"])
+
+    # Page number
+    c.setFont(font_name if font_name != "Helvetica" else "Helvetica", 10)
+    c.setFillGray(0.3)
+    c.drawRightString(page_width - margin, margin / 2, page["page_label"])
+    c.setFillGray(0)
 
-        # Character bên trái
-        try:
-            pil_character = _download_image_as_pil(character_image_url)
-            _draw_image_left_half(c, pil_character, page_width, page_height, margin, gutter)
-        except Exception as e:
-            print(f"Warning: Could not draw character for page {idx}: {e}")
 
-        # Quote bên phải
-        _draw_text_right_half(c, quote_content, font_name, page_width, page_height, margin, gutter, str(background_path))
+async def create_interleafs(
+    category_id: str,
+    book_id: str,
+    interleaf_count: int,
+    name: str,
+    image_url: str,
+    font_path: Optional[str] = None
+) -> bytes:
+    """
+    Tạo các trang interleaf dưới dạng PDF bytes.
+    Mỗi interleaf có 2 trang.
 
-        # Page number
-        c.setFont(font_name if font_name != "Helvetica" else "Helvetica", 10)
-        c.setFillGray(0.3)
-        c.drawRightString(page_width - margin, margin / 2, f"Interleaf {idx}")
-        c.setFillGray(0)
+    Args:
+        category_id: ID category (2 chữ số)
+        book_id: ID book (2 chữ số)
+        interleaf_count: Số lượng interleaf cần tạo
+        name: Tên nhân vật để thay thế vào quotes
+        image_url: URL ảnh face để swap vào characters
+        font_path: (Tùy chọn) Đường dẫn tới font TTF hiện đại
 
-        c.showPage()
+    Returns:
+        Dữ liệu PDF của tất cả interleaf pages dưới dạng bytes
+    """
+    start_time = time.time()
 
-    c.save()
-    buffer.seek(0)
+    with trace_span("interleafs.prepare", interleafs=interleaf_count):
+        pages = await prepare_interleaf_pages(category_id, book_id, interleaf_count, name, image_url)
+    with trace_span("interleafs.render", pages=len(pages)):
+        pdf_bytes = await render_plan(pages, font_path)
 
     processing_time = time.time() - start_time
     print(f"Interleaf creation completed in {processing_time:.2f} seconds")
 
-    return buffer.getvalue()
+    return pdf_bytes
 
 
 async def create_interleafs_test(
@@ -462,151 +454,10 @@ async def create_interleafs_test(
     """
     start_time = time.time()
 
-    print(f"Creating {interleaf_count} interleaf(s) (TEST MODE - no swapface) for category {category_id}, book {book_id}")
-
-    # Load interleaf metadata
-    interleaf_metadata_path = Path("/app/assets/interleafs/interleaf_metadata.yaml")
-
-    # Nếu chưa có metadata, tạo mặc định
-    if not interleaf_metadata_path.exists():
-        print(f"Warning: Interleaf metadata not found at {interleaf_metadata_path}, using default paths")
-        # Sẽ xử lý trong vòng lặp dưới đây
-        has_metadata = False
-    else:
-        import yaml
-        with interleaf_metadata_path.open("r", encoding="utf-8") as f:
-            interleaf_data = yaml.safe_load(f)
-        has_metadata = True
-
-    # Collect all interleaf pages to process
-    all_interleaf_pages = []
-
-    for interleaf_idx in range(1, interleaf_count + 1):
-        interleaf_order = f"{interleaf_idx:02d}"
-
-        for page_num in ["01", "02"]:
-            # New format: XXYY(AA) where XX=category_id, YY=interleaf_order, AA=page_num
-            interleaf_id = f"{category_id}{interleaf_order}({page_num})"
-
-            if has_metadata:
-                page_metadata = interleaf_data.get("pages", {}).get(interleaf_id)
-                if not page_metadata:
-                    print(f"Warning: Interleaf metadata not found for ID: {interleaf_id}, skipping")
-                    continue
-
-                background_path = Path(f"/app/{page_metadata['background']}")
-                character_path = page_metadata['character']  # Use relative path like create_content
-                quote_file_path = Path(f"/app/{page_metadata['quote_file']}")
-            else:
-                # Default paths - use new format
-                background_path = Path(f"/app/assets/interleafs/backgrounds/background_{interleaf_id}.png")
-                character_path = f"assets/interleafs/characters/character_{interleaf_id}.png"  # Use relative path
-                quote_file_path = Path(f"/app/assets/interleafs/quotes/quote_{interleaf_id}.json")
-
-            # Validate file paths
-            if not background_path.exists():
-                print(f"Warning: Background file not found: {background_path}, skipping page {interleaf_id}")
-                continue
-            character_full_path = Path(f"/app/{character_path}")
-            if not character_full_path.exists():
-                print(f"Warning: Character file not found: {character_full_path}, skipping page {interleaf_id}")
-                continue
-            if not quote_file_path.exists():
-                print(f"Warning: Quote file not found: {quote_file_path}, skipping page {interleaf_id}")
-                continue
-
-            # Load quote content
-            try:
-                with quote_file_path.open("r", encoding="utf-8") as f:
-                    quote_data = json.load(f)
-
-                quote_content = quote_data.get("quote", "")
-                if not quote_content:
-                    print(f"Warning: Empty quote content for {interleaf_id}, skipping")
-                    continue
-
-                # Replace placeholders
-                quote_content = quote_content.replace("{character_name}", name).replace("{character_name}", name)
-
-                all_interleaf_pages.append({
-                    "interleaf_id": interleaf_id,
-                    "background_path": background_path,
-                    "character_path": character_path,
-                    "quote_content": quote_content
-                })
-
-            except Exception as e:
-                print(f"Error loading quote for {interleaf_id}: {e}, skipping")
-                continue
-
-    if not all_interleaf_pages:
-        raise ValueError("No valid interleaf pages found")
-
-    print(f"Processing {len(all_interleaf_pages)} interleaf pages")
-
-    # Process all pages
-    processed_pages = []
-
-    for page_data in all_interleaf_pages:
-        interleaf_id = page_data["interleaf_id"]
-        background_path = page_data["background_path"]
-        character_path = page_data["character_path"]
-        quote_content = page_data["quote_content"]
-
-        print(f"Processing interleaf page (TEST MODE): {interleaf_id}")
-
-        # SKIP FACE SWAP - use original character image directly
-        print(f"TEST MODE: Skipping face swap for {interleaf_id}, using original character image")
-        character_image_url = _convert_image_to_transparent_base64(str(character_path))
-
-        processed_pages.append({
-            "background_path": background_path,
-            "character_image_url": character_image_url,
-            "quote_content": quote_content
-        })
-
-    # Chuẩn bị font hiện đại
-    font_name = _register_unicode_font(font_path)
-
-    # Thiết lập trang nằm ngang A4
-    page_width, page_height = landscape(A4)
-    margin = 36  # 0.5 inch
-    gutter = 16  # khoảng cách giữa 2 nửa trang
-
-    # Tạo PDF trong memory
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=(page_width, page_height))
-
-    for idx, page_data in enumerate(processed_pages, start=1):
-        background_path = page_data["background_path"]
-        character_image_url = page_data["character_image_url"]
-        quote_content = page_data["quote_content"]
-
-        # Background
-        _draw_background(c, str(background_path), page_width, page_height)
-
-        # Character bên trái
-        try:
-            pil_character = _download_image_as_pil(character_image_url)
-            _draw_image_left_half(c, pil_character, page_width, page_height, margin, gutter)
-        except Exception as e:
-            print(f"Warning: Could not draw character for page {idx}: {e}")
-
-        # Quote bên phải
-        _draw_text_right_half(c, quote_content, font_name, page_width, page_height, margin, gutter, str(background_path))
-
-        # Page number
-        c.setFont(font_name if font_name != "Helvetica" else "Helvetica", 10)
-        c.setFillGray(0.3)
-        c.drawRightString(page_width - margin, margin / 2, f"Interleaf {idx}")
-        c.setFillGray(0)
-
-        c.showPage()
-
-    c.save()
-    buffer.seek(0)
+    pages = await prepare_interleaf_pages(category_id, book_id, interleaf_count, name, image_url, swap_face_enabled=False)
+    pdf_bytes = await render_plan(pages, font_path)
 
     processing_time = time.time() - start_time
     print(f"Interleaf creation (TEST MODE) completed in {processing_time:.2f} seconds")
 
-    return buffer.getvalue()
+    return pdf_bytes
@@ -1,22 +1,11 @@
 import time
-import asyncio
-import os
 from openai import OpenAI
 import json
-import replicate
 from typing import Optional, Dict, Any
+from .single_flight import prediction_flight, make_flight_key
+from .inference_backend import predict
 
-# Replicate client will be initialized when needed
-client = None
-
-def _get_replicate_client():
-    global client
-    if client is None:
-        REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
-        if not REPLICATE_API_TOKEN:
-            raise ValueError("REPLICATE_API_TOKEN environment variable is not set")
-        client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-    return client
+AVATAR_MODEL = "black-forest-labs/flux-kontext-pro"
 
 
 async def gen_avatar(
@@ -43,17 +32,17 @@ async def gen_avatar(
         except (UnicodeDecodeError, UnicodeEncodeError):
             prompt = str(prompt)
 
-        # Run the Replicate model asynchronously using thread pool
-        loop = asyncio.get_event_loop()
-        output = await loop.run_in_executor(
-            None,
-            _get_replicate_client().run,
-            "black-forest-labs/flux-kontext-pro",
-            {
-                "prompt": prompt,
-                "input_image": image_url,
-                "output_format": output_format
-            }
+        input_params = {
+            "prompt": prompt,
+            "input_image": image_url,
+            "output_format": output_format
+        }
+
+        # Run the model on the configured inference backend through the shared scheduler (bounded concurrency, priority queue)
+        # Các lời gọi giống hệt nhau đang chạy đồng thời dùng chung một prediction
+        output = await prediction_flight.do(
+            make_flight_key(AVATAR_MODEL, input_params),
+            lambda: predict(AVATAR_MODEL, input_params)
         )
 
         # Return the URL of the generated image
@@ -66,22 +55,10 @@ async def gen_avatar(
                     return str(text)
             return text
 
-        if isinstance(output, str):
-            # Output is already a URL string
-            return ensure_utf8_string(output)
-        elif hasattr(output, 'url'):
-            url = output.url() if callable(output.url) else output.url
-            return ensure_utf8_string(url)
-        elif output and isinstance(output, list) and len(output) > 0:
-            # Try to get URL from list
-            first_item = output[0]
-            if isinstance(first_item, str):
-                return ensure_utf8_string(first_item)
-            elif hasattr(first_item, 'url'):
-                url = first_item.url() if callable(first_item.url) else first_item.url
-                return ensure_utf8_string(url)
+        if output:
+            return ensure_utf8_string(output[0])
         else:
-            print("Warning: No output URL received from Replicate")
+            print("Warning: No output URL received from inference backend")
             return None
 
     except Exception as e:
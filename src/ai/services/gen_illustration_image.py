@@ -1,22 +1,11 @@
 import time
-import asyncio
-import os
 from openai import OpenAI
 import json
-import replicate
 from typing import Optional, Dict, Any
+from .single_flight import prediction_flight, make_flight_key
+from .inference_backend import predict
 
-# Replicate client will be initialized when needed
-client = None
-
-def _get_replicate_client():
-    global client
-    if client is None:
-        REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
-        if not REPLICATE_API_TOKEN:
-            raise ValueError("REPLICATE_API_TOKEN environment variable is not set")
-        client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-    return client
+ILLUSTRATION_MODEL = "bytedance/seedream-4"
 
 
 async def gen_illustration_image(
@@ -72,9 +61,12 @@ async def gen_illustration_image(
         if image_url and image_url.strip():
             input_params["image_input"] = [image_url]
 
-        # Run the Replicate model asynchronously using thread pool
-        loop = asyncio.get_event_loop()
-        output = await loop.run_in_executor(None, _get_replicate_client().run, "bytedance/seedream-4", input_params)
+        # Run the model on the configured inference backend through the shared scheduler (bounded concurrency, priority queue)
+        # Các lời gọi giống hệt nhau đang chạy đồng thời dùng chung một prediction
+        output = await prediction_flight.do(
+            make_flight_key(ILLUSTRATION_MODEL, input_params),
+            lambda: predict(ILLUSTRATION_MODEL, input_params)
+        )
 
         # Return the URL of the generated image
         def ensure_utf8_string(text):
@@ -86,16 +78,11 @@ async def gen_illustration_image(
                     return str(text)
             return text
 
-        if output and isinstance(output, list) and len(output) > 0:
+        if output:
             # Get URL from the first output item
-            first_item = output[0]
-            if hasattr(first_item, 'url'):
-                url = first_item.url() if callable(first_item.url) else first_item.url
-                return ensure_utf8_string(url)
-            elif isinstance(first_item, str):
-                return ensure_utf8_string(first_item)
+            return ensure_utf8_string(output[0])
         else:
-            print("Warning: No output URL received from Replicate")
+            print("Warning: No output URL received from inference backend")
             return None
 
     except Exception as e:
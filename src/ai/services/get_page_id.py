@@ -1,10 +1,5 @@
-from pathlib import Path
-from typing import Dict, Any, Optional
 from fastapi import HTTPException
-import yaml
-
-
-CATALOG_METADATA_PATH = Path("/app/assets/interiors/pages_metadata.yaml")
+from .catalog import catalog, CatalogError
 
 
 def _normalize_component(value: str) -> str:
@@ -29,57 +24,14 @@ def _build_page_key(category_id: str, book_id: str, story_id: str, page_id: str)
     return f"{base_key}({page_component})"
 
 
-def _load_catalog_pages() -> Dict[str, Dict[str, Any]]:
-    if not CATALOG_METADATA_PATH.exists():
-        raise HTTPException(status_code=500, detail="Catalog metadata file not found")
+def get_page_id(category_id: str, book_id: str, story_id: str, page_id: str) -> str:
+    # Validate input trước khi tra cứu
+    _build_page_key(category_id, book_id, story_id, page_id)
 
     try:
-        with CATALOG_METADATA_PATH.open("r", encoding="utf-8") as metadata_file:
-            catalog_data = yaml.safe_load(metadata_file) or {}
-    except yaml.YAMLError as yaml_error:
-        raise HTTPException(status_code=500, detail=f"Invalid catalog metadata format: {yaml_error}")
-
-    pages = catalog_data.get("pages")
-    if not isinstance(pages, dict):
-        raise HTTPException(status_code=500, detail="Catalog metadata missing 'pages' mapping")
-
-    return pages
-
-
-def _find_page_key(pages: Dict[str, Dict[str, Any]], category_id: str, book_id: str, story_id: str, page_id: str) -> Optional[str]:
-    normalized_category = _normalize_component(category_id)
-    normalized_book = _normalize_component(book_id)
-    normalized_story = _normalize_component(story_id)
-    normalized_page = _normalize_component(page_id)
-
-    direct_key = _build_page_key(category_id, book_id, story_id, page_id)
-    if direct_key in pages:
-        return direct_key
-
-    for page_key, page_data in pages.items():
-        if not isinstance(page_data, dict):
-            continue
-
-        if (
-            str(page_data.get("category_id", "")).zfill(2) == normalized_category
-            and str(page_data.get("book_id", "")).zfill(2) == normalized_book
-            and str(page_data.get("story_id", "")).zfill(2) == normalized_story
-            and str(page_data.get("page_id", "")).zfill(2) == normalized_page
-        ):
-            return page_key
-
-    return None
-
-
-def get_page_id(category_id: str, book_id: str, story_id: str, page_id: str) -> str:
-    pages = _load_catalog_pages()
-    page_key = _find_page_key(
-        pages,
-        category_id=category_id,
-        book_id=book_id,
-        story_id=story_id,
-        page_id=page_id,
-    )
+        page_key = catalog.find_page_key(category_id, book_id, story_id, page_id)
+    except CatalogError as catalog_error:
+        raise HTTPException(status_code=500, detail=str(catalog_error))
 
     if page_key is None:
         raise HTTPException(status_code=404, detail="Page ID not found for provided identifiers")
@@ -0,0 +1,104 @@
+import os
+import time
+import asyncio
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from .tracing import trace_span, record_span
+
+
+# Cấu hình connection pool dùng chung cho mọi lần tải ảnh (Replicate output, ảnh face của khách...)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+# Số request đồng thời tối đa tới cùng một host
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "16"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+
+
+class SharedHttpClient:
+    """
+    httpx.AsyncClient dùng chung trong process: connection pooling, keep-alive,
+    giới hạn số request đồng thời theo host và timeout mặc định.
+    Client gắn với event loop đang chạy; nếu loop thay đổi (vd: script gọi asyncio.run nhiều lần) sẽ tạo client mới.
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+
+    def client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_event_loop()
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                follow_redirects=True,
+            )
+            self._loop = loop
+            self._host_limits = {}
+        return self._client
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        semaphore = self._host_limits.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(HTTP_PER_HOST_LIMIT)
+            self._host_limits[host] = semaphore
+        return semaphore
+
+    async def fetch_bytes(self, url: str, timeout: Optional[float] = None) -> bytes:
+        """
+        Tải nội dung của URL (GET) qua client dùng chung.
+
+        Args:
+            url: URL http(s)
+            timeout: (Tùy chọn) Timeout riêng cho request này, mặc định dùng HTTP_READ_TIMEOUT
+
+        Returns:
+            Nội dung response dưới dạng bytes
+
+        Raises:
+            httpx.HTTPError: Lỗi mạng, timeout hoặc status code lỗi
+        """
+        client = self.client()
+        with trace_span("image.download", host=urlsplit(url).hostname) as span:
+            queued_at = time.time()
+            async with self._host_limit(url):
+                record_span("http.host_wait", queued_at, time.time())
+                if timeout is None:
+                    response = await client.get(url)
+                else:
+                    response = await client.get(url, timeout=timeout)
+                response.raise_for_status()
+                if span is not None:
+                    span.set_tag("bytes", len(response.content))
+                return response.content
+
+    async def close(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        self._loop = None
+        self._host_limits = {}
+
+
+# Client dùng chung trong process
+http_client = SharedHttpClient()
+
+
+async def fetch_bytes(url: str, timeout: Optional[float] = None) -> bytes:
+    return await http_client.fetch_bytes(url, timeout)
+
+
+async def close_http_client() -> None:
+    """Đóng connection pool (gọi khi app shutdown)."""
+    await http_client.close()
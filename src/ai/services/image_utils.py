@@ -0,0 +1,142 @@
+import io
+import base64
+from typing import Optional, Tuple, Union
+
+from PIL import Image, ImageChops
+
+from .swap_cache import read_source_bytes_async
+from .tracing import run_in_executor_traced
+
+
+# Pixel có cả 3 kênh R, G, B nhỏ hơn ngưỡng này được coi là nền đen
+BLACK_THRESHOLD = 10
+
+
+def image_to_png_bytes(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def image_to_base64_png(image: Image.Image) -> str:
+    return f"data:image/png;base64,{base64.b64encode(image_to_png_bytes(image)).decode('utf-8')}"
+
+
+class ImageHandle:
+    """
+    Ảnh đã decode, truyền giữa các bước xử lý nội bộ (face swap -> tách nền -> vẽ PDF).
+
+    Các renderer nhận trực tiếp handle này nên không phải encode PNG + base64 rồi decode lại;
+    chỉ gọi to_data_url() ở biên HTTP khi cần trả ảnh cho client.
+
+    Khi pickle (gửi sang process render) chỉ bytes ảnh gốc đã nén được gửi đi, không gửi pixel buffer
+    đã decode; process nhận decode lại (và chuyển nền đen thành trong suốt nếu cần).
+    """
+
+    __slots__ = ("image", "source", "data", "transparent")
+
+    def __init__(
+        self,
+        image: Image.Image,
+        source: Optional[str] = None,
+        data: Optional[bytes] = None,
+        transparent: bool = False,
+    ):
+        self.image = image
+        self.source = source  # Nguồn gốc của ảnh (path/URL), dùng cho log
+        self.data = data  # Bytes ảnh gốc (PNG/JPEG...) mà image được decode từ đó
+        self.transparent = transparent  # image = make_black_transparent(decode_image(data))
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.image.size
+
+    def to_png_bytes(self) -> bytes:
+        return image_to_png_bytes(self.image)
+
+    def to_data_url(self) -> str:
+        return image_to_base64_png(self.image)
+
+    def __reduce__(self):
+        data, transparent = self.data, self.transparent
+        if data is None:
+            # Không có bytes gốc: nén nhanh pixel buffer thay vì pickle ảnh raw
+            buffer = io.BytesIO()
+            self.image.save(buffer, format="PNG", compress_level=1)
+            data, transparent = buffer.getvalue(), False
+        return (_restore_image_handle, (data, self.source, transparent))
+
+    def __repr__(self) -> str:
+        return f"ImageHandle(source={self.source!r}, mode={self.image.mode}, size={self.image.size})"
+
+
+def make_black_transparent(image: Image.Image, threshold: int = BLACK_THRESHOLD) -> Image.Image:
+    """
+    Chuyển các pixel gần đen (R, G, B đều < threshold) thành trong suốt.
+    Dùng band operation của Pillow (chạy trong C) thay vì duyệt từng pixel bằng Python.
+
+    Args:
+        image: Ảnh nguồn (mode bất kỳ, sẽ được chuyển sang RGBA)
+        threshold: Ngưỡng cho mỗi kênh màu
+
+    Returns:
+        Ảnh RGBA mới với alpha = 0 ở các pixel gần đen, các pixel khác giữ nguyên
+    """
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+
+    r, g, b, a = image.split()
+
+    # max(R, G, B) < threshold  <=>  cả 3 kênh đều < threshold
+    brightest = ImageChops.lighter(ImageChops.lighter(r, g), b)
+    black_mask = brightest.point(lambda value: 255 if value < threshold else 0)
+
+    # alpha - 255 (clamp về 0) tại pixel đen, giữ nguyên alpha ở các pixel khác
+    alpha = ImageChops.subtract(a, black_mask)
+
+    return Image.merge("RGBA", (r, g, b, alpha))
+
+
+def decode_image(data: bytes) -> Image.Image:
+    """Decode bytes ảnh, chuẩn hóa mode về RGB/RGBA (giữ transparency nếu có)."""
+    img = Image.open(io.BytesIO(data))
+    img.load()
+
+    if img.mode == "P":
+        if "transparency" in img.info:
+            img = img.convert("RGBA")
+        else:
+            img = img.convert("RGB")
+    elif img.mode == "LA":
+        img = img.convert("RGBA")
+    elif img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    return img
+
+
+def _restore_image_handle(data: bytes, source: Optional[str], transparent: bool) -> ImageHandle:
+    """Unpickle ImageHandle (trong process render): decode bytes ảnh gốc và áp dụng lại transparency."""
+    image = decode_image(data)
+    if transparent:
+        image = make_black_transparent(image)
+    return ImageHandle(image, source, data, transparent)
+
+
+async def load_image_handle(source: Union[str, ImageHandle]) -> ImageHandle:
+    """
+    Load ảnh từ URL http(s), data URL hoặc file path thành ImageHandle.
+    URL remote được tải qua HTTP client async dùng chung; đọc file và decode chạy trên thread pool.
+    """
+    if isinstance(source, ImageHandle):
+        return source
+
+    data = await read_source_bytes_async(source)
+    image = await run_in_executor_traced("image.decode", None, decode_image, data)
+    return ImageHandle(image, source, data)
+
+
+async def load_transparent_handle(source: Union[str, ImageHandle]) -> ImageHandle:
+    """Load ảnh character (đã swap) và chuyển nền đen thành trong suốt, giữ ở dạng ảnh đã decode."""
+    handle = await load_image_handle(source)
+    transparent = await run_in_executor_traced("image.transparency", None, make_black_transparent, handle.image)
+    return ImageHandle(transparent, handle.source, handle.data, transparent=True)
@@ -0,0 +1,336 @@
+import os
+import io
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from PIL import Image, ImageDraw, ImageOps
+
+from .swap_cache import PROJECT_ROOT, read_source_bytes
+from .prediction_scheduler import prediction_scheduler
+from .prediction_webhooks import prediction_inbox
+
+
+# "replicate" (mặc định) hoặc "local" (ảnh ghép tất định, không gọi mạng - dùng cho dev offline và load test)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "replicate").lower()
+# Thời gian tối đa cho một prediction (giây); quá hạn thì prediction bị hủy
+INFERENCE_TIMEOUT_SECONDS = float(os.getenv("INFERENCE_TIMEOUT_SECONDS", "300"))
+
+# Backend local: thư mục chứa ảnh kết quả và độ trễ giả lập cho mỗi prediction
+LOCAL_INFERENCE_OUTPUT_DIR = Path(os.getenv("LOCAL_INFERENCE_OUTPUT_DIR", str(PROJECT_ROOT / "cache" / "local_inference")))
+LOCAL_INFERENCE_LATENCY_SECONDS = float(os.getenv("LOCAL_INFERENCE_LATENCY_SECONDS", "0"))
+
+# Poll trạng thái prediction: bắt đầu sau REPLICATE_POLL_INITIAL_SECONDS, tăng dần tới REPLICATE_POLL_MAX_SECONDS
+REPLICATE_POLL_INITIAL_SECONDS = float(os.getenv("REPLICATE_POLL_INITIAL_SECONDS", "1"))
+REPLICATE_POLL_MAX_SECONDS = float(os.getenv("REPLICATE_POLL_MAX_SECONDS", "8"))
+REPLICATE_POLL_BACKOFF = 1.5
+
+# URL public của POST /api/v1/replicate/webhook; trống = chỉ dùng poll
+REPLICATE_WEBHOOK_URL = os.getenv("REPLICATE_WEBHOOK_URL", "")
+# Signing secret (whsec_...); trống = lấy từ API Replicate lần đầu nhận webhook
+REPLICATE_WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET", "")
+# Khi có webhook vẫn poll thưa theo chu kỳ này phòng khi webhook bị mất
+REPLICATE_WEBHOOK_POLL_SECONDS = float(os.getenv("REPLICATE_WEBHOOK_POLL_SECONDS", "30"))
+REPLICATE_WEBHOOK_TOLERANCE_SECONDS = 300
+
+_TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+
+class InferenceError(Exception):
+    """Prediction thất bại, bị hủy hoặc quá thời gian."""
+
+
+class InferenceBackendError(Exception):
+    """Backend inference không dùng được (thiếu token, cấu hình sai...)."""
+
+
+def _output_urls(output: Any) -> List[str]:
+    """Chuẩn hóa output của model (URL, FileOutput, list các URL...) thành list URL."""
+    if output is None:
+        return []
+    if isinstance(output, (list, tuple)):
+        urls = []
+        for item in output:
+            urls.extend(_output_urls(item))
+        return urls
+    if hasattr(output, "url"):
+        url = output.url() if callable(output.url) else output.url
+        return [str(url)]
+    return [str(output)]
+
+
+class ReplicateBackend:
+    """
+    Chạy model trên Replicate không chặn thread: tạo prediction (async) rồi chờ kết quả qua webhook
+    (nếu có REPLICATE_WEBHOOK_URL) hoặc poll với backoff. Hết thời gian hoặc caller bị cancel thì
+    prediction bị hủy phía Replicate.
+    """
+
+    name = "replicate"
+
+    def __init__(self, api_token: Optional[str], webhook_url: str = ""):
+        if not api_token:
+            raise InferenceBackendError("REPLICATE_API_TOKEN environment variable is not set")
+        import replicate
+
+        self._client = replicate.Client(api_token=api_token)
+        self.webhook_url = webhook_url
+        self._webhook_secret = REPLICATE_WEBHOOK_SECRET
+
+    async def _cancel(self, prediction) -> None:
+        try:
+            await prediction.async_cancel()
+        except Exception as e:
+            print(f"Warning: Could not cancel prediction {prediction.id}: {e}")
+
+    async def _wait(self, prediction, deadline: float) -> bool:
+        """Chờ prediction tới trạng thái cuối; trả về False nếu hết thời gian."""
+        # Có webhook thì poll chỉ là lưới an toàn (webhook bị mất, endpoint lỗi)
+        interval = REPLICATE_WEBHOOK_POLL_SECONDS if self.webhook_url else REPLICATE_POLL_INITIAL_SECONDS
+        max_interval = REPLICATE_WEBHOOK_POLL_SECONDS if self.webhook_url else REPLICATE_POLL_MAX_SECONDS
+
+        while prediction.status not in _TERMINAL_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.webhook_url:
+                payload = await prediction_inbox.wait(prediction.id, min(interval, remaining))
+                if payload is not None:
+                    prediction.status = payload.get("status", prediction.status)
+                    prediction.output = payload.get("output")
+                    prediction.error = payload.get("error")
+                    continue
+            else:
+                await asyncio.sleep(min(interval, remaining))
+            await prediction.async_reload()
+            interval = min(interval * REPLICATE_POLL_BACKOFF, max_interval)
+        return True
+
+    async def predict(self, model: str, inputs: Dict[str, Any], timeout: Optional[float] = None) -> List[str]:
+        """
+        Chạy model (coroutine, được scheduler await trực tiếp trên event loop - không giữ thread trong lúc chờ).
+
+        Args:
+            model: Model id dạng owner/name
+            inputs: Input của model (URL, file object, tham số)
+            timeout: Thời gian tối đa (giây), mặc định INFERENCE_TIMEOUT_SECONDS
+
+        Returns:
+            List URL ảnh kết quả
+        """
+        timeout = timeout or INFERENCE_TIMEOUT_SECONDS
+        deadline = time.monotonic() + timeout
+
+        params: Dict[str, Any] = {}
+        if self.webhook_url:
+            params = {"webhook": self.webhook_url, "webhook_events_filter": ["completed"]}
+        prediction = await self._client.models.predictions.async_create(model=model, input=inputs, **params)
+
+        try:
+            finished = await self._wait(prediction, deadline)
+        except asyncio.CancelledError:
+            # Caller không cần kết quả nữa (vd: job speculative bị hủy) - không để prediction chạy tiếp và tính tiền
+            await asyncio.shield(self._cancel(prediction))
+            raise
+        finally:
+            if self.webhook_url:
+                prediction_inbox.forget(prediction.id)
+
+        if not finished:
+            await self._cancel(prediction)
+            raise InferenceError(f"{model} prediction {prediction.id} timed out after {timeout:.0f}s")
+        if prediction.status != "succeeded":
+            raise InferenceError(f"{model} prediction {prediction.id} {prediction.status}: {prediction.error}")
+        return _output_urls(prediction.output)
+
+    async def verify_webhook(self, headers: Dict[str, str], body: str) -> None:
+        """
+        Kiểm tra chữ ký webhook của Replicate (secret lấy từ REPLICATE_WEBHOOK_SECRET hoặc từ API lần đầu cần).
+
+        Raises:
+            InferenceBackendError: Chữ ký không hợp lệ hoặc request quá cũ
+        """
+        from replicate.webhook import WebhookSigningSecret, WebhookValidationError
+
+        if not self._webhook_secret:
+            secret = await self._client.webhooks.default.async_secret()
+            self._webhook_secret = secret.key
+        try:
+            self._client.webhooks.validate(
+                headers=headers,
+                body=body,
+                secret=WebhookSigningSecret(key=self._webhook_secret),
+                tolerance=REPLICATE_WEBHOOK_TOLERANCE_SECONDS,
+            )
+        except (WebhookValidationError, ValueError) as e:
+            raise InferenceBackendError(f"Invalid Replicate webhook: {e}")
+
+
+class LocalBackend:
+    """
+    Backend offline: ảnh kết quả được ghép tất định từ input (cùng input -> cùng file), không cần token hay mạng.
+
+    - Face swap (swap_image + target_image): ảnh face cắt tròn dán lên phần đầu ảnh target
+    - Ảnh -> ảnh (input_image): ảnh input được posterize như một bản "cartoon"
+    - Text -> ảnh (prompt): gradient màu theo prompt đúng kích thước yêu cầu, ghép ảnh tham chiếu nếu có
+    """
+
+    name = "local"
+
+    def __init__(self, output_dir: Path, latency: float = 0.0):
+        self.output_dir = Path(output_dir)
+        self.latency = latency
+
+    @staticmethod
+    def _read(source: Any) -> bytes:
+        if hasattr(source, "read"):
+            # swap_face truyền file object của ảnh character local
+            data = source.read()
+            source.seek(0)
+            return data
+        return read_source_bytes(str(source))
+
+    @staticmethod
+    def _open(data: bytes) -> Image.Image:
+        with Image.open(io.BytesIO(data)) as img:
+            img.load()
+            return img.convert("RGBA")
+
+    def _output_key(self, model: str, inputs: Dict[str, Any], images: Dict[str, bytes]) -> str:
+        hasher = hashlib.sha256(model.encode("utf-8"))
+        params = {key: value for key, value in inputs.items() if key not in images}
+        hasher.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+        for key in sorted(images):
+            hasher.update(key.encode("utf-8"))
+            hasher.update(hashlib.sha256(images[key]).digest())
+        return hasher.hexdigest()
+
+    def _swap(self, face: Image.Image, target: Image.Image) -> Image.Image:
+        size = max(16, min(target.size) // 4)
+        face = ImageOps.fit(face, (size, size), Image.Resampling.LANCZOS)
+        mask = Image.new("L", (size, size), 0)
+        ImageDraw.Draw(mask).ellipse((0, 0, size - 1, size - 1), fill=255)
+        result = target.copy()
+        result.paste(face, ((target.width - size) // 2, target.height // 12), mask)
+        return result
+
+    def _stylize(self, image: Image.Image) -> Image.Image:
+        alpha = image.getchannel("A")
+        result = ImageOps.posterize(image.convert("RGB"), 3).convert("RGBA")
+        result.putalpha(alpha)
+        return result
+
+    def _illustrate(self, prompt: str, width: int, height: int, reference: Optional[Image.Image]) -> Image.Image:
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        gradient = Image.linear_gradient("L").resize((width, height))
+        result = ImageOps.colorize(gradient, tuple(digest[0:3]), tuple(digest[3:6])).convert("RGBA")
+        if reference is not None:
+            reference.thumbnail((width // 3, height // 3))
+            result.paste(reference, ((width - reference.width) // 2, (height - reference.height) // 2), reference)
+        return result
+
+    def _render(self, model: str, inputs: Dict[str, Any], images: Dict[str, bytes]) -> Image.Image:
+        if "swap_image" in images and "target_image" in images:
+            return self._swap(self._open(images["swap_image"]), self._open(images["target_image"]))
+        if "input_image" in images:
+            return self._stylize(self._open(images["input_image"]))
+
+        width, height = 1024, 1024
+        if inputs.get("size") == "custom":
+            width, height = int(inputs.get("width", width)), int(inputs.get("height", height))
+        reference = self._open(images["image_input"]) if "image_input" in images else None
+        return self._illustrate(str(inputs.get("prompt", model)), width, height, reference)
+
+    def predict(self, model: str, inputs: Dict[str, Any], timeout: Optional[float] = None) -> List[str]:
+        """Giống ReplicateBackend.predict nhưng blocking (chạy trên thread pool của scheduler), trả về list đường dẫn file ảnh local."""
+        if self.latency:
+            time.sleep(self.latency)
+
+        images = {}
+        for key in ("swap_image", "target_image", "input_image", "image_input"):
+            value = inputs.get(key)
+            if isinstance(value, (list, tuple)):
+                value = value[0] if value else None
+            if value:
+                images[key] = self._read(value)
+
+        path = self.output_dir / f"{self._output_key(model, inputs, images)}.png"
+        if not path.exists():
+            image = self._render(model, inputs, images)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            image.save(tmp_path, format="PNG")
+            os.replace(tmp_path, path)
+        return [str(path)]
+
+
+def _create_backend():
+    if INFERENCE_BACKEND == "replicate":
+        return ReplicateBackend(os.getenv("REPLICATE_API_TOKEN"), REPLICATE_WEBHOOK_URL)
+    if INFERENCE_BACKEND == "local":
+        return LocalBackend(LOCAL_INFERENCE_OUTPUT_DIR, LOCAL_INFERENCE_LATENCY_SECONDS)
+    raise InferenceBackendError(f"Unknown INFERENCE_BACKEND: {INFERENCE_BACKEND}")
+
+
+_inference_backend = None
+_inference_backend_lock = threading.Lock()
+
+
+def get_inference_backend():
+    """
+    Backend inference dùng chung trong process, tạo lần đầu khi cần (app khởi động được khi chưa có token).
+    Backend có thuộc tính name và hàm predict(model, inputs, timeout) -> list URL/đường dẫn ảnh kết quả;
+    predict là coroutine (await trên event loop) hoặc hàm blocking (chạy trên thread pool của scheduler).
+    """
+    global _inference_backend
+    if _inference_backend is None:
+        with _inference_backend_lock:
+            if _inference_backend is None:
+                _inference_backend = _create_backend()
+    return _inference_backend
+
+
+def inference_backend_name() -> str:
+    """Tên backend đang dùng (không tạo backend), vd: để tách cache kết quả giữa các backend."""
+    backend = _inference_backend
+    return backend.name if backend is not None else INFERENCE_BACKEND
+
+
+def set_inference_backend(backend) -> None:
+    """Thay backend dùng chung (vd: stand-in của benchmark)."""
+    global _inference_backend
+    with _inference_backend_lock:
+        _inference_backend = backend
+
+
+async def predict(model: str, inputs: Dict[str, Any], timeout: Optional[float] = None) -> List[str]:
+    """
+    Chạy model qua prediction scheduler (giới hạn đồng thời, priority) trên backend đang cấu hình.
+
+    Args:
+        model: Model id dạng owner/name
+        inputs: Input của model
+        timeout: Thời gian tối đa (giây), mặc định INFERENCE_TIMEOUT_SECONDS
+
+    Returns:
+        List URL (hoặc đường dẫn file với backend local) của ảnh kết quả
+    """
+    backend = get_inference_backend()
+    return await prediction_scheduler.run(model, backend.predict, model, inputs, timeout)
+
+
+async def verify_prediction_webhook(headers: Dict[str, str], body: str) -> None:
+    """
+    Kiểm tra webhook prediction trước khi chuyển cho prediction_inbox.
+
+    Raises:
+        InferenceBackendError: Backend hiện tại không nhận webhook hoặc chữ ký không hợp lệ
+    """
+    backend = get_inference_backend()
+    if not hasattr(backend, "verify_webhook"):
+        raise InferenceBackendError(f"Inference backend '{backend.name}' does not accept webhooks")
+    await backend.verify_webhook(headers, body)
@@ -1,30 +1,119 @@
+import os
+import copy
+import json
 import time
 import asyncio
-import os
-from openai import OpenAI
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
 
+import httpx
+from openai import AsyncOpenAI
 
-# === HÀM XỬ LÝ AI SCRIPT GENERATION VỚI OPENAI ===
+from .single_flight import SingleFlight, make_flight_key
+from .tracing import trace_span, record_span
 
 
-async def gen_script(type: str, name: str):
+# Model tạo script sách
+OPENAI_SCRIPT_MODEL = os.getenv("OPENAI_SCRIPT_MODEL", "gpt-4o-mini")
+# Connection pool của client OpenAI dùng chung trong mỗi worker
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "120"))
+
+# Cache script theo (theme, tên nhân vật, model, phiên bản prompt); 0 = tắt cache
+SCRIPT_CACHE_TTL_SECONDS = int(os.getenv("SCRIPT_CACHE_TTL_SECONDS", str(24 * 3600)))
+SCRIPT_CACHE_MAX_ENTRIES = int(os.getenv("SCRIPT_CACHE_MAX_ENTRIES", "1000"))
+
+# Tăng khi sửa prompt để không trả về script tạo từ prompt cũ
+SCRIPT_PROMPT_VERSION = "2"
+
+
+class SharedOpenAIClient:
     """
-    Hàm tạo nội dung sách thiếu nhi cá nhân hóa dựa trên loại được yêu cầu
-    Sử dụng OpenAI để tạo câu chuyện phù hợp với lứa tuổi trẻ em
+    AsyncOpenAI dùng chung trong process (connection pooling, keep-alive) thay vì tạo client mới mỗi lần gọi.
+    Client gắn với event loop đang chạy; nếu loop thay đổi sẽ tạo client mới.
     """
-    start_time = time.time()
 
-    # Get OpenAI API key from environment variable
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    if not openai_api_key:
-        raise ValueError("OPENAI_API_KEY environment variable is not set")
+    def __init__(self):
+        self._client: Optional[AsyncOpenAI] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
 
-    # Khởi tạo OpenAI model
-    model = OpenAI(api_key=openai_api_key)
+    def client(self) -> AsyncOpenAI:
+        loop = asyncio.get_event_loop()
+        if self._client is None or self._loop is not loop:
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise ValueError("OPENAI_API_KEY environment variable is not set")
+            self._client = AsyncOpenAI(
+                api_key=api_key,
+                timeout=OPENAI_TIMEOUT_SECONDS,
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+                    timeout=OPENAI_TIMEOUT_SECONDS,
+                ),
+            )
+            self._loop = loop
+        return self._client
 
-    try:
-        # Create prompt with simple JSON format
-        prompt = f"""
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+            self._loop = None
+
+
+class ScriptCache:
+    """Cache trong process cho script đã tạo: hết hạn theo TTL, xóa entry cũ nhất khi vượt số lượng tối đa."""
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(entry[1])
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        self._entries[key] = (time.time() + self.ttl_seconds, copy.deepcopy(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "ttl_seconds": self.ttl_seconds}
+
+
+# Client, cache và single-flight dùng chung trong process
+openai_client = SharedOpenAIClient()
+script_cache = ScriptCache(SCRIPT_CACHE_TTL_SECONDS, SCRIPT_CACHE_MAX_ENTRIES)
+script_flight = SingleFlight("script_flight")
+
+
+async def close_openai_client() -> None:
+    await openai_client.close()
+
+
+def _script_key(type: str, name: str, model: str) -> str:
+    return make_flight_key("script", type.strip().lower(), name.strip(), model, SCRIPT_PROMPT_VERSION)
+
+
+def _build_prompt(type: str, character_name: str) -> str:
+    return f"""
           Create a personalized children's book with theme: {type}.
 
           Please return JSON with the following format:
@@ -67,31 +156,54 @@ async def gen_script(type: str, name: str):
 
           """
 
+
+def _completion_params(type: str, name: str) -> Dict[str, Any]:
+    return {
+        "model": OPENAI_SCRIPT_MODEL,
+        "messages": [{"role": "user", "content": _build_prompt(type, name)}],
         # Đơn giản hóa response format
-        response_format = {"type": "json_object"}
+        "response_format": {"type": "json_object"},
+        "max_tokens": 2000,
+        "temperature": 0.8,  # Tăng creativity cho câu chuyện thiếu nhi
+    }
+
+
+def _parse_script(response_content: str) -> Dict[str, Any]:
+    # Đảm bảo response content là UTF-8
+    if isinstance(response_content, str):
+        try:
+            response_content = response_content.encode("utf-8").decode("utf-8")
+        except (UnicodeDecodeError, UnicodeEncodeError):
+            pass
+    return json.loads(response_content)
+
 
-        # Gọi OpenAI API
-        response = model.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            response_format=response_format,
-            max_tokens=2000,
-            temperature=0.8,  # Tăng creativity cho câu chuyện thiếu nhi
-        )
+async def _generate_script(key: str, type: str, name: str) -> Dict[str, Any]:
+    with trace_span("llm.script", model=OPENAI_SCRIPT_MODEL):
+        response = await openai_client.client().chat.completions.create(**_completion_params(type, name))
+    book_content = _parse_script(response.choices[0].message.content)
+    script_cache.put(key, book_content)
+    return book_content
 
-        # Parse JSON response với xử lý encoding UTF-8
-        import json
 
-        response_content = response.choices[0].message.content
+# === HÀM XỬ LÝ AI SCRIPT GENERATION VỚI OPENAI ===
 
-        # Đảm bảo response content là UTF-8
-        if isinstance(response_content, str):
-            try:
-                response_content = response_content.encode("utf-8").decode("utf-8")
-            except (UnicodeDecodeError, UnicodeEncodeError):
-                pass
 
-        book_content = json.loads(response_content)
+async def gen_script(type: str, name: str):
+    """
+    Hàm tạo nội dung sách thiếu nhi cá nhân hóa dựa trên loại được yêu cầu
+    Sử dụng OpenAI để tạo câu chuyện phù hợp với lứa tuổi trẻ em.
+    Script của cùng theme + tên nhân vật được cache (SCRIPT_CACHE_TTL_SECONDS);
+    các request giống nhau đến cùng lúc dùng chung một lần gọi API.
+    """
+    start_time = time.time()
+    key = _script_key(type, name, OPENAI_SCRIPT_MODEL)
+
+    try:
+        book_content = script_cache.get(key)
+        cache_hit = book_content is not None
+        if book_content is None:
+            book_content = copy.deepcopy(await script_flight.do(key, lambda: _generate_script(key, type, name)))
 
         processing_time = time.time() - start_time
 
@@ -99,7 +211,8 @@ async def gen_script(type: str, name: str):
             "script": book_content,
             "script_type": type,
             "processing_time": processing_time,
-            "model_used": "gpt-4o-mini",
+            "model_used": OPENAI_SCRIPT_MODEL,
+            "cache_hit": cache_hit,
             "success": True,
         }
 
@@ -111,3 +224,41 @@ async def gen_script(type: str, name: str):
             "processing_time": processing_time,
             "success": False,
         }
+
+
+async def stream_script(type: str, name: str) -> AsyncIterator[str]:
+    """
+    Phiên bản streaming của gen_script: trả về từng đoạn JSON ngay khi model sinh ra
+    (vd: để trả qua StreamingResponse). Script hoàn chỉnh được lưu vào cache như gen_script;
+    nếu đã có trong cache thì trả về toàn bộ JSON trong một đoạn.
+
+    Args:
+        type: Theme của sách
+        name: Tên nhân vật chính
+
+    Yields:
+        Các đoạn text JSON của script
+    """
+    key = _script_key(type, name, OPENAI_SCRIPT_MODEL)
+    cached = script_cache.get(key)
+    if cached is not None:
+        yield json.dumps(cached, ensure_ascii=False)
+        return
+
+    # Span được ghi sau khi stream xong (không giữ span mở qua các lần yield về cho caller)
+    started_at = time.time()
+    chunks = []
+    stream = await openai_client.client().chat.completions.create(**_completion_params(type, name), stream=True)
+    async for event in stream:
+        if not event.choices:
+            continue
+        delta = event.choices[0].delta.content
+        if delta:
+            chunks.append(delta)
+            yield delta
+    record_span("llm.script", started_at, time.time(), model=OPENAI_SCRIPT_MODEL, stream=True)
+
+    try:
+        script_cache.put(key, _parse_script("".join(chunks)))
+    except ValueError as e:
+        print(f"Warning: Streamed script is not valid JSON, not caching: {e}")
@@ -0,0 +1,217 @@
+import os
+import time
+import asyncio
+from typing import Any, List, Optional, Set, Tuple
+
+# Nhiều uvicorn worker: mỗi process ghi metric ra file trong thư mục này, /metrics gộp lại khi scrape.
+# Phải có trong environment của process TRƯỚC khi import prometheus_client (không chỉ trong .env),
+# và phải được xóa trống mỗi lần khởi động server (xem Dockerfile.prod).
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+from .tracing import route_template
+
+
+# Chỉ đo các route dưới prefix này (không đo /metrics, /health, static files)
+METRICS_ROUTE_PREFIX = os.getenv("METRICS_ROUTE_PREFIX", "/api/v1")
+# Chu kỳ lấy mẫu các gauge (queue depth, connection pool...) trong mỗi worker
+METRICS_SAMPLE_SECONDS = float(os.getenv("METRICS_SAMPLE_SECONDS", "5"))
+
+# Tạo sách mất vài phút, preview vài giây: bucket trải từ 50ms tới 10 phút
+_REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+_PREDICTION_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_PAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+_PDF_SIZE_BUCKETS = (100e3, 250e3, 500e3, 1e6, 2.5e6, 5e6, 10e6, 25e6, 50e6, 100e6)
+
+# HTTP
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Thời gian xử lý request theo route template",
+    ["method", "route", "status"], buckets=_REQUEST_BUCKETS
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "Số request đang xử lý", ["method", "route"], multiprocess_mode="livesum"
+)
+
+# Prediction (swap_face, gen_avatar, gen_illustration_image đều chạy qua prediction_scheduler)
+PREDICTION_SECONDS = Histogram(
+    "prediction_duration_seconds", "Thời gian chạy một prediction Replicate theo model",
+    ["model", "status"], buckets=_PREDICTION_BUCKETS
+)
+PREDICTION_QUEUE_SECONDS = Histogram(
+    "prediction_queue_wait_seconds", "Thời gian chờ slot của scheduler trước khi prediction được chạy",
+    ["model", "priority"], buckets=_WAIT_BUCKETS
+)
+PREDICTION_QUEUE_DEPTH = Gauge(
+    "prediction_queue_depth", "Số prediction đang chờ slot theo priority", ["priority"], multiprocess_mode="livesum"
+)
+PREDICTIONS_INFLIGHT = Gauge(
+    "predictions_inflight", "Số prediction đang chạy theo model", ["model"], multiprocess_mode="livesum"
+)
+
+# Face swap cache
+SWAP_CACHE_REQUESTS = Counter(
+    "swap_cache_requests_total", "Lượt swap_face_cached theo kết quả cache (hit, miss, bypass khi tắt cache)", ["result"]
+)
+SWAP_FACE_FAILURES = Counter("swap_face_failures_total", "Số lần face swap thất bại")
+
+# Render PDF
+RENDER_PAGE_SECONDS = Histogram(
+    "render_page_seconds", "Thời gian render trung bình một trang PDF trong process render", buckets=_PAGE_BUCKETS
+)
+RENDER_QUEUE_SECONDS = Histogram(
+    "render_queue_wait_seconds", "Thời gian chờ process render rảnh", buckets=_WAIT_BUCKETS
+)
+RENDER_POOL_PENDING = Gauge(
+    "render_pool_pending", "Số job render đang chờ hoặc đang chạy", multiprocess_mode="livesum"
+)
+PDF_SIZE_BYTES = Histogram("pdf_size_bytes", "Kích thước file PDF đã render", buckets=_PDF_SIZE_BUCKETS)
+
+# Tách nền (rembg)
+BACKGROUND_REMOVAL_BATCH_SIZE = Histogram(
+    "background_removal_batch_size", "Số ảnh trong mỗi batch tách nền", buckets=(1, 2, 3, 4, 6, 8, 12, 16)
+)
+
+# Thread pool mặc định của event loop (đọc file, hash ảnh, artifact store...)
+THREAD_POOL_QUEUE_DEPTH = Gauge(
+    "thread_pool_queue_depth", "Số tác vụ đang chờ thread trong thread pool", ["pool"], multiprocess_mode="livesum"
+)
+THREAD_POOL_THREADS = Gauge(
+    "thread_pool_threads", "Số thread đã tạo trong thread pool", ["pool"], multiprocess_mode="livesum"
+)
+
+# SQLAlchemy connection pool
+DB_POOL_CHECKOUTS = Counter("db_pool_checkouts_total", "Số lần lấy connection từ pool")
+DB_POOL_OVERFLOW_CHECKOUTS = Counter(
+    "db_pool_overflow_checkouts_total", "Số lần lấy connection khi pool đã phải mở connection overflow"
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Số connection đang được dùng", multiprocess_mode="livesum"
+)
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow", "Số connection overflow đang mở (vượt pool_size)", multiprocess_mode="livesum"
+)
+
+
+_engines: List[Any] = []
+_sampled_models: Set[str] = set()
+_sampler_task: Optional[asyncio.Task] = None
+
+
+def instrument_engine(engine) -> None:
+    """Đếm checkout/overflow của connection pool SQLAlchemy; số connection đang dùng được lấy mẫu định kỳ."""
+    from sqlalchemy import event
+
+    pool = engine.pool
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKOUTS.inc()
+        if getattr(pool, "overflow", None) and pool.overflow() > 0:
+            DB_POOL_OVERFLOW_CHECKOUTS.inc()
+
+    event.listen(engine, "checkout", on_checkout)
+    _engines.append(engine)
+
+
+async def metrics_middleware(request, call_next):
+    """Middleware HTTP: histogram thời gian xử lý và số request đang chạy theo route template."""
+    if not request.url.path.startswith(METRICS_ROUTE_PREFIX):
+        return await call_next(request)
+
+    method = request.method
+    route = route_template(request) or "unmatched"
+    in_progress = HTTP_REQUESTS_IN_PROGRESS.labels(method, route)
+    in_progress.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        in_progress.dec()
+        HTTP_REQUEST_SECONDS.labels(method, route, str(status)).observe(time.perf_counter() - start)
+
+
+def sample_gauges() -> None:
+    """Cập nhật các gauge trạng thái của worker hiện tại (gọi trên event loop)."""
+    from .prediction_scheduler import prediction_scheduler, PRIORITY_NAMES
+    from .render_pool import render_pool
+
+    stats = prediction_scheduler.stats()
+    for name in PRIORITY_NAMES.values():
+        PREDICTION_QUEUE_DEPTH.labels(name).set(stats["queued_by_priority"].get(name, 0))
+    # Model có giới hạn riêng luôn được báo cáo (kể cả khi = 0), model khác từ lần đầu có prediction chạy
+    _sampled_models.update(stats["model_limits"], stats["inflight_by_model"])
+    for model in _sampled_models:
+        PREDICTIONS_INFLIGHT.labels(model).set(stats["inflight_by_model"].get(model, 0))
+
+    RENDER_POOL_PENDING.set(render_pool.stats()["pending"])
+
+    # loop.run_in_executor(None, ...) dùng ThreadPoolExecutor mặc định của loop (tạo lần đầu khi cần)
+    try:
+        executor = getattr(asyncio.get_running_loop(), "_default_executor", None)
+    except RuntimeError:
+        executor = None
+    work_queue = getattr(executor, "_work_queue", None)
+    if work_queue is not None:
+        THREAD_POOL_QUEUE_DEPTH.labels("default").set(work_queue.qsize())
+        THREAD_POOL_THREADS.labels("default").set(len(getattr(executor, "_threads", ())))
+
+    for engine in _engines:
+        pool = engine.pool
+        if hasattr(pool, "checkedout"):
+            DB_POOL_CHECKED_OUT.set(pool.checkedout())
+            DB_POOL_OVERFLOW.set(max(0, pool.overflow()))
+
+
+async def _sample_forever() -> None:
+    while True:
+        try:
+            sample_gauges()
+        except Exception as e:
+            print(f"Warning: Could not sample metrics: {e}")
+        await asyncio.sleep(METRICS_SAMPLE_SECONDS)
+
+
+def start_metrics() -> None:
+    """Bắt đầu lấy mẫu gauge định kỳ trong worker hiện tại (gọi khi app startup)."""
+    global _sampler_task
+    if _sampler_task is None:
+        _sampler_task = asyncio.get_event_loop().create_task(_sample_forever())
+
+
+def _generate() -> bytes:
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+async def metrics_payload() -> Tuple[bytes, str]:
+    """
+    Nội dung cho endpoint /metrics: gộp metric của mọi worker nếu chạy multiprocess.
+
+    Returns:
+        (body, content type)
+    """
+    sample_gauges()
+    loop = asyncio.get_event_loop()
+    body = await loop.run_in_executor(None, _generate)
+    return body, CONTENT_TYPE_LATEST
+
+
+def shutdown_metrics() -> None:
+    """Dừng lấy mẫu và bỏ gauge của worker này khỏi kết quả gộp (gọi khi app shutdown)."""
+    global _sampler_task
+    if _sampler_task is not None:
+        _sampler_task.cancel()
+        _sampler_task = None
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
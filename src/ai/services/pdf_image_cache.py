@@ -0,0 +1,235 @@
+import os
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image
+from reportlab.pdfbase import pdfdoc, pdfutils
+from reportlab.pdfgen import canvas
+
+from .asset_cache import ASSET_CACHE_DPI
+
+
+# Dung lượng tối đa (MB) của các image stream đã encode giữ trong bộ nhớ mỗi process render
+PDF_IMAGE_CACHE_MB = int(os.getenv("PDF_IMAGE_CACHE_MB", "256"))
+# Mức nén zlib cho image stream (6 = mặc định của reportlab)
+PDF_IMAGE_COMPRESS_LEVEL = int(os.getenv("PDF_IMAGE_COMPRESS_LEVEL", "6"))
+
+_COLOR_SPACES = {"RGB": "DeviceRGB", "L": "DeviceGray", "CMYK": "DeviceCMYK"}
+
+
+class EncodedImage:
+    """
+    Image XObject đã encode sẵn để ghi thẳng vào PDF: dữ liệu stream đã nén (Flate hoặc JPEG/DCT),
+    kích thước, color space và soft mask (kênh alpha) nếu có.
+    """
+
+    __slots__ = ("name", "width", "height", "color_space", "filters", "data", "smask", "decode")
+
+    def __init__(
+        self,
+        name: str,
+        width: int,
+        height: int,
+        color_space: str,
+        filters: Tuple[str, ...],
+        data: bytes,
+        smask: Optional["EncodedImage"] = None,
+        decode: Optional[list] = None
+    ):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.color_space = color_space
+        self.filters = filters
+        self.data = data
+        self.smask = smask
+        self.decode = decode
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data) + (self.smask.nbytes if self.smask else 0)
+
+    def __repr__(self) -> str:
+        return f"EncodedImage(name={self.name[:12]!r}, size=({self.width}, {self.height}), filters={self.filters}, bytes={self.nbytes})"
+
+
+def encode_jpeg_file(path: Path, name: str) -> EncodedImage:
+    """Dùng nguyên bytes JPEG làm stream DCTDecode (không decode/encode lại)."""
+    with open(path, "rb") as f:
+        width, height, components = pdfutils.readJPEGInfo(f)[:3]
+        f.seek(0)
+        data = f.read()
+    color_space = {1: "DeviceGray", 3: "DeviceRGB"}.get(components, "DeviceCMYK")
+    decode = [1, 0, 1, 0, 1, 0, 1, 0] if color_space == "DeviceCMYK" else None
+    return EncodedImage(name, width, height, color_space, ("DCTDecode",), data, decode=decode)
+
+
+def encode_pil_image(img: Image.Image, name: str) -> EncodedImage:
+    """
+    Nén ảnh PIL thành stream FlateDecode; kênh alpha (nếu không hoàn toàn đục) thành soft mask riêng,
+    tương đương drawImage(..., mask="auto") của reportlab.
+    """
+    smask = None
+    if img.mode in ("RGBA", "LA", "P", "PA"):
+        img = img.convert("RGBA")
+        alpha = img.getchannel("A")
+        if alpha.getextrema() != (255, 255):
+            smask = EncodedImage(
+                f"{name}a", alpha.width, alpha.height, "DeviceGray", ("FlateDecode",),
+                zlib.compress(alpha.tobytes(), PDF_IMAGE_COMPRESS_LEVEL), decode=[0, 1]
+            )
+        img = img.convert("RGB")
+    elif img.mode not in _COLOR_SPACES:
+        img = img.convert("RGB")
+
+    return EncodedImage(
+        name, img.width, img.height, _COLOR_SPACES[img.mode], ("FlateDecode",),
+        zlib.compress(img.tobytes(), PDF_IMAGE_COMPRESS_LEVEL), smask=smask
+    )
+
+
+class PdfImageCache:
+    """
+    LRU trong bộ nhớ của các image stream đã encode cho asset tĩnh (background đã scale, character chưa swap...).
+
+    Key là hash nội dung (file đã content-addressed trong asset cache, hoặc pixel của ảnh) + độ phân giải đích,
+    nên cùng một asset chỉ bị nén một lần cho mọi cuốn sách render trong process.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, EncodedImage]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _get(self, key: str) -> Optional[EncodedImage]:
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+            else:
+                self._misses += 1
+            return encoded
+
+    def _put(self, key: str, encoded: EncodedImage) -> None:
+        with self._lock:
+            if key in self._entries or encoded.nbytes > self.max_bytes:
+                return
+            self._entries[key] = encoded
+            self._size += encoded.nbytes
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.nbytes
+
+    def for_file(self, path: Path) -> EncodedImage:
+        """Stream cho file ảnh trên đĩa (JPEG được nhúng nguyên vẹn), key theo path + mtime + size."""
+        path = Path(path)
+        stat = path.stat()
+        key = hashlib.md5(f"file:{path}:{stat.st_mtime_ns}:{stat.st_size}".encode("utf-8")).hexdigest()
+        encoded = self._get(key)
+        if encoded is None:
+            if path.suffix.lower() in (".jpg", ".jpeg"):
+                encoded = encode_jpeg_file(path, key)
+            else:
+                with Image.open(path) as img:
+                    encoded = encode_pil_image(img, key)
+            self._put(key, encoded)
+        return encoded
+
+    def for_image(self, img: Image.Image, target_size: Optional[Tuple[int, int]] = None) -> EncodedImage:
+        """
+        Stream cho ảnh đã decode, thu nhỏ về target_size (pixel) nếu ảnh lớn hơn.
+
+        Args:
+            img: Ảnh PIL
+            target_size: (Tùy chọn) Kích thước tối đa (pixel) theo độ phân giải đích
+
+        Returns:
+            EncodedImage
+        """
+        size = img.size
+        if target_size and (img.width > target_size[0] or img.height > target_size[1]):
+            scale = min(target_size[0] / img.width, target_size[1] / img.height)
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+
+        hasher = hashlib.md5(img.tobytes())
+        hasher.update(f"{img.mode}:{img.width}x{img.height}->{size[0]}x{size[1]}".encode("utf-8"))
+        key = hasher.hexdigest()
+
+        encoded = self._get(key)
+        if encoded is None:
+            if size != img.size:
+                img = img.resize(size, Image.Resampling.LANCZOS)
+            encoded = encode_pil_image(img, key)
+            self._put(key, encoded)
+        return encoded
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+        }
+
+
+# Cache dùng chung trong process render
+pdf_image_cache = PdfImageCache(PDF_IMAGE_CACHE_MB * 1024 * 1024)
+
+
+def target_pixels(width: float, height: float, dpi: int = ASSET_CACHE_DPI) -> Tuple[int, int]:
+    """Số pixel cần để vẽ một vùng (point) ở độ phân giải dpi."""
+    return max(1, round(width * dpi / 72.0)), max(1, round(height * dpi / 72.0))
+
+
+def _image_xobject(encoded: EncodedImage) -> pdfdoc.PDFImageXObject:
+    xobject = pdfdoc.PDFImageXObject(encoded.name)
+    xobject.width = encoded.width
+    xobject.height = encoded.height
+    xobject.bitsPerComponent = 8
+    xobject.colorSpace = encoded.color_space
+    xobject._filters = encoded.filters
+    xobject.streamContent = encoded.data
+    xobject.mask = None
+    if encoded.decode:
+        xobject._decode = encoded.decode
+    return xobject
+
+
+def draw_encoded_image(c: canvas.Canvas, encoded: EncodedImage, x: float, y: float, width: float, height: float) -> None:
+    """
+    Vẽ image stream đã encode lên canvas, giống canvas.drawImage nhưng ghi thẳng dữ liệu đã nén
+    (không nén lại, không bọc ASCII85). Mỗi ảnh chỉ được ghi một lần trong một PDF dù vẽ nhiều lần.
+    """
+    c._currentPageHasImages = 1
+
+    doc = c._doc
+    reg_name = doc.getXObjectName(encoded.name)
+    if not doc.idToObject.get(reg_name):
+        xobject = _image_xobject(encoded)
+        c._setXObjects(xobject)
+        doc.Reference(xobject, reg_name)
+        doc.addForm(encoded.name, xobject)
+        if encoded.smask is not None:
+            mask_reg_name = doc.getXObjectName(encoded.smask.name)
+            if doc.idToObject.get(mask_reg_name):
+                xobject.smask = pdfdoc.PDFObjectReference(mask_reg_name)
+            else:
+                smask = _image_xobject(encoded.smask)
+                c._setXObjects(smask)
+                xobject.smask = doc.Reference(smask, mask_reg_name)
+
+    c.saveState()
+    c.translate(x, y)
+    c.scale(width, height)
+    c._code.append(f"/{reg_name} Do")
+    c.restoreState()
+    c._formsinuse.append(encoded.name)
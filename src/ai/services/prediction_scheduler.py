@@ -0,0 +1,253 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .tracing import trace_span, record_span, run_in_executor_traced
+from .metrics import PREDICTION_SECONDS, PREDICTION_QUEUE_SECONDS
+
+
+# Priority classes - số nhỏ hơn được chạy trước
+PRIORITY_PAID = 0       # Sách của đơn hàng đã thanh toán
+PRIORITY_DEFAULT = 1
+PRIORITY_PREVIEW = 2    # Preview / thử ảnh trên frontend
+PRIORITY_SPECULATIVE = 3  # Render trước sách trong giỏ hàng (có thể bị hủy)
+
+PRIORITY_NAMES = {
+    PRIORITY_PAID: "paid",
+    PRIORITY_DEFAULT: "default",
+    PRIORITY_PREVIEW: "preview",
+    PRIORITY_SPECULATIVE: "speculative",
+}
+
+# Tổng số prediction được chạy đồng thời trong một worker
+REPLICATE_MAX_INFLIGHT = int(os.getenv("REPLICATE_MAX_INFLIGHT", "8"))
+
+# Giới hạn riêng cho từng model, dạng "owner/model=4,owner/other=2"
+REPLICATE_MODEL_LIMITS = os.getenv("REPLICATE_MODEL_LIMITS", "")
+
+# Priority của các prediction tạo ra trong context hiện tại (được copy sang các task con của asyncio.gather)
+_current_priority: ContextVar[int] = ContextVar("prediction_priority", default=PRIORITY_DEFAULT)
+# Nhóm (vd: job_id) của các prediction trong context hiện tại, để nâng priority hoặc hủy cả nhóm
+_current_group: ContextVar[Optional[str]] = ContextVar("prediction_group", default=None)
+
+
+def _parse_model_limits(raw: str) -> Dict[str, int]:
+    limits = {}
+    for item in raw.split(","):
+        item = item.strip()
+        if not item or "=" not in item:
+            continue
+        model, limit = item.rsplit("=", 1)
+        try:
+            limits[model.strip()] = max(1, int(limit))
+        except ValueError:
+            print(f"Warning: Invalid model limit '{item}' in REPLICATE_MODEL_LIMITS, ignoring")
+    return limits
+
+
+@contextmanager
+def prediction_priority(priority: int):
+    """
+    Đặt priority cho mọi prediction được gọi bên trong block (kể cả trong các task con).
+
+    Ví dụ:
+        with prediction_priority(PRIORITY_PAID):
+            pdf_bytes = await create_book(...)
+    """
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+@contextmanager
+def prediction_group(group: str):
+    """
+    Gắn nhóm cho mọi prediction được gọi bên trong block, dùng với
+    prediction_scheduler.promote() / cancel_group() (vd: job render sách speculative).
+    """
+    token = _current_group.set(group)
+    try:
+        yield
+    finally:
+        _current_group.reset(token)
+
+
+class PredictionScheduler:
+    """
+    Scheduler dùng chung cho mọi lời gọi model ra ngoài (swap_face, gen_avatar, gen_illustration_image).
+
+    - Giới hạn tổng số prediction đang chạy và giới hạn riêng theo model
+    - Hàng đợi theo priority (paid trước preview trước speculative), FIFO trong cùng priority
+    - Nâng priority hoặc hủy các prediction đang chờ của một nhóm (prediction_group)
+    - Prediction async (Replicate) được await trực tiếp trên event loop, không giữ thread trong lúc chờ;
+      lời gọi blocking (backend local) chạy trên thread pool riêng, không dùng chung default executor
+    """
+
+    def __init__(self, max_inflight: int, model_limits: Optional[Dict[str, int]] = None):
+        self.max_inflight = max(1, max_inflight)
+        self.model_limits = model_limits or {}
+        # Thread chỉ được tạo khi có lời gọi blocking (prediction async không dùng thread)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_inflight, thread_name_prefix="prediction")
+        self._inflight_total = 0
+        self._inflight_by_model: Dict[str, int] = defaultdict(int)
+        self._waiters: List[Tuple[int, int, str, asyncio.Future, Optional[str]]] = []
+        self._seq = itertools.count()
+        # Priority đã được nâng của từng nhóm (áp dụng cho cả prediction gửi sau đó)
+        self._group_priority: Dict[str, int] = {}
+
+    def _can_start(self, model: str) -> bool:
+        if self._inflight_total >= self.max_inflight:
+            return False
+        limit = self.model_limits.get(model)
+        return limit is None or self._inflight_by_model[model] < limit
+
+    def _take(self, model: str) -> None:
+        self._inflight_total += 1
+        self._inflight_by_model[model] += 1
+
+    def _release(self, model: str) -> None:
+        self._inflight_total -= 1
+        self._inflight_by_model[model] -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Cấp slot cho các waiter theo thứ tự priority; model đã đủ slot không chặn model khác."""
+        if not self._waiters:
+            return
+
+        remaining = []
+        for entry in sorted(self._waiters):
+            _, _, model, future, _ = entry
+            if future.done():
+                continue
+            if self._can_start(model):
+                self._take(model)
+                future.set_result(None)
+            else:
+                remaining.append(entry)
+
+        heapq.heapify(remaining)
+        self._waiters = remaining
+
+    async def _acquire(self, model: str, priority: int, group: Optional[str]) -> None:
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), model, future, group))
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Đã được cấp slot đúng lúc bị cancel - trả lại slot
+                self._release(model)
+            raise
+
+    async def run(self, model: str, func: Callable[..., Any], *args: Any, priority: Optional[int] = None) -> Any:
+        """
+        Chờ tới lượt theo priority rồi chạy func(*args): await nếu func là coroutine function,
+        ngược lại chạy trên thread pool của scheduler.
+
+        Args:
+            model: Tên model (dùng cho giới hạn theo model)
+            func: Coroutine function hoặc hàm blocking thực hiện prediction (vd: backend.predict)
+            args: Tham số cho func
+            priority: Priority class; mặc định lấy từ prediction_priority() của context hiện tại
+
+        Returns:
+            Kết quả của func
+        """
+        if priority is None:
+            priority = _current_priority.get()
+        group = _current_group.get()
+        if group in self._group_priority:
+            priority = min(priority, self._group_priority[group])
+
+        queued_at = time.time()
+        await self._acquire(model, priority, group)
+        wait_time = time.time() - queued_at
+        record_span("prediction.queue", queued_at, queued_at + wait_time, model=model, priority=PRIORITY_NAMES.get(priority, priority))
+        PREDICTION_QUEUE_SECONDS.labels(model, PRIORITY_NAMES.get(priority, str(priority))).observe(wait_time)
+        if wait_time > 1:
+            print(f"DEBUG scheduler: {model} ({PRIORITY_NAMES.get(priority, priority)}) waited {wait_time:.2f}s for a slot")
+
+        started_at = time.time()
+        status = "error"
+        try:
+            if asyncio.iscoroutinefunction(func):
+                with trace_span("prediction.run", model=model):
+                    result = await func(*args)
+            else:
+                result = await run_in_executor_traced("prediction.run", self._executor, func, *args, model=model)
+            status = "ok"
+            return result
+        finally:
+            PREDICTION_SECONDS.labels(model, status).observe(time.time() - started_at)
+            self._release(model)
+
+    def promote(self, group: str, priority: int) -> int:
+        """
+        Nâng priority của nhóm: các prediction đang chờ được xếp lại hàng đợi,
+        prediction gửi sau đó dùng priority mới. Trả về số prediction đang chờ đã được nâng.
+        """
+        self._group_priority[group] = min(priority, self._group_priority.get(group, priority))
+        promoted = 0
+        waiters = []
+        for entry in self._waiters:
+            entry_priority, seq, model, future, entry_group = entry
+            if entry_group == group and entry_priority > priority and not future.done():
+                entry = (priority, seq, model, future, entry_group)
+                promoted += 1
+            waiters.append(entry)
+        heapq.heapify(waiters)
+        self._waiters = waiters
+        self._dispatch()
+        return promoted
+
+    def cancel_group(self, group: str) -> int:
+        """Hủy các prediction của nhóm còn đang chờ slot (prediction đang chạy không bị ảnh hưởng)."""
+        cancelled = 0
+        for _, _, _, future, entry_group in self._waiters:
+            if entry_group == group and not future.done():
+                future.cancel()
+                cancelled += 1
+        return cancelled
+
+    def release_group(self, group: str) -> None:
+        """Quên priority đã nâng của nhóm (gọi khi job của nhóm kết thúc)."""
+        self._group_priority.pop(group, None)
+
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, _, future, _ in self._waiters if not future.done())
+
+    def stats(self) -> Dict[str, Any]:
+        """Trạng thái hiện tại của scheduler (queue depth, số prediction đang chạy)."""
+        queued_by_priority: Dict[str, int] = defaultdict(int)
+        queued_by_model: Dict[str, int] = defaultdict(int)
+        for priority, _, model, future, _ in self._waiters:
+            if future.done():
+                continue
+            queued_by_priority[PRIORITY_NAMES.get(priority, str(priority))] += 1
+            queued_by_model[model] += 1
+
+        return {
+            "max_inflight": self.max_inflight,
+            "model_limits": dict(self.model_limits),
+            "inflight": self._inflight_total,
+            "inflight_by_model": {model: count for model, count in self._inflight_by_model.items() if count},
+            "queue_depth": self.queue_depth(),
+            "queued_by_priority": dict(queued_by_priority),
+            "queued_by_model": dict(queued_by_model),
+        }
+
+
+# Scheduler dùng chung trong process
+prediction_scheduler = PredictionScheduler(REPLICATE_MAX_INFLIGHT, _parse_model_limits(REPLICATE_MODEL_LIMITS))
@@ -0,0 +1,121 @@
+import os
+import re
+import json
+import time
+import asyncio
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from .swap_cache import PROJECT_ROOT
+
+
+# Kết quả prediction nhận qua webhook được ghi ra thư mục dùng chung giữa các worker
+# (webhook có thể đến worker khác với worker đang chờ prediction)
+PREDICTION_WEBHOOK_DIR = Path(os.getenv("PREDICTION_WEBHOOK_DIR", str(PROJECT_ROOT / "runs" / "predictions")))
+# File của prediction không còn ai chờ (đã timeout, worker restart...) bị xóa sau khoảng này
+PREDICTION_WEBHOOK_TTL_SECONDS = int(os.getenv("PREDICTION_WEBHOOK_TTL_SECONDS", "3600"))
+
+# Khoảng kiểm tra file webhook do worker khác nhận (webhook đến worker này thì được báo ngay)
+_FILE_CHECK_SECONDS = 1.0
+_PURGE_INTERVAL_SECONDS = 300
+_PREDICTION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+
+class PredictionInbox:
+    """
+    Hộp nhận kết quả prediction do Replicate gửi qua webhook.
+
+    - deliver(): endpoint webhook ghi payload ra file (atomic) và đánh thức coroutine đang chờ trong worker này
+    - wait(): coroutine chờ prediction, không chiếm thread; webhook đến worker khác được phát hiện qua file
+    """
+
+    def __init__(self, directory: Path, ttl_seconds: int):
+        self.directory = Path(directory)
+        self.ttl_seconds = ttl_seconds
+        self._events: Dict[str, asyncio.Event] = {}
+        self._last_purge = 0.0
+        self.received = 0
+        self.woken = 0
+
+    def _path(self, prediction_id: str) -> Path:
+        if not _PREDICTION_ID_RE.match(prediction_id):
+            raise ValueError(f"Invalid prediction id: {prediction_id!r}")
+        return self.directory / f"{prediction_id}.json"
+
+    def _read(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(prediction_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _purge(self) -> None:
+        now = time.time()
+        if now - self._last_purge < _PURGE_INTERVAL_SECONDS:
+            return
+        self._last_purge = now
+        for path in self.directory.glob("*.json"):
+            try:
+                if now - path.stat().st_mtime > self.ttl_seconds:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def deliver(self, payload: Dict[str, Any]) -> None:
+        """
+        Lưu payload webhook (prediction object của Replicate) và báo cho coroutine đang chờ.
+
+        Args:
+            payload: JSON body của webhook, có "id" và "status"
+        """
+        prediction_id = str(payload.get("id") or "")
+        path = self._path(prediction_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self.received += 1
+
+        event = self._events.get(prediction_id)
+        if event is not None:
+            self.woken += 1
+            event.set()
+        self._purge()
+
+    async def wait(self, prediction_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """
+        Chờ webhook của prediction tối đa timeout giây.
+
+        Returns:
+            Payload webhook, hoặc None nếu chưa nhận được
+        """
+        event = self._events.setdefault(prediction_id, asyncio.Event())
+        deadline = time.monotonic() + timeout
+        while True:
+            payload = self._read(prediction_id)
+            if payload is not None:
+                return payload
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(event.wait(), min(_FILE_CHECK_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+
+    def forget(self, prediction_id: str) -> None:
+        """Bỏ theo dõi prediction đã xong và xóa file webhook của nó."""
+        self._events.pop(prediction_id, None)
+        try:
+            self._path(prediction_id).unlink()
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"waiting": len(self._events), "received": self.received, "woken": self.woken}
+
+
+# Inbox dùng chung trong process
+prediction_inbox = PredictionInbox(PREDICTION_WEBHOOK_DIR, PREDICTION_WEBHOOK_TTL_SECONDS)
@@ -1,9 +1,195 @@
-import requests
 import io
+import os
+import queue
 import base64
-from rembg import remove
+import asyncio
+import threading
+import httpx
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from typing import Optional
+from typing import Any, List, Optional, Tuple, Union
+from .http_client import fetch_bytes
+from .image_utils import image_to_png_bytes
+from .tracing import run_in_executor_traced
+from .metrics import BACKGROUND_REMOVAL_BATCH_SIZE
+
+
+# Model rembg (u2net, u2netp, isnet-general-use, bria-rmbg...); tải về ~/.u2net lần đầu sử dụng
+REMBG_MODEL = os.getenv("REMBG_MODEL", "u2net")
+# Số ONNX session (mỗi session một thread riêng) trong mỗi worker
+REMBG_POOL_SIZE = max(1, int(os.getenv("REMBG_POOL_SIZE", "1")))
+# Gom các ảnh đến cùng lúc thành một batch: tối đa REMBG_BATCH_SIZE ảnh, chờ tối đa REMBG_BATCH_WAIT_MS
+REMBG_BATCH_SIZE = max(1, int(os.getenv("REMBG_BATCH_SIZE", "4")))
+REMBG_BATCH_WAIT_MS = float(os.getenv("REMBG_BATCH_WAIT_MS", "10"))
+# Load model + chạy thử một ảnh khi app khởi động để request đầu tiên không phải chờ
+REMBG_WARMUP = os.getenv("REMBG_WARMUP", "true").lower() in ("1", "true", "yes")
+
+
+class BackgroundRemover:
+    """
+    Tách nền bằng rembg với các ONNX session dùng lại trong suốt vòng đời process.
+
+    - Session được tạo một lần (model load) và giữ trong pool, không tạo lại cho mỗi ảnh
+    - Inference chạy trên thread pool riêng (mỗi thread một session), không chặn event loop
+      và không chiếm default executor
+    - Các ảnh đến gần như cùng lúc được gom thành batch, xử lý liên tiếp trên một session
+    """
+
+    def __init__(self, model_name: str, pool_size: int, batch_size: int, batch_wait: float):
+        self.model_name = model_name
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="rembg")
+        self._sessions: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[Image.Image, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._batches = 0
+        self._images = 0
+
+    def _acquire_session(self):
+        try:
+            return self._sessions.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.pool_size
+            if create:
+                self._created += 1
+        if not create:
+            return self._sessions.get()
+
+        from rembg import new_session
+
+        try:
+            session = new_session(self.model_name)
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+        print(f"DEBUG rembg: Loaded {self.model_name} session ({self._created}/{self.pool_size})")
+        return session
+
+    def _remove_batch(self, images: List[Image.Image]) -> List[Union[bytes, Exception]]:
+        """Chạy trên thread của pool: tách nền từng ảnh trong batch bằng cùng một session, trả về PNG bytes."""
+        from rembg import remove
+
+        session = self._acquire_session()
+        try:
+            results: List[Union[bytes, Exception]] = []
+            for image in images:
+                try:
+                    results.append(image_to_png_bytes(remove(image, session=session)))
+                except Exception as e:
+                    results.append(e)
+            return results
+        finally:
+            self._sessions.put(session)
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[Image.Image, asyncio.Future]]) -> None:
+        batch = [(image, future) for image, future in batch if not future.done()]
+        if not batch:
+            return
+
+        self._batches += 1
+        self._images += len(batch)
+        BACKGROUND_REMOVAL_BATCH_SIZE.observe(len(batch))
+        try:
+            results = await run_in_executor_traced(
+                "rembg.batch", self._executor, self._remove_batch, [image for image, _ in batch], images=len(batch)
+            )
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def remove(self, image: Image.Image) -> bytes:
+        """
+        Tách nền một ảnh (được gom batch với các ảnh khác đến cùng lúc).
+
+        Args:
+            image: Ảnh đầu vào (PIL, có thể chưa decode)
+
+        Returns:
+            PNG bytes của ảnh đã tách nền
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((image, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_wait, self._flush)
+        return await future
+
+    def _warm_up_sync(self) -> None:
+        sample = Image.new("RGB", (64, 64), (255, 255, 255))
+        sessions = [self._acquire_session() for _ in range(self.pool_size)]
+        try:
+            from rembg import remove
+
+            for session in sessions:
+                remove(sample, session=session)
+        finally:
+            for session in sessions:
+                self._sessions.put(session)
+
+    async def warm_up(self) -> None:
+        """Tạo đủ session của pool và chạy thử một ảnh nhỏ (không chặn event loop; lỗi chỉ được log)."""
+        try:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self._executor, self._warm_up_sync)
+            print(f"✓ rembg: {self.pool_size} {self.model_name} session(s) ready")
+        except Exception as e:
+            print(f"Warning: rembg warm-up failed, sessions will be created on first use: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model_name,
+            "pool_size": self.pool_size,
+            "sessions": self._created,
+            "batches": self._batches,
+            "images": self._images,
+            "avg_batch_size": round(self._images / self._batches, 2) if self._batches else 0.0,
+            "pending": len(self._pending),
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Pool session dùng chung trong process (mỗi uvicorn worker có pool riêng)
+background_remover = BackgroundRemover(REMBG_MODEL, REMBG_POOL_SIZE, REMBG_BATCH_SIZE, REMBG_BATCH_WAIT_MS / 1000)
+
+
+_warm_up_task: Optional[asyncio.Task] = None
+
+
+def warm_up_background_remover() -> None:
+    """Warm-up session pool ở nền (gọi khi app startup, không làm chậm khởi động)."""
+    global _warm_up_task
+    if REMBG_WARMUP and _warm_up_task is None:
+        _warm_up_task = asyncio.get_event_loop().create_task(background_remover.warm_up())
+
+
+def shutdown_background_remover() -> None:
+    background_remover.shutdown()
 
 
 async def remove_background(image_url: str) -> Optional[str]:
@@ -27,11 +213,10 @@ async def remove_background(image_url: str) -> Optional[str]:
         # Step 2: Load image from URL or file path
         print("Step 2: Loading image...")
         if image_url.startswith(('http://', 'https://')):
-            # Load from URL
-            response = requests.get(image_url, timeout=30)
-            response.raise_for_status()
-            print(f"Downloaded image from URL, size: {len(response.content)} bytes")
-            input_img = Image.open(io.BytesIO(response.content))
+            # Load from URL (HTTP client async dùng chung, không chặn event loop)
+            image_bytes = await fetch_bytes(image_url)
+            print(f"Downloaded image from URL, size: {len(image_bytes)} bytes")
+            input_img = Image.open(io.BytesIO(image_bytes))
         else:
             # Load from file path
             print(f"Loading image from file path: {image_url}")
@@ -40,17 +225,10 @@ async def remove_background(image_url: str) -> Optional[str]:
 
         print(f"Image opened successfully, format: {input_img.format}, size: {input_img.size}")
 
-        # Step 3: Remove background
+        # Step 3: Remove background (session pool dùng chung, decode + inference + encode PNG trên thread của pool)
         print("Step 3: Removing background...")
-        output_img = remove(input_img)
-        print("Background removed successfully")
-
-        # Step 4: Convert to bytes
-        print("Step 4: Converting to PNG bytes...")
-        output_buffer = io.BytesIO()
-        output_img.save(output_buffer, format='PNG')
-        output_bytes = output_buffer.getvalue()
-        print(f"Converted to PNG, size: {len(output_bytes)} bytes")
+        output_bytes = await background_remover.remove(input_img)
+        print(f"Background removed successfully, PNG size: {len(output_bytes)} bytes")
 
         # Convert to base64 data URL for direct viewing
         base64_data = base64.b64encode(output_bytes).decode('utf-8')
@@ -59,7 +237,7 @@ async def remove_background(image_url: str) -> Optional[str]:
 
         return data_url
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Network error: {str(e)}")
         return None
     except Image.UnidentifiedImageError as e:
@@ -69,4 +247,4 @@ async def remove_background(image_url: str) -> Optional[str]:
         print(f"Unexpected error: {str(e)}")
         import traceback
         traceback.print_exc()
-        return None
\ No newline at end of file
+        return None
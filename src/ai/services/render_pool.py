@@ -0,0 +1,160 @@
+import os
+import time
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+from .tracing import record_span
+from .metrics import RENDER_PAGE_SECONDS, RENDER_QUEUE_SECONDS, PDF_SIZE_BYTES
+
+
+# Số process render PDF trong mỗi worker; 0 = render trên thread pool của process hiện tại
+RENDER_POOL_SIZE = int(os.getenv("RENDER_POOL_SIZE", str(min(4, os.cpu_count() or 1))))
+# "spawn" an toàn với event loop + thread của uvicorn; "fork" khởi động nhanh hơn
+RENDER_POOL_START_METHOD = os.getenv("RENDER_POOL_START_METHOD", "spawn")
+
+# Log khi một job phải chờ process rảnh lâu hơn ngưỡng này (giây)
+RENDER_QUEUE_WARN_SECONDS = 1.0
+
+
+def _render_in_worker(plan: List[Dict[str, Any]], font_path: Optional[str], submitted_at: float) -> Tuple[bytes, float, float]:
+    """
+    Chạy trong process của pool: vẽ page plan thành PDF.
+    Trả về (pdf_bytes, queue_wait, render_time) để process chính đo thời gian chờ.
+    """
+    # Import trong hàm: book_renderer import các module create_* (các module này lại dùng render_pool)
+    from .book_renderer import render_book
+
+    started_at = time.time()
+    pdf_bytes = render_book(plan, font_path)
+    return pdf_bytes, started_at - submitted_at, time.time() - started_at
+
+
+class RenderPool:
+    """
+    Pool process để render PDF (reportlab, decode/resize ảnh, canvas.save) ngoài event loop.
+    Input là page plan (list dict picklable: path, text, ImageHandle - gửi dưới dạng bytes ảnh đã nén),
+    output là PDF bytes.
+    """
+
+    def __init__(self, size: int, start_method: str):
+        self.size = max(0, size)
+        self.start_method = start_method
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_wait = 0.0
+        self._total_render = 0.0
+        self._restarts = 0
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        if self.size == 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.size,
+                    mp_context=multiprocessing.get_context(self.start_method)
+                )
+            return self._executor
+
+    def _reset_executor(self, broken: ProcessPoolExecutor) -> None:
+        """Bỏ executor đã hỏng (process render bị kill/crash) để lần gọi sau tạo pool mới."""
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    async def render(self, plan: List[Dict[str, Any]], font_path: Optional[str] = None) -> bytes:
+        """
+        Render page plan thành PDF bytes trên process pool.
+
+        Args:
+            plan: Danh sách page spec (xem book_renderer.build_book_plan)
+            font_path: (Tùy chọn) Đường dẫn tới font TTF hiện đại
+
+        Returns:
+            Dữ liệu PDF dưới dạng bytes
+        """
+        loop = asyncio.get_event_loop()
+        executor = self._get_executor()
+        self._submitted += 1
+
+        submitted_at = time.time()
+        try:
+            try:
+                pdf_bytes, queue_wait, render_time = await loop.run_in_executor(
+                    executor, _render_in_worker, plan, font_path, submitted_at
+                )
+            except BrokenProcessPool:
+                # Một process render chết (OOM, crash trong reportlab/Pillow): tạo lại pool và thử lại một lần
+                print("Warning: Render process pool is broken, restarting it and retrying the job")
+                self._restarts += 1
+                self._reset_executor(executor)
+                pdf_bytes, queue_wait, render_time = await loop.run_in_executor(
+                    self._get_executor(), _render_in_worker, plan, font_path, submitted_at
+                )
+        except Exception:
+            self._failed += 1
+            raise
+        finally:
+            self._completed += 1
+
+        # Thời gian đo trong process render: chờ process rảnh, rồi vẽ + lưu PDF
+        record_span("render.queue", submitted_at, submitted_at + queue_wait)
+        record_span("render.pdf", submitted_at + queue_wait, submitted_at + queue_wait + render_time, bytes=len(pdf_bytes))
+        RENDER_QUEUE_SECONDS.observe(queue_wait)
+        RENDER_PAGE_SECONDS.observe(render_time / max(1, len(plan)))
+        PDF_SIZE_BYTES.observe(len(pdf_bytes))
+
+        self._last_wait = queue_wait
+        self._total_wait += queue_wait
+        self._max_wait = max(self._max_wait, queue_wait)
+        self._total_render += render_time
+
+        if queue_wait > RENDER_QUEUE_WARN_SECONDS:
+            print(f"DEBUG render_pool: {len(plan)}-page job waited {queue_wait:.2f}s for a render process")
+        print(f"DEBUG render_pool: Rendered {len(plan)} page(s) in {render_time:.2f}s ({len(pdf_bytes)} bytes)")
+        return pdf_bytes
+
+    def stats(self) -> Dict[str, Any]:
+        """Thống kê của pool: số job, số job đang chờ/chạy, thời gian chờ trong hàng đợi."""
+        succeeded = self._completed - self._failed
+        return {
+            "size": self.size,
+            "start_method": self.start_method if self.size else "thread",
+            "submitted": self._submitted,
+            "pending": self._submitted - self._completed,
+            "completed": self._completed,
+            "failed": self._failed,
+            "restarts": self._restarts,
+            "queue_wait_last": round(self._last_wait, 4),
+            "queue_wait_avg": round(self._total_wait / succeeded, 4) if succeeded else 0.0,
+            "queue_wait_max": round(self._max_wait, 4),
+            "render_time_avg": round(self._total_render / succeeded, 4) if succeeded else 0.0,
+        }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+# Pool dùng chung trong process (mỗi uvicorn worker có pool riêng)
+render_pool = RenderPool(RENDER_POOL_SIZE, RENDER_POOL_START_METHOD)
+
+
+async def render_plan(plan: List[Dict[str, Any]], font_path: Optional[str] = None) -> bytes:
+    return await render_pool.render(plan, font_path)
+
+
+def shutdown_render_pool() -> None:
+    render_pool.shutdown()
@@ -0,0 +1,70 @@
+import json
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict
+
+
+def make_flight_key(*parts: Any) -> str:
+    """Tạo key ổn định từ model + input params để nhận diện các prediction giống hệt nhau."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi async giống hệt nhau đang chạy đồng thời thành một lời gọi duy nhất.
+
+    Coroutine đầu tiên với một key sẽ khởi chạy công việc; các coroutine đến sau với cùng key
+    sẽ chờ và nhận cùng kết quả (hoặc cùng exception). Key được xóa ngay khi công việc kết thúc,
+    nên đây không phải là cache - lần gọi tiếp theo sẽ chạy lại. Một caller bị cancel không ảnh hưởng
+    các caller khác; khi caller cuối cùng bị cancel thì công việc chung cũng bị hủy.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Số caller đang chờ mỗi công việc chung; về 0 thì công việc bị hủy
+        self._waiters: Dict[asyncio.Future, int] = {}
+
+    async def do(self, key: str, work: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._inflight.get(key)
+        if future is None or future.done():
+            future = asyncio.ensure_future(work())
+            self._inflight[key] = future
+            self._waiters[future] = 0
+
+            def _forget(done: asyncio.Future, key: str = key) -> None:
+                self._waiters.pop(done, None)
+                if self._inflight.get(key) is done:
+                    del self._inflight[key]
+
+            future.add_done_callback(_forget)
+        else:
+            print(f"DEBUG {self.name}: Joining in-flight call {key[:24]}")
+
+        self._waiters[future] += 1
+        # shield: một caller bị cancel không làm hủy prediction của các caller còn lại
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Công việc chung bị hủy (vd: prediction speculative bị cancel_group) trong khi caller này
+            # không bị hủy: chạy lại với context của caller thay vì trả CancelledError
+            if future.cancelled() and not asyncio.current_task().cancelling():
+                print(f"DEBUG {self.name}: In-flight call {key[:24]} was cancelled, retrying")
+                return await self.do(key, work)
+            raise
+        finally:
+            remaining = self._waiters.get(future)
+            if remaining is not None:
+                self._waiters[future] = remaining - 1
+                if remaining == 1 and not future.done():
+                    # Caller cuối cùng đã bỏ đi: hủy công việc chung để backend hủy prediction phía Replicate
+                    print(f"DEBUG {self.name}: Last waiter left in-flight call {key[:24]}, cancelling it")
+                    future.cancel()
+
+    def inflight_count(self) -> int:
+        return len(self._inflight)
+
+
+# Single-flight dùng chung cho các prediction Replicate (swap_face, gen_avatar, gen_illustration_image)
+prediction_flight = SingleFlight("prediction_flight")
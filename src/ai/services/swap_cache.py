@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import base64
+import hashlib
+import threading
+from pathlib import Path
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, Tuple
+
+import requests
+
+from .http_client import fetch_bytes
+from .tracing import run_in_executor_traced
+
+
+# Thư mục gốc của project (/app trong Docker)
+PROJECT_ROOT = Path(__file__).resolve().parents[3]
+
+# Cấu hình cache qua biến môi trường
+SWAP_CACHE_ENABLED = os.getenv("SWAP_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+SWAP_CACHE_DIR = Path(os.getenv("SWAP_CACHE_DIR", str(PROJECT_ROOT / "cache" / "swap_face")))
+SWAP_CACHE_MAX_MB = int(os.getenv("SWAP_CACHE_MAX_MB", "2048"))
+
+# Digest của ảnh remote (ảnh face của khách) được nhớ tạm để không phải tải lại cho mỗi trang
+REMOTE_DIGEST_TTL_SECONDS = 600
+
+# Thời gian tối đa chờ worker khác đang swap cùng key trước khi tự chạy
+KEY_LOCK_TIMEOUT_SECONDS = 300
+KEY_LOCK_POLL_SECONDS = 0.5
+
+
+def resolve_project_path(source: str) -> Path:
+    """Resolve đường dẫn tương đối (vd: assets/...) theo thư mục gốc project."""
+    path = Path(source)
+    if path.is_absolute():
+        return path
+    return PROJECT_ROOT / path
+
+
+def read_source_bytes(source: str) -> bytes:
+    """
+    Đọc bytes của ảnh từ URL, base64 data URL hoặc file path local.
+
+    Args:
+        source: URL http(s), data URL hoặc đường dẫn file
+
+    Returns:
+        Nội dung ảnh dưới dạng bytes
+    """
+    if source.startswith("data:"):
+        _, base64_data = source.split(",", 1)
+        return base64.b64decode(base64_data)
+
+    if source.startswith(("http://", "https://")):
+        response = requests.get(source, timeout=30)
+        response.raise_for_status()
+        return response.content
+
+    full_path = resolve_project_path(source)
+    if not full_path.is_file():
+        raise FileNotFoundError(f"File not found: {full_path}")
+    return full_path.read_bytes()
+
+
+async def read_source_bytes_async(source: str) -> bytes:
+    """
+    Phiên bản async của read_source_bytes: URL http(s) được tải qua HTTP client dùng chung,
+    data URL / file local được đọc trên thread pool.
+    """
+    if source.startswith(("http://", "https://")):
+        return await fetch_bytes(source)
+    return await run_in_executor_traced("image.read", None, read_source_bytes, source)
+
+
+class SwapResultCache:
+    """
+    Cache trên đĩa cho kết quả face swap, địa chỉ hóa theo nội dung.
+
+    Key là SHA-256 của bytes ảnh face + bytes ảnh character + tham số model.
+    Giá trị là bytes ảnh đã swap (không lưu URL Replicate vì URL sẽ hết hạn).
+    Khi tổng dung lượng vượt giới hạn, các file ít được dùng gần đây nhất bị xóa (LRU theo mtime).
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._approx_size: Optional[int] = None
+        self._local_digests: Dict[Tuple[str, int, int], str] = {}
+        self._remote_digests: Dict[str, Tuple[str, float]] = {}
+
+    def _path_for(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.png"
+
+    def source_digest(self, source: str) -> str:
+        """
+        Trả về SHA-256 của nội dung ảnh nguồn.
+        File local được nhớ theo (path, mtime, size); URL remote được nhớ trong thời gian ngắn.
+        """
+        if source.startswith(("http://", "https://")):
+            cached = self._remote_digests.get(source)
+            if cached and time.time() - cached[1] < REMOTE_DIGEST_TTL_SECONDS:
+                return cached[0]
+            digest = hashlib.sha256(read_source_bytes(source)).hexdigest()
+            self._remote_digests[source] = (digest, time.time())
+            return digest
+
+        if source.startswith("data:"):
+            return hashlib.sha256(read_source_bytes(source)).hexdigest()
+
+        full_path = resolve_project_path(source)
+        stat = full_path.stat()
+        memo_key = (str(full_path), stat.st_mtime_ns, stat.st_size)
+        digest = self._local_digests.get(memo_key)
+        if digest is None:
+            digest = hashlib.sha256(full_path.read_bytes()).hexdigest()
+            self._local_digests[memo_key] = digest
+        return digest
+
+    def build_key(self, face_source: str, character_source: str, model: str, params: Dict[str, Any]) -> str:
+        """Tạo cache key từ nội dung ảnh face, ảnh character và tham số model."""
+        hasher = hashlib.sha256()
+        hasher.update(self.source_digest(face_source).encode("utf-8"))
+        hasher.update(self.source_digest(character_source).encode("utf-8"))
+        hasher.update(model.encode("utf-8"))
+        hasher.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> Optional[Path]:
+        """Trả về đường dẫn file đã cache (và đánh dấu vừa được dùng), hoặc None."""
+        path = self._path_for(key)
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            return None
+        return path
+
+    @asynccontextmanager
+    async def key_lock(self, key: str):
+        """
+        Khóa theo key dùng chung giữa các worker (flock trên file .lock cạnh file cache),
+        để hai worker xử lý cùng một khách hàng không cùng gọi Replicate cho một cặp (face, character).
+        Nếu chờ quá KEY_LOCK_TIMEOUT_SECONDS thì tiếp tục mà không giữ khóa.
+        """
+        lock_path = self._path_for(key).with_suffix(".lock")
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+        locked = False
+        try:
+            deadline = time.monotonic() + KEY_LOCK_TIMEOUT_SECONDS
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        print(f"DEBUG swap_cache: Timed out waiting for lock {key[:12]}, continuing without it")
+                        break
+                    await asyncio.sleep(KEY_LOCK_POLL_SECONDS)
+            yield
+        finally:
+            if locked:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def put(self, key: str, data: bytes) -> Path:
+        """Ghi bytes ảnh vào cache (atomic) và evict nếu vượt dung lượng."""
+        path = self._path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._approx_size is None:
+                self._approx_size = self._scan_size()
+            else:
+                self._approx_size += len(data)
+            if self._approx_size > self.max_bytes:
+                self._evict()
+
+        return path
+
+    def _scan_size(self) -> int:
+        total = 0
+        for entry in self.cache_dir.glob("*/*.png"):
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                continue
+        return total
+
+    def _evict(self) -> None:
+        """Xóa các file cũ nhất cho tới khi còn ~90% giới hạn dung lượng."""
+        entries = []
+        for entry in self.cache_dir.glob("*/*.png"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+
+        entries.sort(key=lambda item: item[0])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+
+        removed = 0
+        for _, size, entry in entries:
+            if total <= target:
+                break
+            try:
+                entry.unlink()
+                total -= size
+                removed += 1
+            except FileNotFoundError:
+                continue
+            try:
+                entry.with_suffix(".lock").unlink()
+            except FileNotFoundError:
+                pass
+
+        self._approx_size = total
+        if removed:
+            print(f"DEBUG swap_cache: Evicted {removed} file(s), cache size now {total / (1024 * 1024):.1f} MB")
+
+
+# Cache dùng chung trong process
+_swap_cache: Optional[SwapResultCache] = None
+
+
+def get_swap_cache() -> Optional[SwapResultCache]:
+    """Trả về cache dùng chung, hoặc None nếu cache bị tắt qua SWAP_CACHE_ENABLED."""
+    global _swap_cache
+    if not SWAP_CACHE_ENABLED:
+        return None
+    if _swap_cache is None:
+        _swap_cache = SwapResultCache(SWAP_CACHE_DIR, SWAP_CACHE_MAX_MB * 1024 * 1024)
+    return _swap_cache
@@ -1,20 +1,23 @@
 import time
-import asyncio
-import os
 import base64
 import requests
 from pathlib import Path
 from typing import Dict, Any
-import replicate
+from .swap_cache import get_swap_cache, read_source_bytes_async
+from .single_flight import prediction_flight, make_flight_key
+from .inference_backend import predict, inference_backend_name
+from .tracing import trace_span, run_in_executor_traced
+from .metrics import SWAP_CACHE_REQUESTS, SWAP_FACE_FAILURES
 
-
-# Get Replicate API token from environment variable
-REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
-if not REPLICATE_API_TOKEN:
-    raise ValueError("REPLICATE_API_TOKEN environment variable is not set")
-
-# Initialize Replicate client with API token
-client = replicate.Client(api_token=REPLICATE_API_TOKEN)
+# Model và tham số cố định cho face swap (cũng là một phần của cache key)
+SWAP_MODEL = "easel/advanced-face-swap"
+SWAP_MODEL_PARAMS = {
+    "upscale": True,
+    "detailer": False,
+    "hair_source": "user",
+    "user_gender": "a woman",
+    "user_b_gender": "a woman"
+}
 
 
 async def open_local_file_for_replicate(file_path: str):
@@ -56,6 +59,25 @@ async def open_local_file_for_replicate(file_path: str):
 
 
 async def swap_face(face_image_url: str, body_image_url: str) -> Dict[str, Any]:
+    """
+    Swap face from face_image_url onto body_image_url.
+    Concurrent identical calls (same face, same body, same model params) share one prediction.
+
+    Args:
+        face_image_url: URL of the face image
+        body_image_url: URL of the body image to place the face on
+
+    Returns:
+        Dict containing result URL and metadata
+    """
+    flight_key = make_flight_key(SWAP_MODEL, SWAP_MODEL_PARAMS, face_image_url, body_image_url)
+    result = await prediction_flight.do(flight_key, lambda: _run_swap_face(face_image_url, body_image_url))
+    if not result["success"]:
+        SWAP_FACE_FAILURES.inc()
+    return dict(result)
+
+
+async def _run_swap_face(face_image_url: str, body_image_url: str) -> Dict[str, Any]:
     """
     Swap face from face_image_url onto body_image_url using Bytedance Seedream 4 model.
 
@@ -85,13 +107,9 @@ async def swap_face(face_image_url: str, body_image_url: str) -> Dict[str, Any]:
             target_image = await open_local_file_for_replicate(body_image_url)
 
         input_params = {
-            "upscale": True,
-            "detailer": False,
+            **SWAP_MODEL_PARAMS,
             "swap_image": face_image_url,  # Face to swap from - this is a URL
-            "hair_source": "user",
-            "user_gender": "a woman",
             "target_image": target_image,  # Body to swap onto - uploaded or external URL
-            "user_b_gender": "a woman"
         }
 
         # Handle file objects properly - need to manage file lifecycle
@@ -100,13 +118,12 @@ async def swap_face(face_image_url: str, body_image_url: str) -> Dict[str, Any]:
             file_to_close = target_image
 
         try:
-            # Run the Replicate model asynchronously using thread pool
-            print(f"DEBUG swap_face: Calling Replicate API with input: {input_params}")
-            loop = asyncio.get_event_loop()
-            output = await loop.run_in_executor(None, client.run, "easel/advanced-face-swap", input_params)
-            print(f"DEBUG swap_face: Replicate API call completed")
+            # Run the model on the configured inference backend through the shared scheduler (bounded concurrency, priority queue)
+            print(f"DEBUG swap_face: Calling inference backend with input: {input_params}")
+            output = await predict(SWAP_MODEL, input_params)
+            print(f"DEBUG swap_face: Inference call completed")
         except Exception as api_error:
-            print(f"DEBUG swap_face: Replicate API call failed: {str(api_error)}")
+            print(f"DEBUG swap_face: Inference call failed: {str(api_error)}")
             raise api_error
         finally:
             # Close file object if we opened one
@@ -129,18 +146,10 @@ async def swap_face(face_image_url: str, body_image_url: str) -> Dict[str, Any]:
                     return str(text)
             return text
 
-        print(f"DEBUG swap_face: output received, type={type(output)}")
-
-        # Process the output - easel/advanced-face-swap returns a single output object
+        # Process the output - easel/advanced-face-swap returns a single image
         if output:
-            if hasattr(output, 'url'):
-                # Call url() method if it's callable, otherwise access url attribute
-                url = output.url() if callable(output.url) else output.url
-                generated_url = ensure_utf8_string(url)
-                print(f"DEBUG swap_face: Generated URL: {generated_url}")
-            else:
-                print(f"DEBUG swap_face: Output doesn't have url method/attribute: {output}")
-                generated_url = ""
+            generated_url = ensure_utf8_string(output[0])
+            print(f"DEBUG swap_face: Generated URL: {generated_url}")
         else:
             print("DEBUG swap_face: No output received from model")
             generated_url = ""
@@ -150,7 +159,7 @@ async def swap_face(face_image_url: str, body_image_url: str) -> Dict[str, Any]:
                 "swapped_image_url": generated_url,
                 "success": True,
                 "processing_time": processing_time,
-                "model_used": "easel/advanced-face-swap",
+                "model_used": SWAP_MODEL,
                 "face_image_url": face_image_url,
                 "body_image_url": body_image_url
             }
@@ -175,3 +184,98 @@ async def swap_face(face_image_url: str, body_image_url: str) -> Dict[str, Any]:
             "face_image_url": face_image_url,
             "body_image_url": body_image_url
         }
+
+
+async def swap_face_cached(face_image_url: str, body_image_url: str) -> Dict[str, Any]:
+    """
+    swap_face có cache trên đĩa theo nội dung ảnh face + ảnh character + tham số model.
+    Kết quả trả về trỏ tới file ảnh đã cache (không phải URL Replicate sẽ hết hạn),
+    nên render lại cùng một cuốn sách cho cùng ảnh khách hàng không gọi lại Replicate.
+
+    Args:
+        face_image_url: URL của ảnh face
+        body_image_url: URL hoặc file path của ảnh character
+
+    Returns:
+        Dict giống swap_face, thêm trường "cache_hit"
+    """
+    with trace_span("swap_face", body=Path(body_image_url).name) as span:
+        result = await _swap_face_cached(face_image_url, body_image_url)
+        if span is not None:
+            span.set_tag("cache_hit", result.get("cache_hit"))
+            span.set_tag("success", result.get("success"))
+
+    if "cache_hit" not in result:
+        SWAP_CACHE_REQUESTS.labels("bypass").inc()
+    else:
+        SWAP_CACHE_REQUESTS.labels("hit" if result["cache_hit"] else "miss").inc()
+    return result
+
+
+async def _swap_face_cached(face_image_url: str, body_image_url: str) -> Dict[str, Any]:
+    cache = get_swap_cache()
+    if cache is None:
+        return await swap_face(face_image_url, body_image_url)
+
+    start_time = time.time()
+    # Kết quả của backend khác Replicate (vd: local) không được dùng lẫn với kết quả thật
+    backend_name = inference_backend_name()
+    cache_model = SWAP_MODEL if backend_name == "replicate" else f"{backend_name}:{SWAP_MODEL}"
+
+    try:
+        cache_key = await run_in_executor_traced(
+            "swap_cache.key", None, cache.build_key, face_image_url, body_image_url, cache_model, SWAP_MODEL_PARAMS
+        )
+    except Exception as e:
+        print(f"DEBUG swap_face_cached: Could not build cache key, skipping cache: {e}")
+        return await swap_face(face_image_url, body_image_url)
+
+    cached_path = cache.get(cache_key)
+    if cached_path is not None:
+        print(f"DEBUG swap_face_cached: Cache hit {cache_key[:12]} for {body_image_url}")
+        return _cached_swap_result(cached_path, face_image_url, body_image_url, start_time)
+
+    # Các coroutine cùng key trong process chờ chung một lần swap
+    result = await prediction_flight.do(
+        f"swap_cache:{cache_key}",
+        lambda: _swap_and_store(cache, cache_key, face_image_url, body_image_url, start_time)
+    )
+    return dict(result)
+
+
+def _cached_swap_result(cached_path, face_image_url: str, body_image_url: str, start_time: float) -> Dict[str, Any]:
+    return {
+        "swapped_image_url": str(cached_path),
+        "success": True,
+        "processing_time": time.time() - start_time,
+        "model_used": SWAP_MODEL,
+        "face_image_url": face_image_url,
+        "body_image_url": body_image_url,
+        "cache_hit": True
+    }
+
+
+async def _swap_and_store(cache, cache_key: str, face_image_url: str, body_image_url: str, start_time: float) -> Dict[str, Any]:
+    """Chạy swap_face và lưu kết quả vào cache, giữ khóa theo key để worker khác chờ thay vì swap lại."""
+    async with cache.key_lock(cache_key):
+        # Worker khác có thể đã swap xong trong lúc chờ khóa
+        cached_path = cache.get(cache_key)
+        if cached_path is not None:
+            print(f"DEBUG swap_face_cached: Cache filled by another worker {cache_key[:12]}")
+            return _cached_swap_result(cached_path, face_image_url, body_image_url, start_time)
+
+        result = await swap_face(face_image_url, body_image_url)
+        result["cache_hit"] = False
+        if not result["success"]:
+            return result
+
+        try:
+            # Lưu bytes ảnh kết quả, không lưu URL Replicate
+            image_bytes = await read_source_bytes_async(result["swapped_image_url"])
+            cached_path = await run_in_executor_traced("swap_cache.put", None, cache.put, cache_key, image_bytes)
+            result["swapped_image_url"] = str(cached_path)
+            print(f"DEBUG swap_face_cached: Stored {cache_key[:12]} ({len(image_bytes)} bytes)")
+        except Exception as e:
+            print(f"DEBUG swap_face_cached: Failed to store result in cache: {e}")
+
+        return result
@@ -0,0 +1,352 @@
+import os
+import json
+import time
+import queue
+import random
+import asyncio
+import secrets
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import requests
+
+
+# Tắt hoàn toàn tracing (span + thống kê) nếu = false
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "gen-book-api")
+# Export span theo định dạng Zipkin v2 JSON: ra file (mỗi dòng một span) và/hoặc POST tới collector
+# (Zipkin, Jaeger với Zipkin receiver, OpenTelemetry Collector zipkin receiver...)
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")
+TRACE_ZIPKIN_URL = os.getenv("TRACE_ZIPKIN_URL", "")  # vd: http://localhost:9411/api/v2/spans
+# Tỉ lệ trace được export (thống kê theo endpoint luôn tính mọi request)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+# Số duration gần nhất giữ lại cho mỗi (endpoint, stage) để tính p50/p95
+TRACE_STATS_WINDOW = int(os.getenv("TRACE_STATS_WINDOW", "1000"))
+
+TRACE_EXPORT_BATCH_SIZE = 100
+TRACE_EXPORT_FLUSH_SECONDS = 2.0
+
+
+class Trace:
+    """Một trace: id, endpoint (để gộp thống kê) và có được export hay không."""
+
+    __slots__ = ("trace_id", "endpoint", "sampled")
+
+    def __init__(self, endpoint: str, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.endpoint = endpoint
+        self.sampled = random.random() < TRACE_SAMPLE_RATE
+
+
+class Span:
+    """Một stage có thời gian bắt đầu/kết thúc trong trace."""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start", "end", "tags")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], kind: Optional[str] = None, tags: Optional[Dict[str, Any]] = None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.tags: Dict[str, Any] = dict(tags or {})
+
+    def set_tag(self, key: str, value: Any) -> None:
+        self.tags[key] = value
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def to_zipkin(self) -> Dict[str, Any]:
+        data = {
+            "traceId": self.trace.trace_id,
+            "id": self.span_id,
+            "name": self.name,
+            "timestamp": int(self.start * 1_000_000),
+            "duration": max(1, int(self.duration * 1_000_000)),
+            "localEndpoint": {"serviceName": TRACE_SERVICE_NAME},
+            "tags": {key: str(value) for key, value in self.tags.items() if value is not None},
+        }
+        if self.parent_id:
+            data["parentId"] = self.parent_id
+        if self.kind:
+            data["kind"] = self.kind
+        return data
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("trace_span", default=None)
+
+
+class StageStats:
+    """Thống kê thời gian các stage theo endpoint: count, tổng, max và p50/p95 trên cửa sổ gần nhất."""
+
+    def __init__(self, window: int):
+        self.window = window
+        self._lock = threading.Lock()
+        self._counts: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._totals: Dict[Tuple[str, str], float] = defaultdict(float)
+        self._max: Dict[Tuple[str, str], float] = defaultdict(float)
+        self._errors: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._recent: Dict[Tuple[str, str], Deque[float]] = {}
+
+    def record(self, endpoint: str, stage: str, duration: float, error: bool = False) -> None:
+        key = (endpoint, stage)
+        with self._lock:
+            self._counts[key] += 1
+            self._totals[key] += duration
+            self._max[key] = max(self._max[key], duration)
+            if error:
+                self._errors[key] += 1
+            recent = self._recent.get(key)
+            if recent is None:
+                recent = self._recent[key] = deque(maxlen=self.window)
+            recent.append(duration)
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        result: Dict[str, Dict[str, Dict[str, Any]]] = defaultdict(dict)
+        with self._lock:
+            for key, count in self._counts.items():
+                endpoint, stage = key
+                recent = sorted(self._recent[key])
+                result[endpoint][stage] = {
+                    "count": count,
+                    "errors": self._errors[key],
+                    "avg_ms": round(self._totals[key] / count * 1000, 2),
+                    "p50_ms": round(recent[int(0.50 * (len(recent) - 1))] * 1000, 2),
+                    "p95_ms": round(recent[int(0.95 * (len(recent) - 1))] * 1000, 2),
+                    "max_ms": round(self._max[key] * 1000, 2),
+                }
+        return dict(result)
+
+
+class ZipkinExporter:
+    """
+    Export span (Zipkin v2 JSON) trên một thread nền theo batch, không chặn event loop.
+    Collector không truy cập được thì bỏ batch đó (chỉ log cảnh báo), không ảnh hưởng request.
+    """
+
+    def __init__(self, file_path: str, url: str):
+        self.file_path = file_path
+        self.url = url
+        self._queue: "queue.SimpleQueue[Optional[Dict[str, Any]]]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.file_path or self.url)
+
+    def export(self, span: Span) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._thread.start()
+        self._queue.put(span.to_zipkin())
+
+    def _run(self) -> None:
+        running = True
+        while running:
+            batch: List[Dict[str, Any]] = []
+            deadline = time.monotonic() + TRACE_EXPORT_FLUSH_SECONDS
+            while len(batch) < TRACE_EXPORT_BATCH_SIZE:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        if self.file_path:
+            try:
+                with open(self.file_path, "a", encoding="utf-8") as f:
+                    for item in batch:
+                        f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"Warning: Could not write spans to {self.file_path}: {e}")
+        if self.url:
+            try:
+                response = requests.post(self.url, json=batch, timeout=5)
+                response.raise_for_status()
+            except Exception as e:
+                self.dropped += len(batch)
+                print(f"Warning: Could not export {len(batch)} span(s) to {self.url}: {e}")
+                return
+        self.exported += len(batch)
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+
+# Thống kê và exporter dùng chung trong process
+stage_stats = StageStats(TRACE_STATS_WINDOW)
+span_exporter = ZipkinExporter(TRACE_EXPORT_FILE, TRACE_ZIPKIN_URL)
+
+
+def _finish(span: Span, error: bool = False) -> None:
+    span.end = time.time()
+    stage_stats.record(span.trace.endpoint, span.name, span.duration, error)
+    if span.trace.sampled and span_exporter.enabled:
+        span_exporter.export(span)
+
+
+@contextmanager
+def trace_span(name: str, kind: Optional[str] = None, **tags: Any):
+    """
+    Span cho một stage (dùng được trong code sync và async). Không có trace đang chạy thì mở trace mới
+    với endpoint = tên span (vd: gọi create_book trực tiếp từ script).
+
+    Ví dụ:
+        with trace_span("book.render", pages=len(plan)):
+            pdf_bytes = await render_plan(plan)
+    """
+    if not TRACING_ENABLED:
+        yield None
+        return
+
+    parent = _current_span.get()
+    trace = parent.trace if parent is not None else Trace(name)
+    span = Span(trace, name, parent.span_id if parent is not None else None, kind, tags)
+    token = _current_span.set(span)
+    error = False
+    try:
+        yield span
+    except BaseException as e:
+        error = True
+        span.set_tag("error", str(e)[:200] or type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        _finish(span, error)
+
+
+@contextmanager
+def start_trace(endpoint: str, name: str, trace_id: Optional[str] = None, kind: Optional[str] = None, **tags: Any):
+    """Mở trace mới (root span) cho một request hoặc job; thống kê của mọi span con được gộp theo endpoint."""
+    if not TRACING_ENABLED:
+        yield None
+        return
+
+    span = Span(Trace(endpoint, trace_id), name, None, kind, tags)
+    token = _current_span.set(span)
+    error = False
+    try:
+        yield span
+    except BaseException as e:
+        error = True
+        span.set_tag("error", str(e)[:200] or type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        _finish(span, error)
+
+
+def record_span(name: str, start: float, end: float, **tags: Any) -> None:
+    """Ghi lại một stage đã đo ở nơi khác (vd: thời gian chờ/render trong process của render pool)."""
+    parent = _current_span.get()
+    if not TRACING_ENABLED or parent is None:
+        return
+    span = Span(parent.trace, name, parent.span_id, tags=tags)
+    span.start = start
+    span.end = end
+    stage_stats.record(parent.trace.endpoint, name, end - start)
+    if parent.trace.sampled and span_exporter.enabled:
+        span_exporter.export(span)
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current_span.get()
+    return span.trace.trace_id if span is not None else None
+
+
+async def run_in_executor_traced(name: str, executor, func: Callable[..., Any], *args: Any, **tags: Any) -> Any:
+    """
+    loop.run_in_executor trong một span; thời gian chờ thread rảnh được ghi thành span con "<name>.pool_wait"
+    để phân biệt chậm do thread pool đầy với chậm do chính công việc.
+    """
+    if not TRACING_ENABLED or _current_span.get() is None:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, func, *args)
+
+    submitted_at = time.time()
+    started_at: List[float] = []
+
+    def call() -> Any:
+        started_at.append(time.time())
+        return func(*args)
+
+    with trace_span(name, **tags):
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(executor, call)
+        finally:
+            if started_at:
+                record_span(f"{name}.pool_wait", submitted_at, started_at[0])
+
+
+def route_template(request) -> Optional[str]:
+    """Template của route (vd: /api/v1/book-jobs/{job_id}) để thống kê không bị tách theo từng id; None nếu không khớp route nào."""
+    from starlette.routing import Match
+
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return getattr(route, "path", None)
+    return None
+
+
+async def tracing_middleware(request, call_next):
+    """
+    Middleware HTTP: mỗi request là một trace (id lấy từ header X-Request-ID nếu có),
+    trả về X-Request-ID và X-Trace-Id để tìm lại trace trong collector.
+    """
+    if not TRACING_ENABLED or request.url.path.startswith(("/runs", "/assets", "/images")):
+        return await call_next(request)
+
+    endpoint = f"{request.method} {route_template(request) or request.url.path}"
+    request_id = request.headers.get("x-request-id") or secrets.token_hex(8)
+    with start_trace(endpoint, endpoint, kind="SERVER", request_id=request_id, **{"http.method": request.method, "http.path": request.url.path}) as span:
+        response = await call_next(request)
+        span.set_tag("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            span.set_tag("error", f"HTTP {response.status_code}")
+
+    response.headers["X-Request-ID"] = request_id
+    response.headers["X-Trace-Id"] = span.trace.trace_id
+    return response
+
+
+def tracing_stats() -> Dict[str, Any]:
+    """Thời gian từng stage gộp theo endpoint + trạng thái exporter."""
+    return {
+        "enabled": TRACING_ENABLED,
+        "export": {
+            "file": TRACE_EXPORT_FILE or None,
+            "zipkin_url": TRACE_ZIPKIN_URL or None,
+            "sample_rate": TRACE_SAMPLE_RATE,
+            "exported": span_exporter.exported,
+            "dropped": span_exporter.dropped,
+        },
+        "endpoints": stage_stats.snapshot(),
+    }
+
+
+def shutdown_tracing() -> None:
+    """Đẩy nốt các span còn trong hàng đợi export (gọi khi app shutdown)."""
+    span_exporter.shutdown()
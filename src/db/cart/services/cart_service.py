@@ -1,9 +1,28 @@
+import json
 from sqlalchemy.orm import Session
 from sqlalchemy import desc
 from typing import List, Optional, Dict, Any
 
 from src.db.cart.models.cart_models import Cart
 from src.db.cart.models.cart_schemas import CartCreate, CartUpdate
+from src.ai.services.book_jobs import (
+    SPECULATIVE_RENDER_ENABLED, schedule_speculative_render, cancel_speculative_render, promote_speculative_render
+)
+
+# Các trường của book_request_data cần để render sách (giống CreateBookRequest)
+BOOK_REQUEST_FIELDS = ("category_id", "book_id", "stories", "name", "image_url")
+
+
+def _book_request_for_render(book_request_data: str) -> Optional[Dict[str, Any]]:
+    """Lấy request render sách từ book_request_data (JSON) của cart item; None nếu thiếu thông tin."""
+    try:
+        data = json.loads(book_request_data)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(data, dict) or not all(data.get(field) for field in BOOK_REQUEST_FIELDS):
+        return None
+    return {field: data[field] for field in BOOK_REQUEST_FIELDS}
+
 
 class CartService:
     @staticmethod
@@ -18,14 +37,36 @@ class CartService:
             .order_by(desc(Cart.created_at)).all()
 
     @staticmethod
-    def add_to_cart(db: Session, cart: CartCreate) -> Cart:
-        """Thêm item vào cart"""
+    def add_to_cart(db: Session, cart: CartCreate, speculative_render: Optional[bool] = None) -> Cart:
+        """
+        Thêm item vào cart
+
+        Args:
+            db: Database session
+            cart: Cart item mới
+            speculative_render: Render trước sách của item ở priority thấp nhất
+                (mặc định theo SPECULATIVE_RENDER_ENABLED)
+        """
         db_cart = Cart(**cart.dict())
         db.add(db_cart)
         db.commit()
         db.refresh(db_cart)
+
+        if SPECULATIVE_RENDER_ENABLED if speculative_render is None else speculative_render:
+            CartService._schedule_render(db_cart)
         return db_cart
 
+    @staticmethod
+    def _schedule_render(db_cart: Cart) -> None:
+        request_data = _book_request_for_render(db_cart.book_request_data)
+        if request_data is None:
+            print(f"DEBUG cart: Cart item {db_cart.id} has incomplete book request, skipping speculative render")
+            return
+        try:
+            schedule_speculative_render(db_cart.id, request_data)
+        except Exception as e:
+            print(f"Warning: Could not schedule speculative render for cart item {db_cart.id}: {e}")
+
     @staticmethod
     def update_cart_item(db: Session, cart_id: int, cart_update: CartUpdate) -> Optional[Cart]:
         """Cập nhật cart item"""
@@ -39,6 +80,11 @@ class CartService:
 
         db.commit()
         db.refresh(db_cart)
+
+        if "book_request_data" in update_data and SPECULATIVE_RENDER_ENABLED:
+            # Nội dung sách thay đổi: bỏ render cũ, render trước theo nội dung mới
+            cancel_speculative_render(db_cart.id)
+            CartService._schedule_render(db_cart)
         return db_cart
 
     @staticmethod
@@ -50,15 +96,46 @@ class CartService:
 
         db.delete(db_cart)
         db.commit()
+        cancel_speculative_render(cart_id)
         return True
 
     @staticmethod
     def clear_user_cart(db: Session, user_id: int) -> int:
         """Xóa tất cả items trong cart của user, trả về số lượng items đã xóa"""
+        cart_ids = [cart_id for (cart_id,) in db.query(Cart.id).filter(Cart.user_id == user_id).all()]
         deleted_count = db.query(Cart).filter(Cart.user_id == user_id).delete()
         db.commit()
+        # Sách của đơn hàng đã thanh toán đã được promote nên không bị hủy
+        for cart_id in cart_ids:
+            cancel_speculative_render(cart_id)
         return deleted_count
 
+    @staticmethod
+    def promote_speculative_renders(db: Session, order) -> int:
+        """
+        Nâng render trước của các item thuộc đơn hàng đã thanh toán lên priority của đơn hàng.
+
+        Order không lưu danh sách item: checkout thanh toán cả cart tại thời điểm tạo order, nên item
+        thuộc đơn hàng là các item của user được thêm vào cart trước order.created_at. Item thêm sau
+        (chưa thanh toán) giữ priority speculative.
+        """
+        query = db.query(Cart.id).filter(Cart.user_id == order.user_id)
+        if order.created_at is not None:
+            query = query.filter(Cart.created_at <= order.created_at)
+        cart_ids = [cart_id for (cart_id,) in query.all()]
+        for cart_id in cart_ids:
+            promote_speculative_render(cart_id)
+        return len(cart_ids)
+
+    @staticmethod
+    def promote_paid_order(db: Session, order) -> None:
+        """Gọi khi đơn hàng chuyển sang "paid" (mọi luồng thanh toán); lỗi chỉ được log."""
+        try:
+            count = CartService.promote_speculative_renders(db, order)
+            print(f"DEBUG cart: Promoted {count} speculative render(s) for paid order {order.id}")
+        except Exception as e:
+            print(f"Warning: Could not promote speculative renders for order {order.id}: {e}")
+
     @staticmethod
     def get_cart_total(db: Session, user_id: int) -> Dict[str, Any]:
         """Tính tổng giá trị cart của user"""
@@ -4,6 +4,7 @@ from sqlalchemy.orm import sessionmaker, Session
 from typing import Generator
 import os
 from dotenv import load_dotenv
+from src.ai.services.metrics import instrument_engine
 
 # Load environment variables
 load_dotenv()
@@ -19,6 +20,9 @@ engine = create_engine(
     echo=False           # Set to True for SQL query logging in development
 )
 
+# Checkout / overflow của connection pool cho /metrics
+instrument_engine(engine)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Base class for models
@@ -4,6 +4,7 @@ from typing import List, Optional, Dict, Any
 
 from src.db.order.models.order_models import Order, Payment
 from src.db.order.models.order_schemas import OrderCreate, OrderUpdate, PaymentCreate, PaymentUpdate
+from src.db.cart.services.cart_service import CartService
 
 class OrderService:
     @staticmethod
@@ -45,12 +46,15 @@ class OrderService:
 
     @staticmethod
     def update_order_status(db: Session, order_id: int, status: str) -> Optional[Order]:
-        """Cập nhật trạng thái order"""
+        """Cập nhật trạng thái order; order vừa thanh toán thì sách render trước được nâng priority"""
         order = db.query(Order).filter(Order.id == order_id).first()
         if order:
+            newly_paid = status == "paid" and order.status != "paid"
             order.status = status
             db.commit()
             db.refresh(order)
+            if newly_paid:
+                CartService.promote_paid_order(db, order)
         return order
 
     @staticmethod
@@ -61,11 +65,14 @@ class OrderService:
             return None
 
         update_data = order_update.dict(exclude_unset=True)
+        newly_paid = update_data.get("status") == "paid" and db_order.status != "paid"
         for field, value in update_data.items():
             setattr(db_order, field, value)
 
         db.commit()
         db.refresh(db_order)
+        if newly_paid:
+            CartService.promote_paid_order(db, db_order)
         return db_order
 
 
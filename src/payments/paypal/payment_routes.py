@@ -171,6 +171,8 @@ async def paypal_webhook(
             if payment:
                 payment.status = 'completed'
                 db.commit()
+                # Đơn hàng chưa được capture/execute đánh dấu paid (vd: client đóng trang) - đánh dấu tại đây
+                payment_service.update_order_status(payment.order_id, 'paid', db)
 
         elif event_type == 'PAYMENT.SALE.DENIED':
             # Thanh toán bị từ chối
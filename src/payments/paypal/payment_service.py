@@ -5,6 +5,7 @@ from decimal import Decimal
 
 from src.db.order.models.order_models import Order, Payment
 from src.db.user.models.user_models import User
+from src.db.cart.services.cart_service import CartService
 # Note: Book model không tồn tại trong cấu trúc hiện tại
 from src.db.order.models.order_schemas import (
     OrderCreate, OrderUpdate, PaymentCreate, PaymentUpdate,
@@ -67,12 +68,15 @@ class PaymentService:
         status: str,
         db: Session
     ) -> Optional[Order]:
-        """Cập nhật trạng thái đơn hàng"""
+        """Cập nhật trạng thái đơn hàng; đơn hàng vừa thanh toán thì sách render trước được nâng priority"""
         order = db.query(Order).filter(Order.id == order_id).first()
         if order:
+            newly_paid = status == "paid" and order.status != "paid"
             order.status = status
             db.commit()
             db.refresh(order)
+            if newly_paid:
+                CartService.promote_paid_order(db, order)
         return order
 
     @staticmethod
@@ -0,0 +1,490 @@
+"""
+Benchmark end-to-end tạo sách offline, không tốn credit Replicate.
+
+Inference backend được thay bằng stand-in local: mỗi prediction ngủ theo một phân phối
+latency cấu hình được (async, giống backend Replicate) và lỗi ngẫu nhiên theo failure rate,
+rồi trả về chính ảnh character làm kết quả swap. Khác với create_book_test, toàn bộ đường đi thật
+(scheduler, single-flight, swap cache, render pool, artifact store, route) đều được chạy.
+
+Mỗi request dùng một ảnh face riêng (như nhiều khách hàng khác nhau) để single-flight, swap cache và
+fingerprint của /create-book/ không gộp công việc; dùng --same-face để đo trường hợp request trùng.
+
+Báo cáo cho mỗi (target, concurrency): latency p50/p95/p99, pages/sec, peak RSS (process chính +
+process render) và độ trễ event loop. --json lưu kết quả để so sánh giữa các release (--baseline).
+
+Usage (từ thư mục gốc project):
+    python test/benchmark/bench_book.py
+    python test/benchmark/bench_book.py --targets create_book route_create_book --concurrency 1 4 8
+    python test/benchmark/bench_book.py --latency lognormal:2.5,0.4 --failure-rate 0.05 --requests 16
+    python test/benchmark/bench_book.py --json bench_v2.json --baseline bench_v1.json
+
+Latency: fixed:S | uniform:LO,HI | normal:MEAN,STD | lognormal:MEDIAN,SIGMA (giây)
+"""
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, PROJECT_ROOT)
+
+DEFAULT_FACE = os.path.join(PROJECT_ROOT, "test", "test_response", "image", "happy.jpeg")
+
+TARGETS = [
+    "create_book", "create_cover", "create_interleafs",
+    "route_create_book", "route_create_cover", "route_create_interleaf",
+]
+
+
+class LatencyModel:
+    """Phân phối latency của một prediction (giây), parse từ chuỗi dạng "lognormal:2.5,0.4"."""
+
+    def __init__(self, spec: str, rng: random.Random):
+        self.spec = spec
+        self.rng = rng
+        kind, _, raw = spec.partition(":")
+        try:
+            params = [float(value) for value in raw.split(",")] if raw else []
+        except ValueError:
+            raise ValueError(f"Invalid latency spec: {spec}")
+
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if kind not in expected or len(params) != expected[kind]:
+            raise ValueError(f"Invalid latency spec: {spec} (expected fixed:S, uniform:LO,HI, normal:MEAN,STD or lognormal:MEDIAN,SIGMA)")
+        self.kind = kind
+        self.params = params
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return self.rng.uniform(*self.params)
+        if self.kind == "normal":
+            return max(0.0, self.rng.gauss(*self.params))
+        median, sigma = self.params
+        return self.rng.lognormvariate(math.log(median), sigma)
+
+
+class StandInBackend:
+    """
+    Inference backend giả lập Replicate: predict() là coroutine chờ trong thời gian lấy từ LatencyModel (được
+    prediction scheduler await trên event loop như backend thật), lỗi với xác suất failure_rate, và trả về ảnh target.
+    """
+
+    name = "bench"
+
+    def __init__(self, latency: LatencyModel, failure_rate: float, rng: random.Random):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self._lock = threading.Lock()
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.failures: Dict[str, int] = defaultdict(int)
+
+    async def predict(self, model: str, inputs: Dict[str, Any], timeout: Optional[float] = None) -> List[str]:
+        with self._lock:
+            delay = self.latency.sample()
+            fail = self.rng.random() < self.failure_rate
+            self.calls[model] += 1
+            if fail:
+                self.failures[model] += 1
+
+        await asyncio.sleep(delay)
+        if fail:
+            raise RuntimeError(f"Stand-in: simulated {model} prediction failure")
+
+        target = inputs.get("target_image")
+        if hasattr(target, "name"):
+            # swap_face mở file character local và truyền file object
+            return [os.path.abspath(target.name)]
+        return [str(target)]
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.failures.clear()
+
+
+class LoopLagMonitor:
+    """Đo độ trễ event loop: thời gian một sleep(interval) bị chậm hơn dự kiến."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self) -> None:
+        self.samples = []
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+
+def _rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class RssSampler:
+    """Peak RSS (MB) của process chính + các process render đang sống, lấy mẫu từ /proc."""
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        pids = [os.getpid()] + [child.pid for child in multiprocessing.active_children()]
+        self.peak = max(self.peak, sum(_rss_bytes(pid) for pid in pids))
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self) -> None:
+        self.peak = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> float:
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        if self.peak == 0:
+            # Không có /proc (macOS...): chỉ có peak của process chính từ đầu chương trình
+            import resource
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+        return self.peak / (1024 * 1024)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentile theo nearest-rank."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def count_pdf_pages(pdf_bytes: bytes) -> int:
+    from pypdf import PdfReader
+    return len(PdfReader(io.BytesIO(pdf_bytes)).pages)
+
+
+def default_stories(category_id: str, book_id: str) -> List[str]:
+    from src.ai.services.catalog import catalog
+    prefix = f"{category_id}{book_id}"
+    return sorted({key[4:6] for key in catalog.pages() if key.startswith(prefix)})
+
+
+class FaceImages:
+    """Ảnh face riêng cho mỗi request (cùng ảnh gốc, khác bytes) để cache/single-flight không gộp request."""
+
+    def __init__(self, source: str, workdir: str, same_face: bool):
+        with open(source, "rb") as f:
+            self.data = f.read()
+        self.source = source
+        self.workdir = workdir
+        self.same_face = same_face
+        self._count = 0
+
+    def next(self) -> str:
+        if self.same_face:
+            return self.source
+        self._count += 1
+        path = os.path.join(self.workdir, f"face_{self._count:05d}.jpg")
+        with open(path, "wb") as f:
+            # Byte thừa sau marker EOI không ảnh hưởng ảnh nhưng đổi hash nội dung
+            f.write(self.data + f"bench-{self._count}".encode("utf-8"))
+        return path
+
+
+def build_target(name: str, args: argparse.Namespace, stories: List[str]) -> Callable[[str], Any]:
+    """Trả về coroutine function (face_path) -> số trang đã tạo."""
+    category_id, book_id, character_name = args.category, args.book, args.name
+    story_dicts = [{"story_id": story_id} for story_id in stories]
+    interleaf_count = max(1, len(stories) // 2)
+
+    if name == "create_book":
+        from src.ai.services.create_book import create_book
+
+        async def run(face: str) -> int:
+            return count_pdf_pages(await create_book(category_id, book_id, story_dicts, character_name, face))
+        return run
+
+    if name == "create_cover":
+        from src.ai.services.create_cover import create_cover
+
+        async def run(face: str) -> int:
+            return count_pdf_pages(await create_cover(category_id, book_id, character_name, face))
+        return run
+
+    if name == "create_interleafs":
+        from src.ai.services.create_interleafs import create_interleafs
+
+        async def run(face: str) -> int:
+            return count_pdf_pages(await create_interleafs(category_id, book_id, interleaf_count, character_name, face))
+        return run
+
+    import httpx
+    from fastapi import FastAPI
+    from src.ai.api.ai_routes import router
+
+    app = FastAPI()
+    app.include_router(router, prefix="/api/v1")
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None)
+
+    async def post(path: str, body: Dict[str, Any]) -> httpx.Response:
+        response = await client.post(path, json=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} returned {response.status_code}: {response.text[:200]}")
+        return response
+
+    base = {"category_id": category_id, "book_id": book_id, "name": character_name}
+    if name == "route_create_book":
+        async def run(face: str) -> int:
+            body = {**base, "stories": story_dicts, "gender": "girl", "language": "en", "image_url": face}
+            return (await post("/api/v1/create-book/", body)).json()["page_count"]
+        return run
+
+    if name == "route_create_cover":
+        async def run(face: str) -> int:
+            return count_pdf_pages((await post("/api/v1/create-cover/", {**base, "image_url": face})).content)
+        return run
+
+    if name == "route_create_interleaf":
+        async def run(face: str) -> int:
+            body = {**base, "interleaf_count": interleaf_count, "image_url": face}
+            return count_pdf_pages((await post("/api/v1/create-interleaf/", body)).content)
+        return run
+
+    raise ValueError(f"Unknown target: {name}")
+
+
+@contextlib.contextmanager
+def quiet(enabled: bool):
+    """
+    Ẩn log DEBUG của các service trong lúc đo (print từ nhiều thread làm nhiễu kết quả).
+    Chuyển hướng ở mức file descriptor để process render (spawn trong lúc này) cũng im lặng.
+    """
+    if not enabled:
+        yield
+        return
+    sys.stdout.flush()
+    saved_fd = os.dup(1)
+    devnull_fd = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull_fd, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_fd, 1)
+        os.close(saved_fd)
+        os.close(devnull_fd)
+
+
+async def run_level(run: Callable[[str], Any], faces: FaceImages, concurrency: int, total: int, stand_in: StandInBackend) -> Dict[str, Any]:
+    latencies: List[float] = []
+    pages = 0
+    errors: List[str] = []
+    remaining = iter(range(total))
+
+    async def worker() -> None:
+        nonlocal pages
+        for _ in remaining:
+            face = faces.next()
+            started = time.perf_counter()
+            try:
+                pages += await run(face)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors.append(str(e))
+
+    stand_in.reset()
+    lag = LoopLagMonitor()
+    rss = RssSampler()
+    lag.start()
+    rss.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    peak_rss = rss.stop()
+    await lag.stop()
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "ok": len(latencies),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "wall_s": round(wall, 3),
+        "p50_s": round(percentile(latencies, 50), 3),
+        "p95_s": round(percentile(latencies, 95), 3),
+        "p99_s": round(percentile(latencies, 99), 3),
+        "pages": pages,
+        "pages_per_s": round(pages / wall, 3) if wall else 0.0,
+        "peak_rss_mb": round(peak_rss, 1),
+        "loop_lag_p99_ms": round(percentile(lag.samples, 99) * 1000, 2),
+        "loop_lag_max_ms": round(max(lag.samples, default=0.0) * 1000, 2),
+        "predictions": sum(stand_in.calls.values()),
+        "injected_failures": sum(stand_in.failures.values()),
+    }
+
+
+def print_result(target: str, result: Dict[str, Any]) -> None:
+    print(
+        f"{target:<24} {result['concurrency']:>4} {result['ok']:>4}/{result['requests']:<4} "
+        f"{result['p50_s']:>8.2f} {result['p95_s']:>8.2f} {result['p99_s']:>8.2f} "
+        f"{result['pages_per_s']:>8.2f} {result['peak_rss_mb']:>9.1f} "
+        f"{result['loop_lag_p99_ms']:>8.1f} {result['loop_lag_max_ms']:>8.1f} "
+        f"{result['predictions']:>6} {result['injected_failures']:>5}"
+    )
+    if result["first_error"]:
+        print(f"    first error: {result['first_error']}")
+
+
+def compare_with_baseline(results: List[Dict[str, Any]], baseline_path: str) -> None:
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(item["target"], item["concurrency"]): item for item in json.load(f)["results"]}
+
+    def delta(new: float, old: float) -> str:
+        return f"{(new - old) / old * 100:+7.1f}%" if old else f"{'-':>8}"
+
+    print(f"\nCompared with {baseline_path}:")
+    print(f"{'target':<24} {'conc':>4} {'p50':>8} {'p95':>8} {'p99':>8} {'pages/s':>8} {'rss':>8}")
+    for result in results:
+        old = baseline.get((result["target"], result["concurrency"]))
+        if old is None:
+            continue
+        print(
+            f"{result['target']:<24} {result['concurrency']:>4} "
+            f"{delta(result['p50_s'], old['p50_s'])} {delta(result['p95_s'], old['p95_s'])} "
+            f"{delta(result['p99_s'], old['p99_s'])} {delta(result['pages_per_s'], old['pages_per_s'])} "
+            f"{delta(result['peak_rss_mb'], old['peak_rss_mb'])}"
+        )
+
+
+async def run_benchmark(args: argparse.Namespace, stand_in: StandInBackend, workdir: str) -> List[Dict[str, Any]]:
+    from src.ai.services.http_client import close_http_client
+
+    stories = args.stories or default_stories(args.category, args.book)
+    if not stories:
+        raise SystemExit(f"No stories found in catalog for category {args.category}, book {args.book}")
+    faces = FaceImages(args.face, workdir, args.same_face)
+    print(f"Book {args.category}/{args.book}, {len(stories)} stories; latency {args.latency}, failure rate {args.failure_rate}")
+
+    print(
+        f"\n{'target':<24} {'conc':>4} {'ok/reqs':>9} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} "
+        f"{'pages/s':>8} {'rss MB':>9} {'lag p99':>8} {'lag max':>8} {'preds':>6} {'fail':>5}"
+    )
+
+    results = []
+    try:
+        for target in args.targets:
+            with quiet(not args.verbose):
+                run = build_target(target, args, stories)
+                if not args.no_warmup:
+                    # Lần đầu: khởi động render pool, build asset cache
+                    await run(faces.next())
+
+            for concurrency in args.concurrency:
+                total = args.requests or concurrency * 2
+                with quiet(not args.verbose):
+                    result = await run_level(run, faces, concurrency, total, stand_in)
+                result["target"] = target
+                results.append(result)
+                print_result(target, result)
+    finally:
+        await close_http_client()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=["create_book", "route_create_book"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8], help="Số request chạy đồng thời")
+    parser.add_argument("--requests", type=int, default=0, help="Số request mỗi mức concurrency (mặc định 2 x concurrency)")
+    parser.add_argument("--latency", default="lognormal:2.0,0.35", help="Phân phối latency của mỗi prediction")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Xác suất một prediction bị lỗi")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--category", default="01")
+    parser.add_argument("--book", default="01")
+    parser.add_argument("--stories", nargs="+", help="Danh sách story_id (mặc định: mọi story của book trong catalog)")
+    parser.add_argument("--name", default="Stephen")
+    parser.add_argument("--face", default=DEFAULT_FACE, help="Ảnh face gốc")
+    parser.add_argument("--same-face", action="store_true", help="Mọi request dùng cùng ảnh face (đo dedupe)")
+    parser.add_argument("--swap-cache", action="store_true", help="Bật swap cache (thư mục tạm)")
+    parser.add_argument("--no-warmup", action="store_true", help="Không chạy request khởi động trước khi đo")
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    parser.add_argument("--baseline", help="File JSON của lần chạy trước để so sánh")
+    parser.add_argument("--verbose", action="store_true", help="Giữ log DEBUG của các service")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_book_")
+    # Job, sách và swap cache của benchmark nằm trong thư mục tạm (phải set trước khi import services)
+    os.environ["BOOK_JOBS_DIR"] = os.path.join(workdir, "jobs")
+    os.environ["RUNS_DIR"] = os.path.join(workdir, "runs")
+    os.environ["SWAP_CACHE_DIR"] = os.path.join(workdir, "swap_cache")
+    os.environ["SWAP_CACHE_ENABLED"] = "true" if args.swap_cache else "false"
+    os.environ.setdefault("BOOK_JOB_POLL_SECONDS", "0.05")
+
+    rng = random.Random(args.seed)
+    stand_in = StandInBackend(LatencyModel(args.latency, rng), args.failure_rate, rng)
+
+    from src.ai.services.inference_backend import set_inference_backend
+    from src.ai.services.render_pool import shutdown_render_pool
+    set_inference_backend(stand_in)
+
+    try:
+        results = asyncio.run(run_benchmark(args, stand_in, workdir))
+    finally:
+        shutdown_render_pool()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline:
+        compare_with_baseline(results, args.baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": platform.python_version(),
+                    "cpu_count": os.cpu_count(),
+                    "args": {key: value for key, value in vars(args).items() if key not in ("json", "baseline")},
+                },
+                "results": results,
+            }, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark chuyển nền đen -> trong suốt cho ảnh character.
+
+So sánh cách cũ (duyệt từng pixel bằng Python qua getdata/putdata) với
+make_black_transparent (band operation của Pillow), và kiểm tra 2 cách cho cùng kết quả.
+
+Usage (từ thư mục gốc project):
+    python test/benchmark/bench_transparency.py
+    python test/benchmark/bench_transparency.py --sizes 1024 2048 --repeat 5
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from src.ai.services.image_utils import make_black_transparent, BLACK_THRESHOLD  # noqa: E402
+
+
+def legacy_make_black_transparent(image: Image.Image, threshold: int = BLACK_THRESHOLD) -> Image.Image:
+    """Cách làm cũ trong create_content/create_cover/create_interleafs (giữ lại để so sánh)."""
+    image = image.convert("RGBA") if image.mode != "RGBA" else image.copy()
+
+    cleaned_pixels = []
+    for pixel in image.getdata():
+        r, g, b, a = pixel
+        if a > 0 and r < threshold and g < threshold and b < threshold:
+            cleaned_pixels.append((r, g, b, 0))
+        else:
+            cleaned_pixels.append((r, g, b, a))
+
+    image.putdata(cleaned_pixels)
+    return image
+
+
+def make_test_image(side: int) -> Image.Image:
+    """Ảnh giả lập kết quả swap: nền đen, character ở giữa với nhiễu màu."""
+    image = Image.new("RGBA", (side, side), (0, 0, 0, 255))
+    noise = Image.effect_noise((side // 2, side // 2), 80).convert("RGB")
+    image.paste(noise, (side // 4, side // 4))
+    # Thêm vài pixel gần đen rải rác
+    rng = random.Random(side)
+    pixels = image.load()
+    for _ in range(side * 4):
+        pixels[rng.randrange(side), rng.randrange(side)] = (rng.randrange(12), rng.randrange(12), rng.randrange(12), 255)
+    return image
+
+
+def measure(func, image: Image.Image, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(image)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048], help="Cạnh ảnh vuông (pixel)")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần đo, lấy kết quả tốt nhất")
+    parser.add_argument("--skip-legacy", action="store_true", help="Bỏ qua cách cũ (chậm) khi đo ảnh lớn")
+    args = parser.parse_args()
+
+    print(f"{'size':>10} {'MP':>6} {'legacy s':>10} {'legacy MP/s':>12} {'vector s':>10} {'vector MP/s':>12} {'speedup':>8}")
+    for side in args.sizes:
+        image = make_test_image(side)
+        megapixels = side * side / 1_000_000
+
+        vector_time = measure(make_black_transparent, image, args.repeat)
+
+        if args.skip_legacy:
+            legacy_cols = f"{'-':>10} {'-':>12}"
+            speedup = "-"
+        else:
+            legacy_time = measure(legacy_make_black_transparent, image, 1)
+            if legacy_make_black_transparent(image).tobytes() != make_black_transparent(image).tobytes():
+                raise SystemExit(f"Output mismatch at size {side}")
+            legacy_cols = f"{legacy_time:>10.3f} {megapixels / legacy_time:>12.2f}"
+            speedup = f"{legacy_time / vector_time:>7.0f}x"
+
+        print(f"{side}x{side:<5} {megapixels:>6.2f} {legacy_cols} {vector_time:>10.4f} {megapixels / vector_time:>12.1f} {speedup:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ import os
 from src.ai.services.create_cover import create_cover_test
 from src.ai.services.create_interleafs import create_interleafs_test
 from src.ai.services.create_content import create_main_content_test
+from src.ai.services.image_utils import load_transparent_handle
 
 # Pydantic models for test endpoints
 class TestCoverRequest(BaseModel):
@@ -240,9 +241,8 @@ async def test_content_endpoint(request: TestContentRequest):
                 character_path = page_metadata["character"]
                 character_full_path = BASE_DIR / character_path
 
-                # Convert to base64 data URL format for PDF generation
-                from src.ai.services.create_content import _convert_image_to_transparent_base64
-                processed_image_data = _convert_image_to_transparent_base64(str(character_full_path))
+                # Decode một lần + nền đen -> trong suốt (ImageHandle, không encode base64)
+                processed_image_data = await load_transparent_handle(str(character_full_path))
 
                 return page_content, processed_image_data
 